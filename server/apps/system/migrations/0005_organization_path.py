@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+def fill_organization_path(apps, schema_editor):
+    """
+    按层级生成组织架构的物化路径
+    """
+    Organization = apps.get_model('system', 'Organization')
+    parents = dict(Organization.objects.values_list('id', 'parent_id'))
+    paths = {}
+
+    def get_path(pk, seen=()):
+        if pk not in paths:
+            parent_id = parents.get(pk, None)
+            if parent_id is None or parent_id not in parents or parent_id in seen:
+                paths[pk] = '/{}/'.format(pk)
+            else:
+                paths[pk] = '{}{}/'.format(get_path(parent_id, seen + (pk,)), pk)
+        return paths[pk]
+
+    for pk in parents:
+        Organization.objects.filter(pk=pk).update(path=get_path(pk))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('system', '0004_githubtrending_alter_historicaldict_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='物化路径,如/1/5/12/,用于单次查询所有上级或下级', max_length=500, verbose_name='路径'),
+        ),
+        migrations.RunPython(fill_organization_path, migrations.RunPython.noop),
+    ]
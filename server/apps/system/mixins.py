@@ -1,4 +1,13 @@
+import hashlib
+from django.core.cache import cache
 from django.db.models.query import QuerySet
+from rest_framework import status
+from rest_framework.response import Response
+from utils.cache import bump_version, get_version
+
+TREE_VERSION_KEY = 'tree__{}__version'
+TREE_DATA_KEY = 'tree__data__{}'
+TREE_CACHE_TIMEOUT = 60*60
 
 class CreateUpdateModelAMixin:
     """
@@ -45,4 +54,70 @@ class OptimizationMixin:
             queryset = self.get_serializer_class().setup_eager_loading(queryset)  # 性能优化
         return queryset
 
-    
\ No newline at end of file
+    
+
+
+def bump_tree_version(model):
+    """
+    数据变更时更新树结构缓存版本号
+    """
+    return bump_version(TREE_VERSION_KEY.format(model._meta.label_lower))
+
+
+def build_tree(data, parent_field='parent'):
+    """
+    一次遍历将平铺列表组装为树,上级不在列表中的作为根节点
+    """
+    nodes = [dict(i) for i in data]
+    node_dict = {i['id']: i for i in nodes}
+    tree = []
+    for i in nodes:
+        parent = node_dict.get(i.get(parent_field, None), None)
+        if parent is not None and parent is not i:
+            parent.setdefault('children', []).append(i)
+        else:
+            tree.append(i)
+    return tree
+
+
+class TreeListMixin:
+    """
+    列表接口支持?format=tree返回树结构
+    按模型版本号缓存,支持ETag/If-None-Match返回304
+    模型需在signals中调用bump_tree_version
+    """
+    tree_format = 'tree'
+    tree_parent_field = 'parent'
+
+    def is_tree_request(self, request):
+        return getattr(self, 'action', None) == 'list' \
+            and request.query_params.get('format', None) == self.tree_format
+
+    def perform_content_negotiation(self, request, force=False):
+        # format参数被DRF用于指定渲染器,树结构请求使用默认渲染器
+        if self.is_tree_request(request):
+            renderer = self.get_renderers()[0]
+            return (renderer, renderer.media_type)
+        return super().perform_content_negotiation(request, force)
+
+    def get_tree_etag(self, request):
+        label = self.get_queryset().model._meta.label_lower
+        version = get_version(TREE_VERSION_KEY.format(label))
+        params = sorted((k, v) for k, v in request.query_params.lists() if k != 'format')
+        return hashlib.md5('{}:{}:{}'.format(label, version, params).encode()).hexdigest()
+
+    def list(self, request, *args, **kwargs):
+        if not self.is_tree_request(request):
+            return super().list(request, *args, **kwargs)
+        etag = self.get_tree_etag(request)
+        headers = {'ETag': '"{}"'.format(etag)}
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [i.strip().lstrip('W/').strip('"') for i in if_none_match.split(',')]:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        key = TREE_DATA_KEY.format(etag)
+        data = cache.get(key, None)
+        if data is None:
+            queryset = self.filter_queryset(self.get_queryset())
+            data = build_tree(self.get_serializer(queryset, many=True).data, self.tree_parent_field)
+            cache.set(key, data, TREE_CACHE_TIMEOUT)
+        return Response(data, headers=headers)
@@ -1,11 +1,15 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q, Value
+from django.db.models.functions import Concat, Substr
 from django.contrib.auth.models import AbstractUser
 from django.db.models.base import Model
 import django.utils.timezone as timezone
 from django.db.models.query import QuerySet
 
-from utils.model import SoftModel, BaseModel
+from utils.model import SoftModel, BaseModel, TreeManager, TreeQuerySet
+from utils.queryset import get_root_ids
 from simple_history.models import HistoricalRecords
+from .org_tree import get_org_tree
 
 
 
@@ -42,6 +46,8 @@ class Permission(SoftModel):
                             on_delete=models.SET_NULL, verbose_name='父')
     method = models.CharField('方法/代号', max_length=50, null=True, blank=True)
 
+    objects = TreeManager()
+
     def __str__(self):
         return self.name
 
@@ -51,6 +57,61 @@ class Permission(SoftModel):
         ordering = ['sort']
 
 
+class OrganizationQuerySet(TreeQuerySet):
+    """
+    组织架构上下级查询走进程内组织树快照
+    快照中不存在的节点(如事务内新建)按物化路径查询, 路径缺失时退回递归查询
+    """
+
+    def get_paths(self, root_ids):
+        paths = dict(self.model._base_manager.using(self.db).filter(pk__in=root_ids)
+            .exclude(path='').values_list('id', 'path'))
+        return paths if len(paths) == len(set(root_ids)) else None
+
+    def subtree_ids(self, roots, include_self=True):
+        tree, root_ids = get_org_tree(), get_root_ids(roots)
+        if all(i in tree for i in root_ids):
+            return tree.subtree_ids(root_ids, include_self)
+        paths = self.get_paths(root_ids)
+        if paths is None:
+            return super().subtree_ids(roots, include_self)
+        query = Q()
+        for path in paths.values():
+            query |= Q(path__startswith=path)
+        rows = list(self.model._base_manager.using(self.db).filter(query).values_list('id', 'path', 'is_deleted'))
+        deleted = {str(pk) for pk, _, is_deleted in rows if is_deleted}
+        depths = {}
+        for root_path in paths.values():
+            for pk, path in ((pk, path) for pk, path, _ in rows if path.startswith(root_path)):
+                # 与递归查询一致, 不经过已软删除的节点向下查找
+                chain = path[len(root_path):].strip('/')
+                chain = chain.split('/') if chain else []
+                if any(i in deleted for i in chain):
+                    continue
+                if len(chain) < depths.get(pk, len(chain) + 1):
+                    depths[pk] = len(chain)
+        if not include_self:
+            for i in root_ids:
+                if depths.get(i, None) == 0:
+                    del depths[i]
+        return depths
+
+    def ancestor_ids(self, roots, include_self=True):
+        tree, root_ids = get_org_tree(), get_root_ids(roots)
+        if all(i in tree for i in root_ids):
+            return tree.ancestor_ids(root_ids, include_self)
+        paths = self.get_paths(root_ids)
+        if paths is None:
+            return super().ancestor_ids(roots, include_self)
+        depths = {}
+        for path in paths.values():
+            for depth, pk in enumerate(reversed(path.strip('/').split('/'))):
+                pk = int(pk)
+                if (depth or include_self) and depth < depths.get(pk, depth + 1):
+                    depths[pk] = depth
+        return depths
+
+
 class Organization(SoftModel):
     """
     组织架构
@@ -64,6 +125,10 @@ class Organization(SoftModel):
                             choices=organization_type_choices, default='部门')
     parent = models.ForeignKey('self', null=True, blank=True,
                             on_delete=models.SET_NULL, verbose_name='父')
+    path = models.CharField('路径', max_length=500, default='', blank=True, db_index=True,
+                            help_text='物化路径,如/1/5/12/,用于单次查询所有上级或下级')
+
+    objects = TreeManager.from_queryset(OrganizationQuerySet)()
 
     class Meta:
         verbose_name = '组织架构'
@@ -72,6 +137,43 @@ class Organization(SoftModel):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.update_path()
+
+    def delete(self, using=None, soft=True, *args, **kwargs):
+        if soft:
+            return super().delete(using=using, soft=soft, *args, **kwargs)
+        children = list(Organization.objects.get_queryset(all=True).filter(parent=self))
+        ret = super().delete(using=using, soft=soft, *args, **kwargs)
+        for child in children:
+            # 上级被物理删除后成为根节点
+            child.parent = None
+            child.save(update_fields=['parent'])
+        return ret
+
+    def update_path(self):
+        """
+        维护物化路径,新建或移动时同步更新自身及所有下级的路径
+        软删除不改变路径,查询下级时排除已删除节点的子树
+        """
+        queryset = Organization.objects.get_queryset(all=True)
+        parent_path = '/'
+        if self.parent_id:
+            parent_path = queryset.filter(pk=self.parent_id).values_list('path', flat=True).first() or '/'
+        old_path = queryset.filter(pk=self.pk).values_list('path', flat=True).first()
+        path = '{}{}/'.format(parent_path, self.pk)
+        if old_path and parent_path.startswith(old_path):
+            raise ValueError('不能移动到自身或下级之下')
+        if path != old_path:
+            if old_path:
+                queryset.filter(path__startswith=old_path).update(
+                    path=Concat(Value(path), Substr('path', len(old_path)+1)))
+            else:
+                queryset.filter(pk=self.pk).update(path=path)
+        self.path = path
+
 
 class Role(SoftModel):
     """
@@ -134,6 +236,8 @@ class DictType(SoftModel):
     parent = models.ForeignKey('self', null=True, blank=True,
                             on_delete=models.SET_NULL, verbose_name='父')
 
+    objects = TreeManager()
+
     class Meta:
         verbose_name = '字典类型'
         verbose_name_plural = verbose_name
@@ -157,6 +261,8 @@ class Dict(SoftModel):
     is_used = models.BooleanField('是否有效', default=True)
     history = HistoricalRecords()
 
+    objects = TreeManager()
+
     class Meta:
         verbose_name = '字典'
         verbose_name_plural = verbose_name
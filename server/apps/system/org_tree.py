@@ -0,0 +1,137 @@
+import threading
+from django.apps import apps
+from utils.cache import bump_version, get_version
+
+ORG_VERSION_KEY = 'org__version'
+
+
+def get_org_version():
+    """
+    获取组织架构版本号
+    """
+    return get_version(ORG_VERSION_KEY)
+
+
+def bump_org_version():
+    """
+    组织架构变更时更新版本号,组织树快照和已解析的数据权限范围全部失效
+    """
+    return bump_version(ORG_VERSION_KEY, prefix='user__')
+
+
+class OrgTree(object):
+    """
+    组织架构树快照
+    parent: id -> 上级id
+    children: id -> 下级id列表
+    tin/tout: 欧拉序进出编号, 下级判断只需比较整数区间
+    depth: id -> 层级(根为0)
+    已软删除的节点及其子树不计入上级的下级范围
+    """
+
+    def __init__(self, rows, version=None):
+        self.version = version
+        self.parent, self.children, self.depth = {}, {}, {}
+        self.tin, self.tout, self.order = {}, {}, []
+        deleted = set()
+        for pk, parent_id, is_deleted in rows:
+            self.parent[pk] = parent_id
+            self.children.setdefault(pk, [])
+            if is_deleted:
+                deleted.add(pk)
+        roots = []
+        for pk, parent_id in self.parent.items():
+            if parent_id in self.parent and pk not in deleted:
+                self.children[parent_id].append(pk)
+            else:
+                roots.append(pk)
+        for pk in self.parent:
+            self.depth[pk] = len(self.get_ancestors(pk)) - 1
+        # 先从根节点遍历,剩余未访问的为成环数据,从任一节点断开
+        for root in roots + list(self.parent):
+            if root not in self.tin:
+                self._walk(root)
+
+    def _walk(self, root):
+        stack = [(root, False)]
+        while stack:
+            pk, leaving = stack.pop()
+            if leaving:
+                self.tout[pk] = len(self.order) - 1
+                continue
+            if pk in self.tin:
+                continue
+            self.tin[pk] = len(self.order)
+            self.order.append(pk)
+            stack.append((pk, True))
+            stack.extend((i, False) for i in reversed(self.children[pk]) if i not in self.tin)
+
+    def __contains__(self, pk):
+        return pk in self.tin
+
+    def get_ancestors(self, pk):
+        """
+        自身及所有上级id,由近到远
+        """
+        ret, seen = [], set()
+        while pk in self.parent and pk not in seen:
+            seen.add(pk)
+            ret.append(pk)
+            pk = self.parent[pk]
+        return ret
+
+    def is_descendant(self, pk, root):
+        """
+        pk是否为root自身或下级
+        """
+        return pk in self.tin and root in self.tin \
+            and self.tin[root] <= self.tin[pk] <= self.tout[root]
+
+    def is_ancestor(self, pk, node):
+        """
+        pk是否为node自身或上级
+        """
+        return self.is_descendant(node, pk)
+
+    def subtree_ids(self, roots, include_self=True):
+        depths = {}
+        for root in roots:
+            base = self.depth[root]
+            for pk in self.order[self.tin[root]:self.tout[root] + 1]:
+                depth = self.depth[pk] - base
+                if depth < depths.get(pk, depth + 1):
+                    depths[pk] = depth
+        if not include_self:
+            for root in roots:
+                if depths.get(root, None) == 0:
+                    del depths[root]
+        return depths
+
+    def ancestor_ids(self, roots, include_self=True):
+        depths = {}
+        for root in roots:
+            for depth, pk in enumerate(self.get_ancestors(root)):
+                if (depth or include_self) and depth < depths.get(pk, depth + 1):
+                    depths[pk] = depth
+        return depths
+
+
+_org_tree = None
+_org_tree_lock = threading.Lock()
+
+
+def get_org_tree():
+    """
+    获取进程内组织树快照,版本号变化时重建
+    """
+    global _org_tree
+    version = get_org_version()
+    tree = _org_tree
+    if tree is not None and tree.version == version:
+        return tree
+    with _org_tree_lock:
+        if _org_tree is None or _org_tree.version != version:
+            model = apps.get_model('system', 'Organization')
+            rows = model._base_manager.values_list('id', 'parent_id', 'is_deleted')
+            _org_tree = OrgTree(rows, version)
+        return _org_tree
@@ -1,25 +1,319 @@
+import time
 from django.core.cache import cache
+from django.db.models import Min
+from django.urls import URLPattern, URLResolver, get_resolver
 from rest_framework.permissions import BasePermission
-from utils.queryset import get_child_queryset2
-from .models import Organization, Permission
+from utils.cache import invalidate_local, local_get, local_set
+from .models import Organization, Permission, Role
+from .org_tree import get_org_tree, get_org_version
 from django.db.models import Q
 
+PERMS_INDEX_KEY = 'perms__index'
+USER_PERMS_KEY = 'user__{}__perms'
+USER_SCOPE_KEY = 'user__{}__scope'
+DATA_SCOPE_ALL = 'all' # 全部数据
+DATA_SCOPE_SELF = 'self' # 仅本人创建或编辑的数据
+PERMS_CACHE_TIMEOUT = 60*60
+
+
+def get_perms_cache_key(user):
+    return USER_PERMS_KEY.format(user.id)
+
+
+def get_role_perms_cache_key(role_id):
+    return 'role__{}__perms'.format(role_id)
+
+
+def get_role_version_key(role_id):
+    return 'role__{}__version'.format(role_id)
+
+
+def get_permission_index():
+    """
+    权限代号索引,每个Permission.method分配固定的整数位
+    返回 {'version':版本号, 'slots':{代号:位}}
+    """
+    index = cache.get(PERMS_INDEX_KEY)
+    if index is None:
+        index = build_permission_index()
+    return index
+
+
+def build_permission_index():
+    codes = Permission.objects.exclude(method__isnull=True).exclude(method='')\
+        .values('method').annotate(first=Min('id')).order_by('first')
+    index = {'version': time.time_ns(),
+             'slots': {i['method']: slot for slot, i in enumerate(codes)}}
+    cache.set(PERMS_INDEX_KEY, index, PERMS_CACHE_TIMEOUT)
+    return index
+
+
+def clear_permission_index():
+    """
+    功能权限变更后重建索引,已缓存的角色及用户权限位图因版本号不符自动失效
+    """
+    cache.delete(PERMS_INDEX_KEY)
+    invalidate_local(keys=[PERMS_INDEX_KEY])
+
+
+def set_role_version(role_ids):
+    version = time.time_ns()
+    cache.set_many({get_role_version_key(i): version for i in role_ids}, None)
+    return version
+
+
+def bump_role_version(role_ids):
+    """
+    角色的功能权限/数据权限变更时更新角色版本号
+    只影响该角色,拥有该角色的用户在下次校验时按版本号重新组合
+    各进程的本地用户缓存无法按角色定位,全部清除
+    """
+    set_role_version(role_ids)
+    invalidate_local(prefix='user__')
+
+
+def get_role_versions(role_ids):
+    """
+    获取角色版本号,缺失的补上新版本号
+    """
+    keys = {get_role_version_key(i): i for i in role_ids}
+    cached = cache.get_many(keys.keys())
+    versions = {keys[k]: v for k, v in cached.items()}
+    missing = [i for i in role_ids if i not in versions]
+    if missing:
+        version = set_role_version(missing)
+        versions.update({i: version for i in missing})
+    return versions
+
+
+def get_role_perms(role_ids, index, versions):
+    """
+    第一级缓存:按角色缓存的权限位图
+    返回 {role_id: {'version':角色版本号, 'index':索引版本号, 'admin':是否超管, 'bits':权限位图}}
+    """
+    keys = {get_role_perms_cache_key(i): i for i in role_ids}
+    role_perms = {}
+    for key, value in cache.get_many(keys.keys()).items():
+        role_id = keys[key]
+        if value['version'] == versions[role_id] and value['index'] == index['version']:
+            role_perms[role_id] = value
+    missing = [i for i in role_ids if i not in role_perms]
+    if missing:
+        slots = index['slots']
+        for role_id in missing:
+            role_perms[role_id] = {'version': versions[role_id], 'index': index['version'],
+                                   'admin': False, 'bits': 0}
+        codes = Role.perms.through.objects.filter(role_id__in=missing, permission__is_deleted=False)\
+            .values_list('role_id', 'permission__method')
+        for role_id, code in codes:
+            if code == 'admin':
+                role_perms[role_id]['admin'] = True
+            if code in slots:
+                role_perms[role_id]['bits'] |= 1 << slots[code]
+        cache.set_many({get_role_perms_cache_key(i): role_perms[i] for i in missing}, PERMS_CACHE_TIMEOUT)
+    return role_perms
+
+
+def compile_user_perms(user, index=None):
+    """
+    第二级缓存:由角色权限位图组合出用户权限位图并缓存
+    返回 {'version':索引版本号, 'roles':{角色id:角色版本号}, 'admin':是否超管, 'bits':权限位图}
+    """
+    if index is None:
+        index = get_permission_index()
+    role_ids = [] if user.is_superuser else list(user.roles.values_list('id', flat=True))
+    versions = get_role_versions(role_ids)
+    bits = 0
+    is_admin = user.is_superuser
+    for value in get_role_perms(role_ids, index, versions).values():
+        bits |= value['bits']
+        is_admin = is_admin or value['admin']
+    grants = {'version': index['version'], 'roles': versions, 'admin': is_admin, 'bits': bits}
+    cache.set(get_perms_cache_key(user), grants, PERMS_CACHE_TIMEOUT)
+    return grants
+
+
+def clear_user_perms(user_ids):
+    """
+    用户角色变更时清除用户权限缓存(包括数据权限范围)
+    """
+    keys = [USER_PERMS_KEY.format(i) for i in user_ids] + [USER_SCOPE_KEY.format(i) for i in user_ids]
+    cache.delete_many(keys)
+    invalidate_local(keys=keys)
+
+
+def get_user_perms(user):
+    """
+    获取用户权限位图
+    先查进程内缓存,未命中时与索引从redis一次取出,索引或角色版本不符时重新组合
+    """
+    key = get_perms_cache_key(user)
+    index, grants = local_get(PERMS_INDEX_KEY), local_get(key)
+    if index is not None and grants is not None and grants['version'] == index['version']:
+        return index, grants
+    cached = cache.get_many([PERMS_INDEX_KEY, key])
+    index = cached.get(PERMS_INDEX_KEY, None)
+    if index is None:
+        index = build_permission_index()
+    grants = cached.get(key, None)
+    if grants is None or grants['version'] != index['version'] \
+            or (grants['roles'] and get_role_versions(list(grants['roles'])) != grants['roles']):
+        grants = compile_user_perms(user, index)
+    local_set(PERMS_INDEX_KEY, index)
+    local_set(key, grants)
+    return index, grants
+
+
+def has_perm_code(index, grants, code):
+    """
+    位图校验是否拥有某权限代号
+    """
+    if grants['admin']:
+        return True
+    slot = index['slots'].get(code, None)
+    if slot is None:
+        return False
+    return bool(grants['bits'] >> slot & 1)
+
+
 def get_permission_list(user):
     """
     获取权限列表,可用redis存取
     """
+    index, grants = get_user_perms(user)
+    if grants['admin']:
+        return ['admin']
+    bits = grants['bits']
+    return [code for code, slot in index['slots'].items() if bits >> slot & 1]
+
+
+def resolve_data_scope(user, roles):
+    """
+    解析用户数据权限范围
+    roles: 用户角色的(id, datas)列表
+    返回DATA_SCOPE_ALL, DATA_SCOPE_SELF或部门id集合
+    """
+    data_range = [i[1] for i in roles]
+    if '全部' in data_range:
+        return DATA_SCOPE_ALL
+    elif '自定义' in data_range:
+        return frozenset(Organization.objects.filter(roles__id__in=[i[0] for i in roles])
+                         .values_list('id', flat=True))
+    elif '同级及以下' in data_range:
+        parent_id = get_org_tree().parent.get(user.dept_id, None)
+        if parent_id:
+            return frozenset(Organization.objects.subtree_ids(parent_id))
+    elif '本级及以下' in data_range:
+        if user.dept_id:
+            return frozenset(Organization.objects.subtree_ids(user.dept_id))
+        return frozenset()
+    elif '本级' in data_range:
+        return frozenset([user.dept_id]) if user.dept_id else frozenset()
+    elif '仅本人' in data_range:
+        return DATA_SCOPE_SELF
+    return DATA_SCOPE_ALL
+
+
+def get_data_scope(user):
+    """
+    获取用户数据权限范围
+    先查进程内缓存再查redis,按角色版本号,组织架构版本号及用户所属部门校验
+    """
     if user.is_superuser:
-        perms_list = ['admin']
-    else:
-        perms = Permission.objects.none()
-        roles = user.roles.all()
-        if roles:
-            for i in roles:
-                perms = perms | i.perms.all()
-        perms_list = perms.values_list('method', flat=True)
-        perms_list = list(set(perms_list))
-    cache.set(user.username + '__perms', perms_list, 60*60)
-    return perms_list
+        return DATA_SCOPE_ALL
+    key = USER_SCOPE_KEY.format(user.id)
+    value = local_get(key)
+    if value is not None and value['dept'] == user.dept_id:
+        return value['scope']
+    org_version = get_org_version()
+    value = cache.get(key, None)
+    if value is None or value['org'] != org_version or value['dept'] != user.dept_id \
+            or (value['roles'] and get_role_versions(list(value['roles'])) != value['roles']):
+        roles = list(user.roles.values_list('id', 'datas'))
+        scope = resolve_data_scope(user, roles)
+        versions = get_role_versions([i[0] for i in roles])
+        value = {'org': org_version, 'roles': versions, 'dept': user.dept_id, 'scope': scope}
+        cache.set(key, value, PERMS_CACHE_TIMEOUT)
+    local_set(key, value)
+    return value['scope']
+
+
+ROUTE_PERMS_PUBLIC = '*'
+_route_perms = {}
+_route_list = None
+
+
+def compile_route_perms(perms_map, method):
+    """
+    由perms_map计算请求方法所需的权限代号
+    返回None(未设置perms_map,不控权)或可通过的权限代号元组('*'表示公开,空元组表示拒绝)
+    """
+    if perms_map is NotImplemented:
+        return None
+    if not perms_map:
+        return ()
+    return tuple(perms_map[key] for key in perms_map if key == method or key == '*')
+
+
+def iter_url_callbacks(patterns, prefix=''):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            yield from iter_url_callbacks(pattern.url_patterns, prefix + str(pattern.pattern))
+        elif isinstance(pattern, URLPattern) and hasattr(pattern.callback, 'cls'):
+            route = prefix + str(pattern.pattern)
+            if '(?P<format>' not in route:
+                yield route, pattern.callback
+
+
+def build_route_perms():
+    """
+    遍历路由,编译(视图类, action, 请求方法)对应的权限代号表
+    @action(perms_map=...)的设置通过initkwargs传入,同样编译进表
+    """
+    global _route_list
+    route_list = []
+    for route, callback in iter_url_callbacks(get_resolver().url_patterns):
+        cls = callback.cls
+        initkwargs = getattr(callback, 'initkwargs', {})
+        actions = getattr(callback, 'actions', None)
+        if not actions:
+            actions = {m: None for m in cls.http_method_names if m != 'options' and hasattr(cls, m)}
+        perms_map = initkwargs.get('perms_map', getattr(cls, 'perms_map', NotImplemented))
+        permission_classes = initkwargs.get('permission_classes', cls.permission_classes)
+        for method, action in actions.items():
+            required = compile_route_perms(perms_map, method)
+            _route_perms[(cls, action, method)] = required
+            route_list.append({
+                'route': route, 'view': '{}.{}'.format(cls.__module__, cls.__name__),
+                'action': action, 'method': method,
+                'rbac': RbacPermission in permission_classes,
+                'perms': required})
+    _route_list = route_list
+    return _route_list
+
+
+def get_route_list():
+    """
+    路由权限表,用于审计各接口由哪些权限代号控权
+    """
+    if _route_list is None:
+        build_route_perms()
+    return _route_list
+
+
+def get_route_perms(view, method):
+    """
+    查询视图请求所需的权限代号,不在路由表中的视图按其perms_map编译后缓存
+    """
+    if _route_list is None:
+        build_route_perms()
+    key = (view.__class__, getattr(view, 'action', None), method)
+    try:
+        return _route_perms[key]
+    except KeyError:
+        required = compile_route_perms(getattr(view, 'perms_map', NotImplemented), method)
+        _route_perms[key] = required
+        return required
 
 
 class RbacPermission(BasePermission):
@@ -34,39 +328,56 @@ class RbacPermission(BasePermission):
         :param view:
         :return:
         """
+        required = get_route_perms(view, request.method.lower())
+        if required is None or ROUTE_PERMS_PUBLIC in required:
+            return True
         if not request.user:
-            perms = ['visitor'] # 如果没有经过认证,视为游客
-        else:
-            perms = cache.get(request.user.username + '__perms')
-        if not perms:
-            perms = get_permission_list(request.user)
-        if perms:
-            if 'admin' in perms:
-                return True
-            elif not hasattr(view, 'perms_map'):
+            # 如果没有经过认证,视为游客
+            return 'visitor' in required
+        index, grants = get_user_perms(request.user)
+        if grants['admin']:
+            return True
+        for code in required:
+            if has_perm_code(index, grants, code):
                 return True
-            else:
-                perms_map = view.perms_map
-                _method = request._request.method.lower()
-                if perms_map:
-                    for key in perms_map:
-                        if key == _method or key == '*':
-                            if perms_map[key] in perms or perms_map[key] == '*':
-                                return True
-                return False
-        else:
-            return False
-    
+        return False
+
     def has_object_permission(self, request, view, obj):
         """
         Return `True` if permission is granted, `False` otherwise.
+        view可设置obj_perm_check = False跳过数据权限控权
         """
         if not request.user:
             return False
-        if hasattr(obj, 'belong_dept'):
-            has_obj_perm(request.user, obj)
+        if hasattr(obj, 'belong_dept') and getattr(view, 'obj_perm_check', True):
+            return has_obj_perm(request.user, obj)
         return True
 
+
+def has_obj_perm_many(user, objs):
+    """
+    批量数据权限控权,数据权限范围只解析一次
+    需要控数据权限的表需有belong_dept, create_by, update_by字段(部门, 创建人, 编辑人)
+    传入user, obj实例列表
+    返回与objs顺序一致的是否可以操作列表
+    """
+    if user.is_superuser:
+        return [True] * len(objs)
+    scope = get_data_scope(user)
+    if scope == DATA_SCOPE_ALL:
+        return [True] * len(objs)
+    elif scope == DATA_SCOPE_SELF:
+        return [user.id in (obj.create_by_id, obj.update_by_id) for obj in objs]
+    return [obj.belong_dept_id in scope for obj in objs]
+
+
+def filter_permitted(user, objs):
+    """
+    返回有数据权限的obj实例列表
+    """
+    return [obj for obj, permitted in zip(objs, has_obj_perm_many(user, objs)) if permitted]
+
+
 def has_obj_perm(user, obj):
     """
     数据权限控权
@@ -74,24 +385,4 @@ def has_obj_perm(user, obj):
     需要控数据权限的表需有belong_dept, create_by, update_by字段(部门, 创建人, 编辑人)
     传入user, obj实例
     """
-    roles = user.roles
-    data_range = roles.values_list('datas', flat=True)
-    if '全部' in data_range:
-        return True
-    elif '自定义' in data_range:
-        depts = Organization.objects.filter(roles__in = roles)
-        if obj.belong_dept not in depts:
-            return False
-    elif '同级及以下' in data_range:
-        if user.dept.parent:
-            belong_depts = get_child_queryset2(user.dept.parent)
-            if obj.belong_dept not in belong_depts:
-                return False
-    elif '本级及以下' in data_range:
-        belong_depts = get_child_queryset2(user.dept)
-        if obj.belong_dept not in belong_depts:
-            return False
-    elif '本级' in data_range:
-        if obj.belong_dept is not user.dept:
-            return False
-    return True
\ No newline at end of file
+    return has_obj_perm_many(user, [obj])[0]
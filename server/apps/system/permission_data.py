@@ -2,8 +2,18 @@ from django.db.models import Q
 from django.db.models.query import QuerySet
 from rest_framework.generics import GenericAPIView
 from apps.system.mixins import CreateUpdateModelBMixin
-from apps.system.models import Organization
-from utils.queryset import get_child_queryset2
+from apps.system.permission import DATA_SCOPE_ALL, DATA_SCOPE_SELF, get_data_scope
+
+
+def filter_by_data_scope(queryset, user, scope):
+    """
+    按已解析的数据权限范围过滤queryset
+    """
+    if scope == DATA_SCOPE_ALL:
+        return queryset
+    elif scope == DATA_SCOPE_SELF:
+        return queryset.filter(Q(create_by=user)|Q(update_by=user))
+    return queryset.filter(belong_dept_id__in=scope)
 
 
 class RbacFilterSet(CreateUpdateModelBMixin, object):
@@ -14,7 +24,7 @@ class RbacFilterSet(CreateUpdateModelBMixin, object):
     带性能优化
     包括必要的创建和编辑操作
 
-    此处对性能有较大影响,根据业务需求进行修改或取舍
+    数据权限范围已解析为部门id集合并缓存,见get_data_scope
     """
     def get_queryset(self):
         assert self.queryset is not None, (
@@ -36,28 +46,7 @@ class RbacFilterSet(CreateUpdateModelBMixin, object):
 
         if hasattr(queryset.model, 'belong_dept'):
             user = self.request.user
-            roles = user.roles
-            data_range = roles.values_list('datas', flat=True)
-            if '全部' in data_range:
-                return queryset
-            elif '自定义' in data_range:
-                queryset = queryset.filter(belong_dept__roles__in=roles)
-                return queryset
-            elif '同级及以下' in data_range:
-                if user.dept.parent:
-                    belong_depts = get_child_queryset2(user.dept.parent)
-                    queryset = queryset.filter(belong_dept__in = belong_depts)
-                    return queryset
-            elif '本级及以下' in data_range:
-                belong_depts = get_child_queryset2(user.dept)
-                queryset = queryset.filter(belong_dept__in = belong_depts)
-                return queryset
-            elif '本级' in data_range:
-                queryset = queryset.filter(belong_dept = user.dept)
-                return queryset
-            elif '仅本人' in data_range:
-                queryset = queryset.filter(Q(create_by=user)|Q(update_by=user))
-                return queryset
+            queryset = filter_by_data_scope(queryset, user, get_data_scope(user))
         return queryset
 
 
@@ -70,29 +59,6 @@ def rbac_filter_queryset(user, queryset):
     if user.is_superuser:
         return queryset
 
-    roles = user.roles
-    data_range = roles.values_list('datas', flat=True)
     if hasattr(queryset.model, 'belong_dept'):
-        if '全部' in data_range:
-            return queryset
-        elif '自定义' in data_range:
-            if roles.depts.exists():
-                queryset = queryset.filter(belong_dept__in = roles.depts)
-                return queryset
-        elif '同级及以下' in data_range:
-            if user.dept.parent:
-                belong_depts = get_child_queryset2(user.dept.parent)
-                queryset = queryset.filter(belong_dept__in = belong_depts)
-                return queryset
-        elif '本级及以下' in data_range:
-            belong_depts = get_child_queryset2(user.dept)
-            queryset = queryset.filter(belong_dept__in = belong_depts)
-            return queryset
-        elif '本级' in data_range:
-            queryset = queryset.filter(belong_dept = user.dept)
-            return queryset
-        elif '仅本人' in data_range:
-            queryset = queryset.filter(Q(create_by=user)|Q(update_by=user))
-            return queryset    
+        queryset = filter_by_data_scope(queryset, user, get_data_scope(user))
     return queryset
-
@@ -109,6 +109,12 @@ class OrganizationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Organization
         fields = '__all__'
+        read_only_fields = ['path']
+
+    def validate_parent(self, value):
+        if value and self.instance and self.instance.path and value.path.startswith(self.instance.path):
+            raise serializers.ValidationError('上级不能是自身或下级')
+        return value
 
 class UserSimpleSerializer(serializers.ModelSerializer):
     class Meta:
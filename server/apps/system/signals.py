@@ -1,12 +1,66 @@
-from django.db.models.signals import m2m_changed
-from .models import Role, Permission, User
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from .models import DictType, Organization, Role, Permission, User
 from django.dispatch import receiver
-from django.core.cache import cache
-from .permission import get_permission_list
+from django.db import transaction
+from .mixins import bump_tree_version
+from .org_tree import bump_org_version
+from .permission import bump_role_version, clear_permission_index, clear_user_perms
 
-# 变更用户角色时动态更新权限或者前端刷新
+# 变更用户角色时清除用户权限缓存,下次校验时由角色缓存重新组合
+# 缓存失效均在事务提交后执行,避免其他进程按未提交前的数据重建缓存
 @receiver(m2m_changed, sender=User.roles.through)
-def update_perms_cache_user(sender, instance, action, **kwargs):
-    if action in ['post_remove', 'post_add']:
-        if cache.get(instance.username+'__perms', None):
-            get_permission_list(instance)
\ No newline at end of file
+def update_perms_cache_user(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._cleared_user_ids = list(instance.user_set.values_list('id', flat=True))
+    elif action in ['post_remove', 'post_add', 'post_clear']:
+        if not reverse:
+            user_ids = [instance.id]
+        elif action == 'post_clear':
+            user_ids = getattr(instance, '_cleared_user_ids', [])
+        else:
+            user_ids = list(pk_set)
+        transaction.on_commit(lambda: clear_user_perms(user_ids))
+
+# 变更角色的功能权限/数据权限时只更新该角色的版本号
+@receiver(m2m_changed, sender=Role.perms.through)
+@receiver(m2m_changed, sender=Role.depts.through)
+def update_perms_cache_role(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._cleared_role_ids = list(instance.roles.values_list('id', flat=True)) \
+            if sender is Role.depts.through else list(instance.role_set.values_list('id', flat=True))
+    elif action in ['post_remove', 'post_add', 'post_clear']:
+        if not reverse:
+            role_ids = [instance.id]
+        elif action == 'post_clear':
+            role_ids = getattr(instance, '_cleared_role_ids', [])
+        else:
+            role_ids = list(pk_set)
+        transaction.on_commit(lambda: bump_role_version(role_ids))
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def update_role_version(sender, instance, **kwargs):
+    role_id = instance.id
+    transaction.on_commit(lambda: bump_role_version([role_id]))
+
+# 变更功能权限时重建权限索引
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def update_perms_index(sender, instance, **kwargs):
+    transaction.on_commit(clear_permission_index)
+
+# 变更组织架构时组织树快照及数据权限范围失效,事务提交后再更新版本号,避免其他进程读到未提交的数据
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def update_org_version(sender, instance, **kwargs):
+    transaction.on_commit(bump_org_version)
+
+# 变更树形数据时树结构接口缓存失效
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=DictType)
+@receiver(post_delete, sender=DictType)
+def update_tree_version(sender, instance, **kwargs):
+    transaction.on_commit(lambda: bump_tree_version(sender))
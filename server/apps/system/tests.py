@@ -1,3 +1,381 @@
-from django.test import TestCase
+import json
+from unittest import mock
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIClient
+from utils.cache import INVALIDATE_CHANNEL, _apply_invalidation, local_cache, local_get, local_set
+from utils.queryset import get_tree_ids
+from .models import Organization, Permission, Role, User
+from .org_tree import OrgTree, bump_org_version, get_org_tree, get_org_version
+from .permission import (USER_PERMS_KEY, USER_SCOPE_KEY, compile_route_perms, get_data_scope, get_permission_list,
+                         get_route_list)
+from .views import PermissionViewSet
 
-# Create your tests here.
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class OrganizationPathTestCase(TestCase):
+    """
+    组织树快照未命中时按物化路径查询, 结果与递归查询一致
+    """
+
+    def setUp(self):
+        self.root = Organization.objects.create(name='公司', type='公司')
+        self.a = Organization.objects.create(name='A', parent=self.root)
+        self.b = Organization.objects.create(name='B', parent=self.root)
+        self.a1 = Organization.objects.create(name='A1', parent=self.a)
+        self.a11 = Organization.objects.create(name='A11', parent=self.a1)
+        self.b1 = Organization.objects.create(name='B1', parent=self.b)
+        # 软删除的节点不再向下查找
+        self.b.delete()
+
+    def assert_same(self, roots, ancestors=False):
+        with mock.patch('apps.system.models.get_org_tree', return_value=OrgTree([])):
+            for include_self in (True, False):
+                if ancestors:
+                    ret = Organization.objects.ancestor_ids(roots, include_self)
+                else:
+                    ret = Organization.objects.subtree_ids(roots, include_self)
+                expected = get_tree_ids(Organization, roots, include_self, ancestors)
+                self.assertEqual(ret, expected)
+
+    def test_subtree(self):
+        self.assert_same(self.root.id)
+        self.assert_same([self.a.id, self.a1.id])
+        self.assert_same(self.b.id)
+
+    def test_ancestors(self):
+        self.assert_same(self.a11.id, ancestors=True)
+        self.assert_same([self.a11.id, self.b1.id], ancestors=True)
+
+    def test_move(self):
+        self.a.parent = self.b1
+        self.a.save()
+        self.assertEqual(Organization.objects.get(id=self.a11.id).path,
+            '/{}/{}/{}/{}/{}/{}/'.format(self.root.id, self.b.id, self.b1.id, self.a.id, self.a1.id, self.a11.id))
+        self.assert_same(self.b1.id)
+        self.assert_same(self.a11.id, ancestors=True)
+
+
+class OrgTreeTestCase(TestCase):
+    """
+    组织树快照欧拉序下级判断, 及版本号变化后重建
+    """
+
+    def test_euler(self):
+        # 1 -> 2 -> 4, 1 -> 3(已删除) -> 5, 6 <-> 7 成环
+        rows = [(1, None, False), (2, 1, False), (3, 1, True), (4, 2, False), (5, 3, False),
+                (6, 7, False), (7, 6, False)]
+        tree = OrgTree(rows)
+        self.assertEqual(sorted(tree.order), [1, 2, 3, 4, 5, 6, 7])
+        for pk in tree.order:
+            self.assertLessEqual(tree.tin[pk], tree.tout[pk])
+        self.assertTrue(tree.is_descendant(4, 1))
+        self.assertTrue(tree.is_descendant(2, 2))
+        self.assertTrue(tree.is_ancestor(1, 4))
+        self.assertFalse(tree.is_descendant(1, 4))
+        self.assertFalse(tree.is_descendant(4, 99))
+        # 已删除节点及其子树不属于上级
+        self.assertFalse(tree.is_descendant(3, 1))
+        self.assertFalse(tree.is_descendant(5, 1))
+        self.assertTrue(tree.is_descendant(5, 3))
+        self.assertEqual(tree.subtree_ids([1]), {1: 0, 2: 1, 4: 2})
+        self.assertEqual(tree.subtree_ids([1, 2], include_self=False), {4: 1})
+        self.assertEqual(tree.ancestor_ids([4]), {4: 0, 2: 1, 1: 2})
+        self.assertEqual(tree.depth[4], 2)
+        # 成环数据也能完成遍历
+        self.assertTrue(tree.is_descendant(7, 6) ^ tree.is_descendant(6, 7))
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_version(self):
+        cache.clear()
+        local_cache.clear()
+        root = Organization.objects.create(name='公司', type='公司')
+        tree = get_org_tree()
+        self.assertIs(get_org_tree(), tree)
+        self.assertEqual(tree.version, get_org_version())
+        local_set('user__perms_1', 1)
+        # 事务提交前不更新版本号
+        with self.captureOnCommitCallbacks() as callbacks:
+            org = Organization.objects.create(name='A', parent=root)
+        self.assertIs(get_org_tree(), tree)
+        self.assertNotIn(org.id, tree)
+        for callback in callbacks:
+            callback()
+        new_tree = get_org_tree()
+        self.assertIsNot(new_tree, tree)
+        self.assertTrue(new_tree.is_descendant(org.id, root.id))
+        self.assertIsNone(local_get('user__perms_1'))
+        bump_org_version()
+        self.assertIsNot(get_org_tree(), new_tree)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PermissionCacheTestCase(TestCase):
+    """
+    角色权限/部门、用户角色、组织架构变更后权限缓存失效
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.root = Organization.objects.create(name='公司', type='公司')
+            self.a = Organization.objects.create(name='A', parent=self.root)
+            self.b = Organization.objects.create(name='B', parent=self.root)
+            self.b1 = Organization.objects.create(name='B1', parent=self.b)
+            self.p_list = Permission.objects.create(name='用户列表', method='user_list')
+            self.p_create = Permission.objects.create(name='新增用户', method='user_create')
+            self.role = Role.objects.create(name='角色', datas='本级及以下')
+            self.role.perms.add(self.p_list)
+            self.user = User.objects.create(username='test', dept=self.a)
+            self.user.roles.add(self.role)
+
+    def get_user(self):
+        return User.objects.get(id=self.user.id)
+
+    def assert_cached(self, perms, scope):
+        user = self.get_user()
+        self.assertEqual(sorted(get_permission_list(user)), perms)
+        self.assertEqual(get_data_scope(user), scope)
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(get_permission_list(user)), perms)
+            self.assertEqual(get_data_scope(user), scope)
+
+    def commit(self):
+        # 缓存在事务提交后失效
+        return self.captureOnCommitCallbacks(execute=True)
+
+    def test_role_perms(self):
+        self.assert_cached(['user_list'], {self.a.id})
+        with self.commit():
+            self.role.perms.add(self.p_create)
+        self.assert_cached(['user_create', 'user_list'], {self.a.id})
+        with self.commit():
+            self.role.perms.remove(self.p_list)
+        self.assert_cached(['user_create'], {self.a.id})
+
+    def test_role_depts(self):
+        with self.commit():
+            self.role.datas = '自定义'
+            self.role.save()
+            self.role.depts.add(self.b)
+        self.assert_cached(['user_list'], {self.b.id})
+        with self.commit():
+            self.role.depts.add(self.b1)
+        self.assert_cached(['user_list'], {self.b.id, self.b1.id})
+        with self.commit():
+            self.b.roles.clear()
+        self.assert_cached(['user_list'], {self.b1.id})
+
+    def test_user_roles(self):
+        self.assert_cached(['user_list'], {self.a.id})
+        with self.commit():
+            role = Role.objects.create(name='管理员', datas='全部')
+            role.perms.add(self.p_create)
+            self.user.roles.add(role)
+        self.assert_cached(['user_create', 'user_list'], 'all')
+        with self.commit():
+            self.user.roles.remove(self.role)
+        self.assert_cached(['user_create'], 'all')
+        with self.commit():
+            role.user_set.clear()
+        self.assert_cached([], 'all')
+
+    def test_permission_index(self):
+        self.assert_cached(['user_list'], {self.a.id})
+        with self.commit():
+            self.p_list.method = 'user_view'
+            self.p_list.save()
+        self.assert_cached(['user_view'], {self.a.id})
+
+    def test_after_commit(self):
+        """
+        事务提交前不失效, 避免其他进程按旧数据重建缓存
+        """
+        self.assert_cached(['user_list'], {self.a.id})
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.role.perms.add(self.p_create)
+            self.user.roles.add(Role.objects.create(name='管理员', datas='全部'))
+            self.assert_cached(['user_list'], {self.a.id})
+        for callback in callbacks:
+            callback()
+        self.assert_cached(['user_create', 'user_list'], 'all')
+
+    def test_org_move(self):
+        self.assert_cached(['user_list'], {self.a.id})
+        with self.commit():
+            self.b.parent = self.a
+            self.b.save()
+        self.assert_cached(['user_list'], {self.a.id, self.b.id, self.b1.id})
+        with self.commit():
+            self.b1.parent = self.root
+            self.b1.save()
+        self.assert_cached(['user_list'], {self.a.id, self.b.id})
+
+    def test_user_dept(self):
+        self.assert_cached(['user_list'], {self.a.id})
+        self.user.dept = self.b
+        self.user.save()
+        self.assert_cached(['user_list'], {self.b.id, self.b1.id})
+
+    def test_publish(self):
+        """
+        失效消息发布给其他worker, 收到消息后清除本地缓存
+        """
+        client = mock.Mock()
+        key = USER_PERMS_KEY.format(self.user.id)
+        with mock.patch('utils.cache.get_redis_client', return_value=client), self.commit():
+            self.role.perms.add(self.p_create)
+            self.user.roles.remove(self.role)
+        messages = [json.loads(i.args[1]) for i in client.publish.call_args_list
+                    if i.args[0] == INVALIDATE_CHANNEL]
+        self.assertIn({'keys': [], 'prefix': 'user__'}, messages)
+        self.assertIn({'keys': [key, USER_SCOPE_KEY.format(self.user.id)], 'prefix': None}, messages)
+        local_set(key, 'stale')
+        for message in messages:
+            _apply_invalidation(message)
+        self.assertIsNone(local_get(key))
+
+
+class RoutePermsTestCase(SimpleTestCase):
+    """
+    路由权限表按perms_map及@action(perms_map=...)编译
+    """
+
+    def test_compile(self):
+        self.assertIsNone(compile_route_perms(NotImplemented, 'get'))
+        self.assertEqual(compile_route_perms({}, 'get'), ())
+        self.assertEqual(compile_route_perms({'get': 'a', 'post': 'b', '*': 'c'}, 'get'), ('a', 'c'))
+
+    def test_route_list(self):
+        routes = {(i['view'], i['action'], i['method']): i for i in get_route_list()}
+        view = '{}.{}'.format(PermissionViewSet.__module__, PermissionViewSet.__name__)
+        self.assertEqual(routes[(view, 'list', 'get')]['perms'], ('*',))
+        self.assertEqual(routes[(view, 'create', 'post')]['perms'], ('perm_create',))
+        self.assertEqual(routes[(view, 'destroy', 'delete')]['perms'], ('perm_delete',))
+        self.assertEqual(routes[(view, 'routes', 'get')]['perms'], ('perm_update',))
+        self.assertTrue(routes[(view, 'routes', 'get')]['rbac'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RbacPermissionTestCase(TestCase):
+    """
+    先查路由所需权限, 公开接口不要求用户有任何功能权限
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user = User.objects.create(username='test')
+            self.role = Role.objects.create(name='角色')
+            self.perm = Permission.objects.create(name='编辑权限', method='perm_update')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_public_without_perms(self):
+        self.assertEqual(self.client.get('/api/system/permission/').json()['code'], 200)
+        self.assertEqual(self.client.post('/api/system/permission/', {'name': 'x'}).json()['code'], 403)
+        self.assertEqual(self.client.get('/api/system/permission/routes/').json()['code'], 403)
+
+    def test_routes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.role.perms.add(self.perm)
+            self.user.roles.add(self.role)
+        res = self.client.get('/api/system/permission/routes/').json()
+        self.assertEqual(res['code'], 200)
+        routes = {(i['route'], i['method']): i for i in res['data']}
+        route = routes[('api/system/^permission/routes/$', 'get')]
+        self.assertFalse(route['public'])
+        self.assertEqual(route['perms'], [{'code': 'perm_update', 'name': '编辑权限'}])
+        route = routes[('api/system/^permission/$', 'get')]
+        self.assertTrue(route['public'])
+        self.assertEqual(route['perms'], [])
+        self.assertEqual(self.client.post('/api/system/permission/', {'name': 'x'}).json()['code'], 403)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TreeListTestCase(TestCase):
+    """
+    ?format=tree返回树结构, ETag未变化时返回304, 数据变更后ETag变化
+    """
+    url = '/api/system/organization/?format=tree'
+
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.root = Organization.objects.create(name='公司', type='公司')
+            self.a = Organization.objects.create(name='A', parent=self.root)
+            user = User.objects.create(username='test')
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_etag(self):
+        res = self.client.get(self.url)
+        self.assertEqual(res.status_code, 200)
+        etag = res['ETag']
+        data = res.json()['data']
+        self.assertEqual([(i['id'], [j['id'] for j in i['children']]) for i in data], [(self.root.id, [self.a.id])])
+        # 命中缓存不查询数据库
+        with self.assertNumQueries(0):
+            res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res['ETag'], etag)
+            res = self.client.get(self.url)
+            self.assertEqual(res.json()['data'], data)
+        self.assertNotEqual(self.client.get(self.url + '&search=A')['ETag'], etag)
+
+    def test_version_bump(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            b = Organization.objects.create(name='B', parent=self.root)
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res['ETag'], etag)
+        self.assertEqual([j['id'] for j in res.json()['data'][0]['children']], [self.a.id, b.id])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TreeQuerySetTestCase(TestCase):
+    """
+    descendants/ancestors单次查询返回数据及depth
+    """
+
+    def setUp(self):
+        self.root = Permission.objects.create(name='系统')
+        self.a = Permission.objects.create(name='用户', parent=self.root)
+        self.a1 = Permission.objects.create(name='新增用户', parent=self.a)
+        self.b = Permission.objects.create(name='角色', parent=self.root)
+        self.b1 = Permission.objects.create(name='新增角色', parent=self.b)
+        self.b.delete()
+
+    def depths(self, queryset):
+        with self.assertNumQueries(1):
+            return {i.id: i.depth for i in queryset}
+
+    def test_descendants(self):
+        for include_self in (True, False):
+            expected = get_tree_ids(Permission, self.root, include_self)
+            self.assertEqual(self.depths(Permission.objects.descendants(
+                self.root, include_self, with_depth=True)), expected)
+        self.assertEqual(self.depths(Permission.objects.descendants(
+            [self.a, self.a1], with_depth=True)), {self.a.id: 0, self.a1.id: 0})
+        self.assertEqual(set(Permission.objects.descendants(self.a)
+                             .values_list('id', flat=True)), {self.a.id, self.a1.id})
+        self.assertEqual(Permission.objects.descendants([]).count(), 0)
+
+    def test_ancestors(self):
+        self.assertEqual(self.depths(Permission.objects.ancestors(self.a1, with_depth=True)),
+                         {self.a1.id: 0, self.a.id: 1, self.root.id: 2})
+        self.assertEqual(self.depths(Permission.objects.ancestors(self.a1, False, with_depth=True)
+                                     .order_by('depth')), {self.a.id: 1, self.root.id: 2})
+
+    def test_combine(self):
+        queryset = Permission.objects.descendants(self.a, False) | Permission.objects.filter(id=self.root.id)
+        self.assertEqual(set(queryset.values_list('id', flat=True)), {self.a1.id, self.root.id})
+        queryset = Permission.objects.filter(id__in=Permission.objects.descendants(self.a).values('id'))
+        self.assertEqual(set(queryset.values_list('id', flat=True)), {self.a.id, self.a1.id})
+        self.assertEqual(Permission.objects.descendants(self.root).filter(
+            id__in=Permission.objects.ancestors(self.a1)).count(), 3)
@@ -20,13 +20,12 @@ from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.exceptions import ValidationError, ParseError
-from utils.queryset import get_child_queryset2
 
 from .filters import UserFilter
-from .mixins import CreateUpdateModelAMixin, OptimizationMixin
+from .mixins import CreateUpdateModelAMixin, OptimizationMixin, TreeListMixin
 from .models import (Dict, DictType, File, Organization, Permission, Position,
                      Role, User)
-from .permission import RbacPermission, get_permission_list
+from .permission import ROUTE_PERMS_PUBLIC, RbacPermission, get_permission_list, get_route_list
 from .permission_data import RbacFilterSet
 from .serializers import (DictSerializer, DictTypeSerializer, FileSerializer,
                           OrganizationSerializer, PermissionSerializer,
@@ -133,7 +132,7 @@ class PTaskViewSet(OptimizationMixin, ModelViewSet):
         return Response(status=status.HTTP_200_OK)
 
 
-class DictTypeViewSet(ModelViewSet):
+class DictTypeViewSet(TreeListMixin, ModelViewSet):
     """
     数据字典类型-增删改查
     """
@@ -194,7 +193,7 @@ class TestView(APIView):
         return Response('测试api接口')
 
 
-class PermissionViewSet(ModelViewSet):
+class PermissionViewSet(TreeListMixin, ModelViewSet):
     """
     权限-增删改查
     """
@@ -207,8 +206,26 @@ class PermissionViewSet(ModelViewSet):
     ordering_fields = ['sort']
     ordering = ['sort', 'pk']
 
+    @action(methods=['get'], detail=False, perms_map={'get':'perm_update'}, pagination_class=None)
+    def routes(self, request, pk=None):
+        """
+        接口权限表,用于审计各接口由哪些权限代号控权
+        """
+        route_list = get_route_list()
+        codes = set()
+        for i in route_list:
+            codes.update(i['perms'] or [])
+        names = dict(Permission.objects.filter(method__in=codes).values_list('method', 'name'))
+        data = []
+        for i in route_list:
+            perms = [code for code in (i['perms'] or []) if code != ROUTE_PERMS_PUBLIC]
+            data.append({**i,
+                'public': i['perms'] is None or ROUTE_PERMS_PUBLIC in i['perms'],
+                'perms': [{'code': code, 'name': names.get(code, None)} for code in perms]})
+        return Response(data)
+
 
-class OrganizationViewSet(ModelViewSet):
+class OrganizationViewSet(TreeListMixin, ModelViewSet):
     """
     组织机构-增删改查
     """
@@ -259,8 +276,9 @@ class UserViewSet(ModelViewSet):
             queryset = self.get_serializer_class().setup_eager_loading(queryset)  # 性能优化
         dept = self.request.query_params.get('dept', None)  # 该部门及其子部门所有员工
         if dept:
-            deptqueryset = get_child_queryset2(Organization.objects.get(pk=dept))
-            queryset = queryset.filter(dept__in=deptqueryset)
+            if not dept.isdigit():
+                raise ParseError('部门参数有误')
+            queryset = queryset.filter(dept__in=list(Organization.objects.subtree_ids(int(dept))))
         return queryset
 
     def get_serializer_class(self):
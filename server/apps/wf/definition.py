@@ -0,0 +1,95 @@
+from django.core.cache import cache
+from utils.cache import bump_version, get_version, local_get, local_set
+from .expression import ExpressionError, compile_conditions
+from .models import CustomField, State, Transition
+
+WF_VERSION_KEY = 'workflow__{}__version'
+WF_DEFINITION_KEY = 'workflow__{}__definition'
+WF_DEFINITION_TIMEOUT = 60*60*24
+
+
+class WorkflowDefinition(object):
+    """
+    编译后的工作流定义(状态,流转,自定义字段),按工作流版本号缓存
+    其中的对象为进程内共享,只读使用
+    """
+
+    def __init__(self, workflow_id, version, states, transitions, custom_fields):
+        self.workflow_id = workflow_id
+        self.version = version
+        self.state_list = tuple(states)
+        self.states = {i.id: i for i in self.state_list}
+        # 流转的源状态和目的状态直接指向定义中的状态,避免再次查询
+        for i in transitions:
+            if i.source_state_id in self.states:
+                i.source_state = self.states[i.source_state_id]
+            if i.destination_state_id in self.states:
+                i.destination_state = self.states[i.destination_state_id]
+        self.transition_list = tuple(transitions)
+        self.transitions = {i.id: i for i in self.transition_list}
+        self.transitions_by_source = {}
+        for i in self.transition_list:
+            self.transitions_by_source.setdefault(i.source_state_id, []).append(i)
+        self.transitions_by_source = {k: tuple(v) for k, v in self.transitions_by_source.items()}
+        # 条件表达式随定义一起预编译,历史数据中编译失败的在使用时报错
+        self.conditions = {}
+        for i in self.transition_list:
+            try:
+                self.conditions[i.id] = compile_conditions(i.condition_expression)
+            except ExpressionError as e:
+                self.conditions[i.id] = e
+        self.start_state = self._get_only_state(State.STATE_TYPE_START)
+        self.end_state = self._get_only_state(State.STATE_TYPE_END)
+        self.custom_fields = tuple(custom_fields)
+        self.field_keys = tuple(i.field_key for i in self.custom_fields)
+
+    def _get_only_state(self, type):
+        states = [i for i in self.state_list if i.type == type]
+        return states[0] if len(states) == 1 else None
+
+    def get_state_transitions(self, state_id):
+        return self.transitions_by_source.get(state_id, ())
+
+    def get_conditions(self, transition):
+        """
+        获取流转预编译的条件表达式[(ConditionExpression, target_state_id)]
+        """
+        conditions = self.conditions.get(transition.id, None)
+        if conditions is None:
+            conditions = compile_conditions(transition.condition_expression)
+        if isinstance(conditions, ExpressionError):
+            raise conditions
+        return conditions
+
+    @classmethod
+    def compile(cls, workflow_id, version):
+        states = State.objects.filter(workflow_id=workflow_id).order_by('sort', 'id')
+        transitions = Transition.objects.filter(workflow_id=workflow_id).order_by('id')
+        custom_fields = CustomField.objects.filter(workflow_id=workflow_id).order_by('sort', 'id')
+        return cls(workflow_id, version, list(states), list(transitions), list(custom_fields))
+
+
+def bump_workflow_version(workflow_id):
+    """
+    工作流的状态,流转或自定义字段变更时更新版本号
+    """
+    return bump_version(WF_VERSION_KEY.format(workflow_id))
+
+
+def get_workflow_definition(workflow):
+    """
+    获取工作流定义,先查进程内缓存再查redis,版本号不一致时重新编译
+    workflow: 工作流实例或id
+    """
+    workflow_id = getattr(workflow, 'pk', workflow)
+    version = get_version(WF_VERSION_KEY.format(workflow_id))
+    key = WF_DEFINITION_KEY.format(workflow_id)
+    definition = local_get(key)
+    if definition is not None and definition.version == version:
+        return definition
+    definition = cache.get(key, None)
+    if definition is None or definition.version != version:
+        definition = WorkflowDefinition.compile(workflow_id, version)
+        cache.set(key, definition, WF_DEFINITION_TIMEOUT)
+    local_set(key, definition, WF_DEFINITION_TIMEOUT)
+    return definition
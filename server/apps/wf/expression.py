@@ -0,0 +1,99 @@
+import ast
+import datetime
+import re
+import time
+
+SLOT_PATTERN = re.compile(r'\{([^{}]+)\}')
+EXPRESSION_MODULES = {'datetime': datetime, 'time': time}
+MODULE_ATTRS = {
+    'datetime': ('datetime', 'date', 'time', 'timedelta', 'timezone'),
+    'time': ('time', 'localtime', 'mktime', 'strftime', 'strptime'),
+}
+# strptime等方法内部需要__import__,表达式中的名称已在编译时限制
+EXPRESSION_GLOBALS = {'__builtins__': {'__import__': __import__}, **EXPRESSION_MODULES}
+ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot,
+    ast.Constant, ast.List, ast.Tuple, ast.Subscript, ast.Slice, ast.Name, ast.Load,
+    ast.Attribute, ast.Call, ast.keyword,
+) + ((ast.Index,) if hasattr(ast, 'Index') else ()) # python3.8的下标节点
+# 字符串格式化可通过{0.__class__}等访问内部属性
+BLOCKED_METHODS = ('format', 'format_map')
+
+
+class ExpressionError(Exception):
+    pass
+
+
+class ConditionExpression(object):
+    """
+    预编译的流转条件表达式
+    {field_key}替换为变量槽位,解析为AST校验后编译,求值时直接绑定字段值
+    只支持简单运算、datetime/time运算及字段值的方法调用
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.slots = []
+        source = SLOT_PATTERN.sub(self._add_slot, expression)
+        self.slots = tuple(self.slots)
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ExpressionError('表达式语法错误: {}'.format(e.msg))
+        self._validate(tree)
+        self.code = compile(tree, '<condition>', 'eval')
+
+    def _add_slot(self, match):
+        key = match.group(1).strip()
+        if key not in self.slots:
+            self.slots.append(key)
+        return '_v{}'.format(self.slots.index(key))
+
+    def _validate(self, tree):
+        names = {'_v{}'.format(i) for i in range(len(self.slots))}
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ExpressionError('表达式不支持{}'.format(type(node).__name__))
+            if isinstance(node, ast.Name) and node.id not in names and node.id not in EXPRESSION_MODULES:
+                raise ExpressionError('表达式中的{}未定义,字段请用{{}}包裹'.format(node.id))
+            if isinstance(node, ast.Attribute) and (node.attr.startswith('_') or (
+                    isinstance(node.value, ast.Name) and node.value.id in MODULE_ATTRS
+                    and node.attr not in MODULE_ATTRS[node.value.id])):
+                raise ExpressionError('表达式不支持访问{}'.format(node.attr))
+            if isinstance(node, ast.Call):
+                # 只能调用方法, 如datetime.datetime.now().date()、{name}.startswith('a')
+                # 调用链的起点只能是字段、datetime/time或常量, 已由上面的名称校验保证
+                if not isinstance(node.func, ast.Attribute):
+                    raise ExpressionError('表达式只支持调用方法')
+                if node.func.attr in BLOCKED_METHODS:
+                    raise ExpressionError('表达式不支持调用{}'.format(node.func.attr))
+
+    def __reduce__(self):
+        # 编译结果不可序列化,存入redis时只保存表达式
+        return (ConditionExpression, (self.expression,))
+
+    def evaluate(self, values):
+        """
+        values: 字段值字典,缺少的字段为None
+        """
+        local = {'_v{}'.format(i): values.get(key, None) for i, key in enumerate(self.slots)}
+        return eval(self.code, EXPRESSION_GLOBALS, local)
+
+
+def compile_conditions(condition_expression):
+    """
+    编译流转的条件表达式列表
+    返回[(ConditionExpression, target_state_id)]
+    """
+    ret = []
+    for i in condition_expression or []:
+        if not isinstance(i, dict) or 'expression' not in i or 'target_state' not in i:
+            raise ExpressionError('条件表达式格式应为[{"expression":"", "target_state":1}]')
+        try:
+            target_state = int(i['target_state'])
+        except (TypeError, ValueError):
+            raise ExpressionError('target_state应为状态id')
+        ret.append((ConditionExpression(str(i['expression'])), target_state))
+    return ret
@@ -1,5 +1,6 @@
+from django.db.models import F
 from django_filters import rest_framework as filters
-from .models import Ticket
+from .models import Ticket, TicketInvolvement
 class TicketFilterSet(filters.FilterSet):
     start_create = filters.DateFilter(field_name="create_time", lookup_expr='gte')
     end_create = filters.DateFilter(field_name="create_time", lookup_expr='lte')
@@ -14,11 +15,15 @@ class TicketFilterSet(filters.FilterSet):
         if value == 'owner': # 我的
             queryset = queryset.filter(create_by=user)
         elif value == 'duty': # 待办
-            queryset = queryset.filter(participant__contains=user.id).exclude(act_state__in=[Ticket.TICKET_ACT_STATE_FINISH, Ticket.TICKET_ACT_STATE_CLOSED])
+            queryset = queryset.filter(ticketparticipant_ticket__user=user).exclude(act_state__in=[Ticket.TICKET_ACT_STATE_FINISH, Ticket.TICKET_ACT_STATE_CLOSED])
         elif value == 'worked': # 处理过的
-            queryset = queryset.filter(ticketflow_ticket__participant=user).exclude(create_by=user).order_by('-update_time').distinct()
+            queryset = queryset.filter(ticketinvolvement_ticket__user=user, ticketinvolvement_ticket__role=TicketInvolvement.ROLE_HANDLED)\
+                .exclude(create_by=user).annotate(involvement_touched=F('ticketinvolvement_ticket__last_touched'))\
+                .order_by('-involvement_touched', '-id')
         elif value == 'cc': # 抄送我的
-            queryset = queryset.filter(ticketflow_ticket__participant_cc__contains=user.id).exclude(create_by=user).order_by('-update_time').distinct()
+            queryset = queryset.filter(ticketinvolvement_ticket__user=user, ticketinvolvement_ticket__role=TicketInvolvement.ROLE_CC)\
+                .exclude(create_by=user).annotate(involvement_touched=F('ticketinvolvement_ticket__last_touched'))\
+                .order_by('-involvement_touched', '-id')
         elif value == 'all':
             pass
         else:
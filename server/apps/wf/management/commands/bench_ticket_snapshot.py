@@ -0,0 +1,54 @@
+"""
+对比工单流转记录快照的两种生成方式
+原方式: TicketSimpleSerializer序列化后再查询自定义字段合并
+现方式: build_ticket_snapshot直接取字段值,自定义字段取自工作流定义
+测试数据在事务中创建,结束后回滚
+"""
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from apps.wf.definition import bump_workflow_version, get_workflow_definition
+from apps.wf.models import CustomField, State, Ticket, Workflow
+from apps.wf.serializers import TicketSimpleSerializer
+from apps.wf.snapshot import build_ticket_snapshot
+
+
+def legacy_snapshot(ticket):
+    field_info_dict = TicketSimpleSerializer(instance=ticket).data
+    for i in CustomField.objects.filter(is_deleted=False, workflow=ticket.workflow).order_by('sort'):
+        field_info_dict[i.field_key] = ticket.ticket_data.get(i.field_key, None)
+    return field_info_dict
+
+
+class Command(BaseCommand):
+    help = '工单快照生成性能对比'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fields', type=int, default=50, help='自定义字段数量')
+        parser.add_argument('--rounds', type=int, default=1000, help='执行次数')
+
+    def handle(self, *args, **options):
+        fields, rounds = options['fields'], options['rounds']
+        with transaction.atomic():
+            workflow = Workflow.objects.create(name='bench', sn_prefix='bench')
+            state = State.objects.create(workflow=workflow, name='开始', type=State.STATE_TYPE_START)
+            CustomField.objects.bulk_create([
+                CustomField(workflow=workflow, field_type='string', field_key='field_{}'.format(i),
+                            field_name='字段{}'.format(i), sort=i) for i in range(fields)])
+            ticket = Ticket.objects.create(workflow=workflow, state=state, sn='bench', title='bench',
+                ticket_data={'field_{}'.format(i): 'value_{}'.format(i) for i in range(fields)})
+            get_workflow_definition(workflow.id)
+            if dict(legacy_snapshot(ticket)) != build_ticket_snapshot(ticket):
+                self.stdout.write(self.style.ERROR('两种方式结果不一致'))
+            for name, func in [('serializer', legacy_snapshot), ('snapshot', build_ticket_snapshot)]:
+                with CaptureQueriesContext(connection) as queries:
+                    func(ticket)
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    func(ticket)
+                cost = time.perf_counter() - start
+                self.stdout.write('{:<12}{:>10.1f} us/次 {:>4} 次查询/次'.format(
+                    name, cost / rounds * 1000000, len(queries.captured_queries)))
+            transaction.set_rollback(True)
+        bump_workflow_version(workflow.id)
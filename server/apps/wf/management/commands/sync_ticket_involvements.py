@@ -0,0 +1,45 @@
+"""
+根据流转记录回填工单参与记录(处理过/抄送/创建)
+按工单分批重建, 最近流转时间取工单的更新时间, 可重复执行
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from apps.system.models import User
+from apps.wf.models import Ticket, TicketFlow, TicketInvolvement
+
+
+class Command(BaseCommand):
+    help = '回填工单参与记录,用于处理过的/抄送我的查询'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500, help='每批处理的工单数量')
+
+    def handle(self, *args, **options):
+        batch = options['batch']
+        user_ids = set(User._base_manager.values_list('id', flat=True))
+        last_id, total, created = 0, 0, 0
+        while True:
+            tickets = list(Ticket.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', 'create_by_id', 'update_time')[:batch])
+            if not tickets:
+                break
+            rows = {}
+            for ticket_id, create_by_id, _ in tickets:
+                rows[ticket_id] = {(create_by_id, TicketInvolvement.ROLE_CREATED)} if create_by_id else set()
+            flows = TicketFlow.objects.filter(ticket_id__in=rows).values_list('ticket_id', 'participant_id', 'participant_cc')
+            for ticket_id, participant_id, participant_cc in flows:
+                if participant_id:
+                    rows[ticket_id].add((participant_id, TicketInvolvement.ROLE_HANDLED))
+                for i in participant_cc or []:
+                    if isinstance(i, int) and not isinstance(i, bool) or isinstance(i, str) and i.isdigit():
+                        rows[ticket_id].add((int(i), TicketInvolvement.ROLE_CC))
+            objs = [TicketInvolvement(ticket_id=ticket_id, user_id=user_id, role=role, last_touched=update_time)
+                for ticket_id, _, update_time in tickets for user_id, role in rows[ticket_id] if user_id in user_ids]
+            with transaction.atomic():
+                TicketInvolvement.objects.filter(ticket_id__in=rows).delete()
+                TicketInvolvement.objects.bulk_create(objs)
+            total += len(tickets)
+            created += len(objs)
+            last_id = tickets[-1][0]
+            self.stdout.write('已处理{}个工单'.format(total))
+        self.stdout.write(self.style.SUCCESS('完成: 共{}条参与记录'.format(created)))
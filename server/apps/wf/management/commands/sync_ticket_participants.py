@@ -0,0 +1,32 @@
+"""
+根据工单当前处理人回填工单处理人表
+可重复执行,已同步的工单不会产生变更, 已删除的工单会清除其处理人
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from apps.wf.models import Ticket
+from apps.wf.services import WfService
+
+
+class Command(BaseCommand):
+    help = '回填工单处理人表,用于待办查询'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500, help='每批处理的工单数量')
+
+    def handle(self, *args, **options):
+        batch = options['batch']
+        last_id, total, added, removed = 0, 0, 0, 0
+        while True:
+            tickets = list(Ticket._base_manager.filter(id__gt=last_id).order_by('id')[:batch])
+            if not tickets:
+                break
+            with transaction.atomic():
+                for ticket in tickets:
+                    a, r = WfService.sync_ticket_participants(ticket)
+                    added += len(a)
+                    removed += len(r)
+            total += len(tickets)
+            last_id = tickets[-1].id
+            self.stdout.write('已处理{}个工单'.format(total))
+        self.stdout.write(self.style.SUCCESS('完成: 新增{}条, 移除{}条'.format(added, removed)))
@@ -0,0 +1,31 @@
+"""
+为未结束的工单回填当前状态的定时器(定时流转上线前已在处理中的工单)
+已有的定时器保持不变, 缺少的从执行时开始计时, 可重复执行
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from apps.wf.models import Ticket
+from apps.wf.services import WfService
+
+
+class Command(BaseCommand):
+    help = '回填工单定时器,用于定时流转'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500, help='每批处理的工单数量')
+
+    def handle(self, *args, **options):
+        batch = options['batch']
+        last_id, total, created = 0, 0, 0
+        queryset = Ticket.objects.exclude(act_state__in=[Ticket.TICKET_ACT_STATE_FINISH, Ticket.TICKET_ACT_STATE_CLOSED])
+        while True:
+            tickets = list(queryset.filter(id__gt=last_id).order_by('id')[:batch])
+            if not tickets:
+                break
+            with transaction.atomic():
+                for ticket in tickets:
+                    created += WfService.sync_ticket_timers(ticket, reset=False)
+            total += len(tickets)
+            last_id = tickets[-1].id
+            self.stdout.write('已处理{}个工单'.format(total))
+        self.stdout.write(self.style.SUCCESS('完成: 新增{}个定时器'.format(created)))
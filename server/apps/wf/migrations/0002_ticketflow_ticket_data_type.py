@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+def mark_ticket_data_type(apps, schema_editor):
+    """
+    已有记录均为全量快照
+    """
+    TicketFlow = apps.get_model('wf', 'TicketFlow')
+    TicketFlow.objects.exclude(ticket_data={}).update(ticket_data_type=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wf', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticketflow',
+            name='ticket_data_type',
+            field=models.IntegerField(choices=[(0, '无'), (1, '全量'), (2, '增量')], default=0, help_text='0.无 1.全量快照 2.相对上一条记录的增量(定期写入全量快照)', verbose_name='工单数据类型'),
+        ),
+        migrations.RunPython(mark_ticket_data_type, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wf', '0002_ticketflow_ticket_data_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketSnCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, help_text='创建时间', verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, help_text='修改时间', verbose_name='修改时间')),
+                ('is_deleted', models.BooleanField(default=False, help_text='删除标记', verbose_name='删除标记')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('next_value', models.PositiveIntegerField(default=1, verbose_name='下一个序号')),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wf.workflow', verbose_name='关联工作流')),
+            ],
+            options={
+                'verbose_name': '工单流水号计数',
+                'verbose_name_plural': '工单流水号计数',
+                'unique_together': {('workflow', 'date')},
+            },
+        ),
+    ]
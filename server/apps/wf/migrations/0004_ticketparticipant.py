@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wf', '0003_ticketsncounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketParticipant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.IntegerField(choices=[(1, '处理'), (2, '待接单'), (3, '加签')], default=1, verbose_name='类型')),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticketparticipant_ticket', to='wf.ticket', verbose_name='关联工单')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticketparticipant_user', to=settings.AUTH_USER_MODEL, verbose_name='处理人')),
+            ],
+            options={
+                'verbose_name': '工单处理人',
+                'verbose_name_plural': '工单处理人',
+                'unique_together': {('ticket', 'user')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wf', '0004_ticketparticipant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketInvolvement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.IntegerField(choices=[(1, '处理过'), (2, '抄送'), (3, '创建')], default=1, verbose_name='关系')),
+                ('last_touched', models.DateTimeField(default=django.utils.timezone.now, verbose_name='最近流转时间')),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticketinvolvement_ticket', to='wf.ticket', verbose_name='关联工单')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticketinvolvement_user', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '工单参与记录',
+                'verbose_name_plural': '工单参与记录',
+                'indexes': [models.Index(fields=['user', 'role', '-last_touched'], name='wf_involvement_user_role_idx')],
+                'unique_together': {('user', 'ticket', 'role')},
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wf', '0005_ticketinvolvement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketScriptTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, help_text='创建时间', verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, help_text='修改时间', verbose_name='修改时间')),
+                ('is_deleted', models.BooleanField(default=False, help_text='删除标记', verbose_name='删除标记')),
+                ('key', models.CharField(max_length=64, unique=True, verbose_name='幂等键')),
+                ('script', models.CharField(max_length=200, verbose_name='脚本')),
+                ('status', models.IntegerField(choices=[(0, '待执行'), (1, '执行中'), (2, '成功'), (3, '失败'), (4, '跳过')], default=0, verbose_name='状态')),
+                ('retries', models.PositiveIntegerField(default=0, verbose_name='已重试次数')),
+                ('next_run_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='下次执行时间')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='最后一次错误')),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wf.state', verbose_name='脚本状态')),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticketscripttask_ticket', to='wf.ticket', verbose_name='关联工单')),
+            ],
+            options={
+                'verbose_name': '工单脚本任务',
+                'verbose_name_plural': '工单脚本任务',
+                'indexes': [models.Index(fields=['status', 'next_run_at'], name='wf_scripttask_status_idx')],
+            },
+        ),
+    ]
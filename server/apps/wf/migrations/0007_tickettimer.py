@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wf', '0006_ticketscripttask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketTimer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('due_at', models.DateTimeField(db_index=True, verbose_name='到期时间')),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wf.state', verbose_name='源状态')),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tickettimer_ticket', to='wf.ticket', verbose_name='关联工单')),
+                ('transition', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wf.transition', verbose_name='定时流转')),
+            ],
+            options={
+                'verbose_name': '工单定时器',
+                'verbose_name_plural': '工单定时器',
+                'unique_together': {('ticket', 'transition')},
+            },
+        ),
+    ]
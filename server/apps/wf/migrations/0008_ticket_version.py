@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wf', '0007_tickettimer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='每次流转加1, 用于并发处理时的冲突检测', verbose_name='版本号'),
+        ),
+    ]
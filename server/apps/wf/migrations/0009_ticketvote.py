@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def forwards(apps, schema_editor):
+    """
+    会签中的工单: 已处理的结果转为投票记录
+    """
+    Ticket = apps.get_model('wf', 'Ticket')
+    TicketVote = apps.get_model('wf', 'TicketVote')
+    Transition = apps.get_model('wf', 'Transition')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    transition_ids = set(Transition.objects.values_list('id', flat=True))
+    user_ids = set(User.objects.values_list('id', flat=True))
+    votes = []
+    for ticket in Ticket.objects.exclude(multi_all_person={}).only('id', 'state_id', 'multi_all_person').iterator():
+        for key, value in (ticket.multi_all_person or {}).items():
+            if not value or not str(key).isdigit():
+                continue
+            if int(key) in user_ids and value.get('transition') in transition_ids:
+                votes.append(TicketVote(ticket_id=ticket.id, state_id=ticket.state_id, user_id=int(key),
+                    transition_id=value['transition']))
+    TicketVote.objects.bulk_create(votes, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('wf', '0008_ticket_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketVote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create_time', models.DateTimeField(default=django.utils.timezone.now, verbose_name='处理时间')),
+                ('state', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wf.state', verbose_name='会签状态')),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticketvote_ticket', to='wf.ticket', verbose_name='关联工单')),
+                ('transition', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wf.transition', verbose_name='处理操作')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='处理人')),
+            ],
+            options={
+                'verbose_name': '工单会签记录',
+                'verbose_name_plural': '工单会签记录',
+                'unique_together': {('ticket', 'state', 'user')},
+            },
+        ),
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wf', '0009_ticketvote'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['create_time', 'id'], name='wf_ticket_create_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticketflow',
+            index=models.Index(fields=['create_time', 'id'], name='wf_ticketflow_create_idx'),
+        ),
+    ]
@@ -4,7 +4,7 @@ from django.db.models.base import Model
 import django.utils.timezone as timezone
 from django.db.models.query import QuerySet
 from apps.system.models import CommonAModel, CommonBModel, Organization, User, Dict, File
-from utils.model import SoftModel, BaseModel
+from utils.model import SoftModel, BaseModel, TreeManager
 from simple_history.models import HistoricalRecords
 
 
@@ -217,12 +217,155 @@ class Ticket(CommonBModel):
     participant = models.JSONField('当前处理人', default=list, blank=True, help_text='可以为空(无处理人的情况，如结束状态)、userid、userid列表')
     act_state = models.IntegerField('进行状态', default=1, help_text='当前工单的进行状态', choices=act_state_choices)
     multi_all_person = models.JSONField('全部处理的结果', default=dict, blank=True, help_text='需要当前状态处理人全部处理时实际的处理结果，json格式')
+    version = models.PositiveIntegerField('版本号', default=0, help_text='每次流转加1, 用于并发处理时的冲突检测')
+
+    objects = TreeManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['create_time', 'id'], name='wf_ticket_create_idx'),
+        ]
+
+
+class TicketParticipant(models.Model):
+    """
+    工单当前处理人, 由工作流引擎随工单同步维护, 用于待办查询
+    """
+    KIND_HANDLE = 1 # 处理
+    KIND_ACCEPT = 2 # 多人待接单
+    KIND_ADD_NODE = 3 # 加签
+    kind_choices = (
+        (KIND_HANDLE, '处理'),
+        (KIND_ACCEPT, '待接单'),
+        (KIND_ADD_NODE, '加签')
+    )
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, verbose_name='关联工单', related_name='ticketparticipant_ticket')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='处理人', related_name='ticketparticipant_user')
+    kind = models.IntegerField('类型', default=KIND_HANDLE, choices=kind_choices)
+
+    class Meta:
+        verbose_name = '工单处理人'
+        verbose_name_plural = verbose_name
+        unique_together = ('ticket', 'user')
+
+
+class TicketInvolvement(models.Model):
+    """
+    用户与工单的关系, 新增流转记录时维护, 用于处理过的/抄送我的查询
+    last_touched为工单最近一次流转的时间
+    """
+    ROLE_HANDLED = 1 # 处理过
+    ROLE_CC = 2 # 抄送
+    ROLE_CREATED = 3 # 创建
+    role_choices = (
+        (ROLE_HANDLED, '处理过'),
+        (ROLE_CC, '抄送'),
+        (ROLE_CREATED, '创建')
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='用户', related_name='ticketinvolvement_user')
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, verbose_name='关联工单', related_name='ticketinvolvement_ticket')
+    role = models.IntegerField('关系', default=ROLE_HANDLED, choices=role_choices)
+    last_touched = models.DateTimeField('最近流转时间', default=timezone.now)
+
+    class Meta:
+        verbose_name = '工单参与记录'
+        verbose_name_plural = verbose_name
+        unique_together = ('user', 'ticket', 'role')
+        indexes = [
+            models.Index(fields=['user', 'role', '-last_touched'], name='wf_involvement_user_role_idx'),
+        ]
+
+
+class TicketSnCounter(BaseModel):
+    """
+    工单流水号计数器, 按工作流每日一行
+    """
+    workflow = models.ForeignKey(Workflow, on_delete=models.CASCADE, verbose_name='关联工作流')
+    date = models.DateField('日期')
+    next_value = models.PositiveIntegerField('下一个序号', default=1)
+
+    class Meta:
+        verbose_name = '工单流水号计数'
+        verbose_name_plural = verbose_name
+        unique_together = ('workflow', 'date')
+
+
+class TicketScriptTask(BaseModel):
+    """
+    脚本状态待执行任务(事务性发件箱), 与工单在同一事务中写入, 提交后投递到celery执行
+    """
+    TASK_STATUS_PENDING = 0 # 待执行
+    TASK_STATUS_RUNNING = 1 # 执行中
+    TASK_STATUS_SUCCESS = 2 # 成功
+    TASK_STATUS_FAILED = 3 # 失败(超过重试次数或执行超时)
+    TASK_STATUS_SKIPPED = 4 # 工单已离开该状态
+    status_choices = (
+        (TASK_STATUS_PENDING, '待执行'),
+        (TASK_STATUS_RUNNING, '执行中'),
+        (TASK_STATUS_SUCCESS, '成功'),
+        (TASK_STATUS_FAILED, '失败'),
+        (TASK_STATUS_SKIPPED, '跳过')
+    )
+    key = models.CharField('幂等键', max_length=64, unique=True)
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, verbose_name='关联工单', related_name='ticketscripttask_ticket')
+    state = models.ForeignKey(State, on_delete=models.CASCADE, verbose_name='脚本状态')
+    script = models.CharField('脚本', max_length=200)
+    status = models.IntegerField('状态', default=TASK_STATUS_PENDING, choices=status_choices)
+    retries = models.PositiveIntegerField('已重试次数', default=0)
+    next_run_at = models.DateTimeField('下次执行时间', default=timezone.now)
+    last_error = models.TextField('最后一次错误', default='', blank=True)
+
+    class Meta:
+        verbose_name = '工单脚本任务'
+        verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['status', 'next_run_at'], name='wf_scripttask_status_idx'),
+        ]
+
+
+class TicketVote(models.Model):
+    """
+    全部处理(会签)状态下每个处理人的处理结果, 每人一行
+    """
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, verbose_name='关联工单', related_name='ticketvote_ticket')
+    state = models.ForeignKey(State, on_delete=models.CASCADE, verbose_name='会签状态')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='处理人')
+    transition = models.ForeignKey(Transition, on_delete=models.CASCADE, verbose_name='处理操作')
+    create_time = models.DateTimeField('处理时间', default=timezone.now)
+
+    class Meta:
+        verbose_name = '工单会签记录'
+        verbose_name_plural = verbose_name
+        unique_together = ('ticket', 'state', 'user')
+
+
+class TicketTimer(models.Model):
+    """
+    工单定时流转, 进入状态时按流转的定时器写入到期时间, 离开状态时删除
+    """
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, verbose_name='关联工单', related_name='tickettimer_ticket')
+    state = models.ForeignKey(State, on_delete=models.CASCADE, verbose_name='源状态')
+    transition = models.ForeignKey(Transition, on_delete=models.CASCADE, verbose_name='定时流转')
+    due_at = models.DateTimeField('到期时间', db_index=True)
+
+    class Meta:
+        verbose_name = '工单定时器'
+        verbose_name_plural = verbose_name
+        unique_together = ('ticket', 'transition')
 
 
 class TicketFlow(BaseModel):
     """
     工单流转日志
     """
+    TICKET_DATA_TYPE_NONE = 0 # 无工单数据
+    TICKET_DATA_TYPE_FULL = 1 # 全量快照
+    TICKET_DATA_TYPE_DELTA = 2 # 相对上一条记录的增量
+    ticket_data_type_choices = (
+        (TICKET_DATA_TYPE_NONE, '无'),
+        (TICKET_DATA_TYPE_FULL, '全量'),
+        (TICKET_DATA_TYPE_DELTA, '增量')
+    )
     ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, verbose_name='关联工单', related_name='ticketflow_ticket')
     transition = models.ForeignKey(Transition, verbose_name='流转id', help_text='与worklow.Transition关联， 为空时表示认为干预的操作', on_delete=models.CASCADE, null=True, blank=True)
     suggestion = models.CharField('处理意见', max_length=10000, default='', blank=True)
@@ -231,6 +374,11 @@ class TicketFlow(BaseModel):
     participant_str = models.CharField('处理人', max_length=200, null=True, blank=True, help_text='非人工处理的处理人相关信息')
     state = models.ForeignKey(State, verbose_name='当前状态', default=0, blank=True, on_delete=models.CASCADE)
     ticket_data = models.JSONField('工单数据', default=dict, blank=True, help_text='可以用于记录当前表单数据，json格式')
+    ticket_data_type = models.IntegerField('工单数据类型', default=0, choices=ticket_data_type_choices, help_text='0.无 1.全量快照 2.相对上一条记录的增量(定期写入全量快照)')
     intervene_type = models.IntegerField('干预类型', default=0, help_text='流转类型', choices=Transition.intervene_type_choices)
     participant_cc = models.JSONField('抄送给', default=list, blank=True, help_text='抄送给(userid列表)')
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['create_time', 'id'], name='wf_ticketflow_create_idx'),
+        ]
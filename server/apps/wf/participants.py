@@ -0,0 +1,87 @@
+import threading
+import time
+from apps.system.models import Organization, User
+from utils.cache import bump_version, get_version
+
+PARTICIPANT_VERSION_KEY = 'wf__participant__version'
+PARTICIPANT_INDEX_TIMEOUT = 60*10 # 兜底绕过信号的批量更新
+
+
+def _to_ids(values):
+    values = values if isinstance(values, (list, tuple, set)) else [values]
+    return [int(i) for i in values if isinstance(i, int) or isinstance(i, str) and i.isdigit()]
+
+
+def bump_participant_version():
+    """
+    用户角色或部门变更时更新版本号
+    """
+    return bump_version(PARTICIPANT_VERSION_KEY)
+
+
+class ParticipantIndex(object):
+    """
+    处理人解析用的用户快照
+    role_users: 角色id -> 用户id集合
+    dept_users: 部门id -> 用户id集合
+    user_dept: 用户id -> 部门id
+    """
+
+    def __init__(self, users, user_roles, version=None):
+        self.version = version
+        self.expire = time.monotonic() + PARTICIPANT_INDEX_TIMEOUT
+        self.user_dept, self.dept_users, self.role_users = {}, {}, {}
+        for user_id, dept_id in users:
+            self.user_dept[user_id] = dept_id
+            self.dept_users.setdefault(dept_id, set()).add(user_id)
+        for user_id, role_id in user_roles:
+            if user_id in self.user_dept:
+                self.role_users.setdefault(role_id, set()).add(user_id)
+
+    def get_dept_users(self, dept_ids):
+        ret = set()
+        for i in _to_ids(dept_ids):
+            ret.update(self.dept_users.get(i, ()))
+        return ret
+
+    def get_role_users(self, role_ids, dept_ids=None):
+        """
+        角色下的用户, dept_ids不为None时只保留这些部门的用户
+        """
+        ret = set()
+        for i in _to_ids(role_ids):
+            ret.update(self.role_users.get(i, ()))
+        if dept_ids is not None:
+            ret = {i for i in ret if self.user_dept[i] in dept_ids}
+        return ret
+
+
+_participant_index = None
+_participant_index_lock = threading.Lock()
+
+
+def get_participant_index():
+    """
+    获取进程内用户快照,版本号变化或超时时重建
+    """
+    global _participant_index
+    version = get_version(PARTICIPANT_VERSION_KEY)
+    index = _participant_index
+    if index is not None and index.version == version and index.expire > time.monotonic():
+        return index
+    with _participant_index_lock:
+        index = _participant_index
+        if index is None or index.version != version or index.expire <= time.monotonic():
+            users = User.objects.values_list('id', 'dept_id')
+            user_roles = User.roles.through.objects.values_list('user_id', 'role_id')
+            _participant_index = ParticipantIndex(users, user_roles, version)
+        return _participant_index
+
+
+def get_dept_ancestor_ids(dept_id):
+    """
+    部门自身及所有上级id, 读取组织树快照
+    """
+    if dept_id is None:
+        return set()
+    return set(Organization.objects.ancestor_ids(dept_id))
@@ -34,11 +34,12 @@ class HandleScripts:
         # 获取信息      
         transition_obj = Transition.objects.filter(source_state=ticket.state, is_deleted=False).first()
 
-        TicketFlow.objects.create(ticket=ticket, state=ticket.state,
+        flow = TicketFlow.objects.create(ticket=ticket, state=ticket.state,
                             participant_type=State.PARTICIPANT_TYPE_ROBOT,
                             participant_str='func:{}'.format(script_str),
                             transition=transition_obj)
         from .services import WfService
+        WfService.record_ticket_involvement(ticket, [flow])
 
         # 自动执行流转
         WfService.handle_ticket(ticket=ticket, transition=transition_obj, new_ticket_data=ticket.ticket_data, by_task=True)
@@ -3,7 +3,10 @@ from apps.system.serializers import UserSimpleSerializer
 import rest_framework
 from rest_framework import serializers
 
+from django.db import models
+from .expression import ExpressionError, compile_conditions
 from .models import State, Ticket, TicketFlow, Workflow, Transition, CustomField
+from .snapshot import get_flow_snapshot, materialize_flows
 
 
 class WorkflowSerializer(serializers.ModelSerializer):
@@ -32,6 +35,24 @@ class TransitionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Transition
         fields = '__all__'
+
+    def validate_condition_expression(self, value):
+        """
+        保存时即编译校验条件表达式
+        """
+        try:
+            compile_conditions(value)
+        except ExpressionError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+    def validate(self, attrs):
+        workflow = attrs.get('workflow', getattr(self.instance, 'workflow', None))
+        conditions = attrs.get('condition_expression', None) or []
+        targets = {int(i['target_state']) for i in conditions}
+        if targets and State.objects.filter(workflow=workflow, id__in=targets).count() != len(targets):
+            raise serializers.ValidationError({'condition_expression': '目标状态不属于该工作流'})
+        return attrs
     @staticmethod
     def setup_eager_loading(queryset):
         """ Perform necessary eager loading of data. """
@@ -156,12 +177,42 @@ class TicketDetailSerializer(serializers.ModelSerializer):
         if item['id'] == field_value:
             return 
 
+def is_flow_delta_request(context):
+    """
+    请求参数delta=true时直接返回增量,否则返回还原后的快照
+    """
+    request = context.get('request', None)
+    return request is not None and request.query_params.get('delta', None) in ('1', 'true')
+
+
+class TicketFlowListSerializer(serializers.ListSerializer):
+    """
+    批量还原增量快照,避免逐条查询
+    """
+    def to_representation(self, data):
+        flows = list(data.all() if isinstance(data, models.Manager) else data)
+        if not is_flow_delta_request(self.context):
+            self.context['flow_snapshots'] = materialize_flows(flows)
+        return super().to_representation(flows)
+
+
 class TicketFlowSerializer(serializers.ModelSerializer):
     participant_ = UserSimpleSerializer(source='participant', read_only=True)
     state_ = StateSimpleSerializer(source='state', read_only=True)
     class Meta:
         model = TicketFlow
         fields = '__all__'
+        list_serializer_class = TicketFlowListSerializer
+
+    def to_representation(self, instance):
+        ret = super().to_representation(instance)
+        if instance.ticket_data_type == TicketFlow.TICKET_DATA_TYPE_DELTA and not is_flow_delta_request(self.context):
+            snapshots = self.context.get('flow_snapshots', {})
+            if instance.id in snapshots:
+                ret['ticket_data'] = snapshots[instance.id]
+            else:
+                ret['ticket_data'] = get_flow_snapshot(instance.ticket_id, instance.id)[0]
+        return ret
 
 class TicketFlowSimpleSerializer(serializers.ModelSerializer):
     participant_ = UserSimpleSerializer(source='participant', read_only=True)
@@ -175,6 +226,23 @@ class TicketHandleSerializer(serializers.Serializer):
     transition = serializers.PrimaryKeyRelatedField(queryset=Transition.objects.all(), label="流转id")
     ticket_data = serializers.JSONField(label="表单数据json")
     suggestion = serializers.CharField(label="处理意见", required = False, allow_blank=True)
+    version = serializers.IntegerField(label="工单版本号", required=False, help_text='传入时校验工单未被他人修改')
+
+class TicketHandleBatchItemSerializer(serializers.Serializer):
+    ticket = serializers.IntegerField(label="工单id")
+    transition = serializers.IntegerField(label="流转id")
+    ticket_data = serializers.JSONField(label="表单数据json", required=False, default=dict)
+    suggestion = serializers.CharField(label="处理意见", required=False, allow_blank=True, default='')
+    version = serializers.IntegerField(label="工单版本号", required=False, help_text='传入时校验工单未被他人修改')
+
+class TicketHandleBatchSerializer(serializers.Serializer):
+    items = TicketHandleBatchItemSerializer(label="处理列表", many=True, allow_empty=False)
+    all_or_none = serializers.BooleanField(label="全部成功或全部回滚", required=False, default=False)
+
+    def validate_items(self, value):
+        if len(value) > 100:
+            raise serializers.ValidationError('单次最多处理100个工单')
+        return value
 
 class TicketRetreatSerializer(serializers.Serializer):
     suggestion = serializers.CharField(label="撤回原因", required = False)
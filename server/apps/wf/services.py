@@ -1,14 +1,37 @@
 from apps.wf.serializers import CustomFieldSerializer
-from apps.wf.serializers import TicketSerializer, TicketSimpleSerializer
+from apps.wf.serializers import TicketSerializer
 from typing import Tuple
 from apps.system.models import User
-from apps.wf.models import CustomField, State, Ticket, TicketFlow, Transition, Workflow
-from rest_framework.exceptions import APIException, PermissionDenied
+from apps.wf.models import State, Ticket, TicketFlow, TicketInvolvement, TicketParticipant, TicketScriptTask, TicketSnCounter, TicketTimer, TicketVote, Transition, Workflow
+from rest_framework.exceptions import APIException, ParseError, PermissionDenied, ValidationError
+from django.db import IntegrityError, connection, transaction
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta
+import logging
 import random
+import traceback
+from .definition import get_workflow_definition
+from .expression import ExpressionError
+from .participants import get_dept_ancestor_ids, get_participant_index
+from .snapshot import build_ticket_snapshot, get_flow_snapshot, make_flow_data
 from .scripts import GetParticipants, HandleScripts
-from utils.queryset import get_parent_queryset
+from .tasks import dispatch_script_task
+from .todo import get_todo_changes, update_todo_counts
+
+logger = logging.getLogger('log')
+
+SCRIPT_TASK_MAX_RETRIES = 3 # 脚本失败最多重试次数
+SCRIPT_TASK_RETRY_DELAY = 60 # 首次重试间隔(秒), 之后翻倍
+SCRIPT_TASK_TIMEOUT = 60*30 # 执行中超过该时间视为worker异常, 标记为失败
+TIMER_RETRY_DELAY = 60*5 # 定时流转执行失败后的重试间隔(秒)
+
+class TicketConflict(APIException):
+    """
+    工单已被其他请求修改, 客户端刷新后可重试
+    """
+    status_code = 409
+    default_detail = '工单已被其他人处理, 请刷新后重试'
+    default_code = 'conflict'
 
 class WfService(object):
     @staticmethod
@@ -16,71 +39,77 @@ class WfService(object):
         """
         获取工作流状态列表
         """
-        return State.objects.filter(workflow=workflow, is_deleted=False).order_by('sort')
+        return list(get_workflow_definition(workflow).state_list)
     
     @staticmethod
     def get_workflow_transitions(workflow:Workflow):
         """
         获取工作流流转列表
         """
-        return Transition.objects.filter(workflow=workflow, is_deleted=False)
+        return list(get_workflow_definition(workflow).transition_list)
     
     @staticmethod
     def get_workflow_start_state(workflow:Workflow):
         """
         获取工作流初始状态
         """
-        try:
-            wf_state_obj = State.objects.get(workflow=workflow, type=State.STATE_TYPE_START, is_deleted=False)
-            return wf_state_obj
-        except:
+        wf_state_obj = get_workflow_definition(workflow).start_state
+        if wf_state_obj is None:
             raise Exception('工作流状态配置错误')
+        return wf_state_obj
 
     @staticmethod
     def get_workflow_end_state(workflow:Workflow):
         """
         获取工作流结束状态
         """
-        try:
-            wf_state_obj = State.objects.get(workflow=workflow, type=State.STATE_TYPE_END, is_deleted=False)
-            return wf_state_obj
-        except:
+        wf_state_obj = get_workflow_definition(workflow).end_state
+        if wf_state_obj is None:
             raise Exception('工作流状态配置错误')
+        return wf_state_obj
 
     @staticmethod
     def get_workflow_custom_fields(workflow:Workflow):
         """
         获取工单字段
         """
-        return CustomField.objects.filter(is_deleted=False, workflow=workflow).order_by('sort')
+        return list(get_workflow_definition(workflow).custom_fields)
 
     @staticmethod
     def get_workflow_custom_fields_list(workflow:Workflow):
         """
         获取工单字段key List
         """
-        return list(CustomField.objects.filter(is_deleted=False, workflow=workflow).order_by('sort').values_list('field_key', flat=True))
+        return list(get_workflow_definition(workflow).field_keys)
 
     @classmethod
     def get_ticket_transitions(cls, ticket:Ticket):
         """
         获取工单当前状态下可用的流转条件
         """
-        return cls.get_state_transitions(ticket.state)
+        return list(get_workflow_definition(ticket.workflow_id).get_state_transitions(ticket.state_id))
 
     @classmethod    
     def get_state_transitions(cls, state:State):
         """
         获取状态可执行的操作
         """
-        return Transition.objects.filter(is_deleted=False, source_state=state).all()
+        return list(get_workflow_definition(state.workflow_id).get_state_transitions(state.id))
+
+    @classmethod
+    def get_ticket_state(cls, ticket:Ticket)->State:
+        """
+        获取工单当前状态,优先取工作流定义中的状态
+        """
+        state = get_workflow_definition(ticket.workflow_id).states.get(ticket.state_id, None)
+        return state if state is not None else ticket.state
 
     @classmethod
     def get_ticket_steps(cls, ticket:Ticket):
-        steps = cls.get_worlflow_states(ticket.workflow)
+        steps = cls.get_worlflow_states(ticket.workflow_id)
         nsteps_list = []
         for i in steps:
-            if ticket.state == i or (not i.is_hidden):
+            if ticket.state_id == i.id or (not i.is_hidden):
                 nsteps_list.append(i)
         return nsteps_list
 
@@ -89,7 +118,7 @@ class WfService(object):
         """
         获取工单可执行的操作
         """
-        return cls.get_state_transitions(ticket.state)
+        return list(get_workflow_definition(ticket.workflow_id).get_state_transitions(ticket.state_id))
 
     @classmethod
     def get_transition_by_args(cls, kwargs:dict):
@@ -104,33 +133,51 @@ class WfService(object):
         """
         生成工单流水号
         """
-        now = timezone.now()
-        today = str(now)[:10]+' 00:00:00'
-        next_day = str(now+timedelta(days=1))[:10]+' 00:00:00'
-        ticket_day_count_new = Ticket.objects.filter(create_time__gte=today, create_time__lte=next_day, workflow=workflow).count()+1
-        return '%s_%04d%02d%02d%04d' % (workflow.sn_prefix, now.year, now.month, now.day, ticket_day_count_new)
+        return cls.reserve_ticket_sn(workflow)[0]
+
+    @classmethod
+    def reserve_ticket_sn(cls, workflow:Workflow, count:int=1)->list:
+        """
+        预留工单流水号, 按工作流每日计数器行锁分配, 可一次预留多个用于批量导入
+        """
+        today = timezone.localdate()
+        with transaction.atomic():
+            counter = TicketSnCounter.objects.select_for_update().filter(workflow=workflow, date=today).first()
+            if counter is None:
+                # 当天首次分配, 接续当天已生成流水号的工单数
+                start = timezone.make_aware(datetime.combine(today, datetime.min.time()))
+                seed = Ticket.objects.filter(workflow=workflow, create_time__gte=start,
+                    create_time__lt=start+timedelta(days=1)).exclude(sn='').count()+1
+                try:
+                    with transaction.atomic():
+                        counter = TicketSnCounter.objects.create(workflow=workflow, date=today, next_value=seed)
+                except IntegrityError:
+                    counter = TicketSnCounter.objects.select_for_update().get(workflow=workflow, date=today)
+            first = counter.next_value
+            counter.next_value = first + count
+            counter.save(update_fields=['next_value', 'update_time'])
+        return ['%s_%04d%02d%02d%04d' % (workflow.sn_prefix, today.year, today.month, today.day, i)
+            for i in range(first, first + count)]
 
 
-        
     @classmethod
     def get_next_state_by_transition_and_ticket_info(cls, ticket:Ticket, transition: Transition, new_ticket_data:dict={})->object:
         """
         获取下个节点状态
         """
-        source_state = ticket.state
+        definition = get_workflow_definition(ticket.workflow_id)
         destination_state = transition.destination_state
-        ticket_all_value = cls.get_ticket_all_field_value(ticket)
-        ticket_all_value.update(**new_ticket_data)
-        for key, value in ticket_all_value.items():
-                if isinstance(ticket_all_value[key], str):
-                    ticket_all_value[key] = "'" + ticket_all_value[key] + "'"
-        if transition.condition_expression:
-            for i in transition.condition_expression:
-                expression = i['expression'].format(**ticket_all_value)
-                import datetime, time  # 用于支持条件表达式中对时间的操作
-                if eval(expression, {'__builtins__':None}, {'datetime':datetime, 'time':time}):
-                    destination_state = State.objects.get(pk=i['target_state'])
-                    return destination_state
+        try:
+            conditions = definition.get_conditions(transition)
+        except ExpressionError as e:
+            raise APIException('流转条件表达式配置错误:{}'.format(e))
+        if conditions:
+            ticket_all_value = cls.get_ticket_all_field_value(ticket)
+            ticket_all_value.update(**new_ticket_data)
+            for expression, target_state in conditions:
+                if expression.evaluate(ticket_all_value):
+                    destination_state = definition.states.get(target_state, None)
+                    return destination_state or State.objects.get(pk=target_state)
         return destination_state
     
     @classmethod
@@ -143,7 +190,7 @@ class WfService(object):
             回到初始状态
             """
             return dict(destination_participant_type=State.PARTICIPANT_TYPE_PERSONAL,
-                                destination_participant=ticket.create_by.id,
+                                destination_participant=ticket.create_by_id,
                                 multi_all_person={})
         elif state.type == State.STATE_TYPE_END:
             """
@@ -156,28 +203,26 @@ class WfService(object):
         destination_participant_type, destination_participant = state.participant_type, state.participant
         if destination_participant_type == State.PARTICIPANT_TYPE_FIELD:
             destination_participant = new_ticket_data.get(destination_participant, 0) if destination_participant in new_ticket_data \
-                else Ticket.ticket_data.get(destination_participant, 0)
+                else ticket.ticket_data.get(destination_participant, 0)
 
         elif destination_participant_type == State.PARTICIPANT_TYPE_FORMCODE:#代码获取
             destination_participant = getattr(GetParticipants, destination_participant)(
                 state=state, ticket=ticket, new_ticket_data=new_ticket_data, handler=handler)
 
         elif destination_participant_type == State.PARTICIPANT_TYPE_DEPT:#部门
-            destination_participant = list(User.objects.filter(dept__in=destination_participant).values_list('id', flat=True))
+            destination_participant = list(get_participant_index().get_dept_users(destination_participant))
 
         elif destination_participant_type == State.PARTICIPANT_TYPE_ROLE:#角色
-            user_queryset = User.objects.filter(roles__in=destination_participant)
+            index = get_participant_index()
             # 如果选择了角色, 需要走过滤策略
+            depts = None
             if state.filter_policy == 1:
-                depts = get_parent_queryset(ticket.belong_dept)
-                user_queryset = user_queryset.filter(dept__in=depts)
+                depts = get_dept_ancestor_ids(ticket.belong_dept_id)
             elif state.filter_policy == 2:
-                depts = get_parent_queryset(ticket.create_by.dept)
-                user_queryset = user_queryset.filter(dept__in=depts)
+                depts = get_dept_ancestor_ids(index.user_dept.get(ticket.create_by_id, None))
             elif state.filter_policy == 3:
-                depts = get_parent_queryset(handler.dept)
-                user_queryset = user_queryset.filter(dept__in=depts)
-            destination_participant = list(user_queryset.values_list('id', flat=True))
+                depts = get_dept_ancestor_ids(handler.dept_id)
+            destination_participant = list(index.get_role_users(destination_participant, depts))
         if type(destination_participant) == list:
             destination_participant_type = State.PARTICIPANT_TYPE_MULTI
             destination_participant = list(set(destination_participant))
@@ -199,13 +244,13 @@ class WfService(object):
     
     @classmethod
     def ticket_handle_permission_check(cls, ticket:Ticket, user:User)-> dict:
-        transitions = cls.get_state_transitions(ticket.state)
+        transitions = cls.get_ticket_transitions(ticket)
         if not transitions:
             return dict(permission=True, msg="工单当前状态无需操作")
         current_participant_count = 0
         participant_type = ticket.participant_type
         participant = ticket.participant
-        state = ticket.state
+        state = cls.get_ticket_state(ticket)
         if participant_type == State.PARTICIPANT_TYPE_PERSONAL:
             if user.id != participant:
                 return dict(permission=False, msg="非当前处理人", need_accept=False)
@@ -222,6 +267,8 @@ class WfService(object):
             if user.id not in participant:
                 return dict(permission=False, msg="非当前处理人", need_accept=False)
             return dict(permission=False, msg="需要先接单再处理", need_accept=True)
+        if ticket.multi_all_person and TicketVote.objects.filter(ticket=ticket, state_id=ticket.state_id, user=user).exists():
+            return dict(permission=False, msg="您已处理过该工单", need_accept=False)
         if ticket.in_add_node:
             return dict(permission=False, msg="工单当前处于加签中,请加签完成后操作", need_accept=False)
         return dict(permission=True, msg="", need_accept=False)
@@ -250,23 +297,157 @@ class WfService(object):
         :param ticket:
         :return:
         """
-        # 获取工单基础表中的字段中的字段信息
-        field_info_dict = TicketSimpleSerializer(instance=ticket).data
-        # 获取自定义字段的值
-        custom_fields_queryset = cls.get_workflow_custom_fields(ticket.workflow)
-        for i in custom_fields_queryset:
-            field_info_dict[i.field_key] = ticket.ticket_data.get(i.field_key, None)
-        return field_info_dict
+        return build_ticket_snapshot(ticket)
+
+    @classmethod
+    def create_ticket_flow(cls, ticket:Ticket, flows:list=None, **kwargs)->TicketFlow:
+        """
+        新增记录工单数据的流转记录, 工单数据相对上一条记录增量存储
+        flows: 批量处理时传入, 流转记录暂存其中由调用方批量创建
+        """
+        ticket_data, ticket_data_type = make_flow_data(ticket)
+        flow = TicketFlow(ticket=ticket, ticket_data=ticket_data, ticket_data_type=ticket_data_type, **kwargs)
+        cls.save_ticket_flow(flow, flows)
+        cls.record_ticket_involvement(ticket, [flow])
+        return flow
+
+    @staticmethod
+    def save_ticket_flow(flow:TicketFlow, flows:list=None):
+        if flows is None:
+            flow.save()
+        else:
+            flows.append(flow)
+
+    @classmethod
+    def lock_ticket(cls, ticket:Ticket, version:int=None)->Ticket:
+        """
+        锁定工单行并刷新为最新数据, 需在事务中调用
+        version: 客户端持有的版本号, 与当前版本不一致时抛出TicketConflict
+        """
+        # 不阻塞其他事务写入关联表(投票、流转记录等)时的外键检查
+        no_key = connection.features.has_select_for_no_key_update
+        current = Ticket.objects.select_for_update(no_key=no_key).get(id=ticket.id)
+        if version is not None and current.version != version:
+            raise TicketConflict()
+        for field in Ticket._meta.concrete_fields:
+            setattr(ticket, field.attname, getattr(current, field.attname))
+        return ticket
+
+    @classmethod
+    def save_ticket(cls, ticket:Ticket, fields:list):
+        """
+        只保存指定字段, 按版本号比较后更新(CAS), 版本号已变化说明工单已被其他事务修改, 抛出TicketConflict
+        """
+        values = {Ticket._meta.get_field(i).attname: getattr(ticket, Ticket._meta.get_field(i).attname) for i in fields}
+        values['update_time'] = timezone.now()
+        values['version'] = ticket.version + 1
+        if not Ticket.objects.filter(id=ticket.id, version=ticket.version).update(**values):
+            raise TicketConflict()
+        ticket.update_time, ticket.version = values['update_time'], values['version']
+
+    @classmethod
+    def get_ticket_participant_ids(cls, ticket:Ticket)->dict:
+        """
+        工单当前处理人及类型{user_id: kind}
+        """
+        if ticket.is_deleted or ticket.act_state in [Ticket.TICKET_ACT_STATE_FINISH, Ticket.TICKET_ACT_STATE_CLOSED]:
+            return {}
+        participant = ticket.participant if isinstance(ticket.participant, list) else [ticket.participant]
+        ids = set()
+        for i in participant:
+            if isinstance(i, int) and not isinstance(i, bool) and i > 0:
+                ids.add(i)
+            elif isinstance(i, str) and i.isdigit() and int(i) > 0:
+                ids.add(int(i))
+        if ticket.multi_all_person and ids:
+            # 会签中已处理的人不再是当前处理人
+            ids -= set(TicketVote.objects.filter(ticket=ticket, state_id=ticket.state_id).values_list('user_id', flat=True))
+        if ticket.in_add_node:
+            kind = TicketParticipant.KIND_ADD_NODE
+        elif len(ids) > 1 and cls.get_ticket_state(ticket).distribute_type == State.STATE_DISTRIBUTE_TYPE_ACTIVE:
+            kind = TicketParticipant.KIND_ACCEPT
+        else:
+            kind = TicketParticipant.KIND_HANDLE
+        return {i: kind for i in ids}
+
+    @classmethod
+    def sync_ticket_participants(cls, ticket:Ticket)->tuple:
+        """
+        同步工单当前处理人表, 需与工单在同一事务中保存
+        返回(新增的用户id集合, 移除的用户id集合)
+        """
+        current = dict(TicketParticipant.objects.filter(ticket=ticket).values_list('user_id', 'kind'))
+        target = cls.get_ticket_participant_ids(ticket)
+        added = set(target) - set(current)
+        removed = set(current) - set(target)
+        if added:
+            added = set(User.objects.filter(id__in=added).values_list('id', flat=True))
+        if removed:
+            TicketParticipant.objects.filter(ticket=ticket, user_id__in=removed).delete()
+        if added:
+            TicketParticipant.objects.bulk_create([TicketParticipant(ticket=ticket, user_id=i, kind=target[i]) for i in added])
+        changed = {}
+        for user_id, kind in current.items():
+            if user_id in target and target[user_id] != kind:
+                changed.setdefault(target[user_id], []).append(user_id)
+        for kind, user_ids in changed.items():
+            TicketParticipant.objects.filter(ticket=ticket, user_id__in=user_ids).update(kind=kind)
+        update_todo_counts(get_todo_changes(ticket.workflow_id, added, removed))
+        return added, removed
+
+    @classmethod
+    def record_ticket_involvement(cls, ticket:Ticket, flows:list=(), created_by:User=None, touch_all:bool=True):
+        """
+        记录流转记录涉及的用户(处理人, 抄送人, 创建人)
+        并刷新该工单所有参与记录的最近流转时间
+        touch_all: 为False时只刷新本次涉及用户的记录(会签投票时避免同时处理的人更新同一批行)
+        """
+        rows = set()
+        if created_by is not None:
+            rows.add((created_by.id, TicketInvolvement.ROLE_CREATED))
+        cc_ids = set()
+        for flow in flows:
+            if flow.participant_id:
+                rows.add((flow.participant_id, TicketInvolvement.ROLE_HANDLED))
+            for i in flow.participant_cc or []:
+                if isinstance(i, int) and not isinstance(i, bool) or isinstance(i, str) and i.isdigit():
+                    cc_ids.add(int(i))
+        if cc_ids:
+            rows.update((i, TicketInvolvement.ROLE_CC) for i in User.objects.filter(id__in=cc_ids).values_list('id', flat=True))
+        now = timezone.now()
+        if rows:
+            TicketInvolvement.objects.bulk_create([TicketInvolvement(ticket=ticket, user_id=user_id, role=role, last_touched=now)
+                for user_id, role in rows], ignore_conflicts=True)
+        queryset = TicketInvolvement.objects.filter(ticket=ticket)
+        if not touch_all:
+            queryset = queryset.filter(user_id__in={i[0] for i in rows})
+        queryset.update(last_touched=now)
+
+    @classmethod
+    def get_ticket_flow_data(cls, flow:TicketFlow)->dict:
+        """
+        还原流转记录时的工单数据
+        """
+        if flow.ticket_data_type != TicketFlow.TICKET_DATA_TYPE_DELTA:
+            return flow.ticket_data
+        return get_flow_snapshot(flow.ticket_id, flow.id)[0]
 
     @classmethod
     def handle_ticket(cls, ticket:Ticket, transition: Transition, new_ticket_data:dict={}, handler:User=None, 
-        suggestion:str='', created:bool=False, by_timer:bool=False, by_task:bool=False, by_hook:bool=False):
+        suggestion:str='', created:bool=False, by_timer:bool=False, by_task:bool=False, by_hook:bool=False, flows:list=None):
+        """
+        处理工单
+        flows: 批量处理时传入, 流转记录暂存其中由调用方批量创建
+        """
 
-        source_state = ticket.state
+        definition = get_workflow_definition(ticket.workflow_id)
+        source_state = cls.get_ticket_state(ticket)
+        ticket.state = source_state
+        transition = definition.transitions.get(transition.id, transition)
         source_ticket_data = ticket.ticket_data
 
         # 校验处理权限
-        if not handler or not created: # 没有处理人意味着系统触发不校验处理权限
+        if handler and not created: # 没有处理人意味着系统触发不校验处理权限
             result = WfService.ticket_handle_permission_check(ticket, handler)
             if result.get('permission') is False:
                 raise PermissionDenied(result.get('msg'))
@@ -279,29 +460,22 @@ class WfService(object):
                         raise APIException('字段{}必填'.format(key))
 
         destination_state = cls.get_next_state_by_transition_and_ticket_info(ticket, transition, new_ticket_data)
-        multi_all_person = ticket.multi_all_person
-        if multi_all_person:
-            multi_all_person[handler.id] =dict(transition=transition.id)
-            # 判断所有人处理结果是否一致
-            if WfService.check_dict_has_all_same_value(multi_all_person):
-                participant_info = WfService.get_ticket_state_participant_info(destination_state, ticket, new_ticket_data)
-                destination_participant_type = participant_info.get('destination_participant_type', 0)
-                destination_participant = participant_info.get('destination_participant', 0)
-                multi_all_person = {}
-            else:
-                # 处理人没有没有全部处理完成或者处理动作不一致
-                destination_participant_type = ticket.participant_type
-                destination_state = ticket.state  # 保持原状态
-                destination_participant = []
-                for key, value in multi_all_person.items():
-                    if not value:
-                        destination_participant.append(key)
-        else:
-            # 当前处理人类型非全部处理
-            participant_info = WfService.get_ticket_state_participant_info(destination_state, ticket, new_ticket_data)
-            destination_participant_type = participant_info.get('destination_participant_type', 0)
-            destination_participant = participant_info.get('destination_participant', 0)
-            multi_all_person = participant_info.get('multi_all_person', {})
+        # 会签中(multi_all_person为会签人员名单), 系统触发的流转不计票直接流转
+        voting = bool(ticket.multi_all_person)
+        voted = False
+        if voting and handler:
+            # 处理人没有全部处理完成或者处理动作不一致时保持原状态, 不改写工单
+            if not cls.vote_ticket(ticket, source_state, transition, new_ticket_data, handler, suggestion, flows):
+                return ticket
+            voted = True
+            # 本人修改已保存, 按锁定后的最新数据确定目标状态和处理人
+            source_ticket_data = ticket.ticket_data
+            new_ticket_data = dict(ticket.ticket_data)
+            destination_state = cls.get_next_state_by_transition_and_ticket_info(ticket, transition, new_ticket_data)
+        participant_info = WfService.get_ticket_state_participant_info(destination_state, ticket, new_ticket_data)
+        destination_participant_type = participant_info.get('destination_participant_type', 0)
+        destination_participant = participant_info.get('destination_participant', 0)
+        multi_all_person = participant_info.get('multi_all_person', {})
 
         # 更新工单信息：基础字段及自定义字段， add_relation字段 需要下个处理人是部门、角色等的情况
         ticket.state = destination_state
@@ -325,29 +499,277 @@ class WfService(object):
                         if key in new_ticket_data:
                             source_ticket_data[key] = new_ticket_data[key]
             ticket.ticket_data = source_ticket_data
-        ticket.save()
+        cls.save_ticket(ticket, ['state', 'participant_type', 'participant', 'multi_all_person', 'act_state', 'ticket_data'])
+        if voting:
+            cls.clear_ticket_votes(ticket)
+        if voted:
+            cls.record_ticket_involvement(ticket)
+        cls.sync_ticket_participants(ticket)
+        cls.sync_ticket_timers(ticket)
 
-        # 更新工单流转记录
-        if not by_task:
-            TicketFlow.objects.create(ticket=ticket, state=source_state, ticket_data=WfService.get_ticket_all_field_value(ticket),
+        # 更新工单流转记录, 会签的最后一人已在投票时记录
+        if not by_task and not voted:
+            cls.create_ticket_flow(ticket, flows=flows, state=source_state,
                             suggestion=suggestion, participant_type=State.PARTICIPANT_TYPE_PERSONAL,
-                            participant=handler, transition=transition)
+                            participant=handler, transition=transition, participant_str='定时器' if by_timer else None)
 
+        cc_flows = []
         if created:
             if source_state.participant_cc:
-                TicketFlow.objects.create(ticket=ticket, state=source_state, 
+                cc_flows.append(TicketFlow(ticket=ticket, state=source_state, 
                             participant_type=0, intervene_type=Transition.TRANSITION_INTERVENE_TYPE_CC,
-                            participant=None, participant_cc=source_state.participant_cc)
+                            participant=None, participant_cc=source_state.participant_cc))
 
         # 目标状态需要抄送
         if destination_state.participant_cc:
-            TicketFlow.objects.create(ticket=ticket, state=destination_state, 
+            cc_flows.append(TicketFlow(ticket=ticket, state=destination_state, 
                         participant_type=0, intervene_type=Transition.TRANSITION_INTERVENE_TYPE_CC,
-                        participant=None, participant_cc=destination_state.participant_cc)
+                        participant=None, participant_cc=destination_state.participant_cc))
+        for flow in cc_flows:
+            cls.save_ticket_flow(flow, flows)
+        if cc_flows or created:
+            cls.record_ticket_involvement(ticket, cc_flows, created_by=ticket.create_by if created else None)
         
-        # 如果目标状态是脚本则执行
+        # 如果目标状态是脚本则写入脚本任务, 事务提交后异步执行
         if destination_state.participant_type == State.PARTICIPANT_TYPE_ROBOT:
-            getattr(HandleScripts, destination_state.participant)(ticket)
+            cls.enqueue_ticket_script(ticket, destination_state)
         
         return ticket
 
+
+    @classmethod
+    def vote_ticket(cls, ticket:Ticket, state:State, transition:Transition, new_ticket_data:dict, handler:User,
+        suggestion:str='', flows:list=None)->bool:
+        """
+        会签处理: 每个处理人独立写入一条投票记录, 不锁定工单
+        修改了表单数据时按版本号保存工单(版本已变化抛出TicketConflict), 流转记录写入全量快照, 否则不带工单数据
+        流转记录不依赖上一条记录的增量, 同时处理的人无需共用锁
+        最后短暂锁定工单判断是否完成: 所有人处理完成且处理动作一致时返回True, 由调用方流转工单
+        """
+        if ticket.state_id != state.id or not ticket.multi_all_person:
+            raise TicketConflict()
+        try:
+            with transaction.atomic():
+                TicketVote.objects.create(ticket=ticket, state=state, user=handler, transition=transition)
+        except IntegrityError:
+            raise APIException('您已处理过该工单')
+        ticket_data = dict(ticket.ticket_data)
+        for key, value in state.state_fields.items():
+            if value in (State.STATE_FIELD_REQUIRED, State.STATE_FIELD_OPTIONAL) and key in new_ticket_data:
+                ticket_data[key] = new_ticket_data[key]
+        flow = TicketFlow(ticket=ticket, state=state, suggestion=suggestion, participant_type=State.PARTICIPANT_TYPE_PERSONAL,
+                        participant=handler, transition=transition)
+        if ticket_data != ticket.ticket_data:
+            ticket.ticket_data = ticket_data
+            cls.save_ticket(ticket, ['ticket_data'])
+            flow.ticket_data, flow.ticket_data_type = build_ticket_snapshot(ticket), TicketFlow.TICKET_DATA_TYPE_FULL
+        cls.save_ticket_flow(flow, flows)
+        cls.record_ticket_involvement(ticket, [flow], touch_all=False)
+        cls.sync_ticket_participants(ticket)
+        votes = TicketVote.objects.filter(ticket=ticket, state=state)
+        if votes.exclude(transition=transition).exists():
+            # 已有不同的处理动作, 不会全部一致, 无需锁定
+            return False
+        # 锁定后读取已提交的投票, 最后提交的处理人能看到所有人的投票
+        cls.lock_ticket(ticket)
+        if ticket.state_id != state.id or not ticket.multi_all_person:
+            raise TicketConflict()
+        votes = dict(votes.values_list('user_id', 'transition_id'))
+        voters = {int(i) for i in ticket.multi_all_person}
+        return voters <= set(votes) and set(votes.values()) == {transition.id}
+
+    @classmethod
+    def clear_ticket_votes(cls, ticket:Ticket):
+        """
+        离开会签状态时删除投票记录
+        """
+        TicketVote.objects.filter(ticket=ticket).delete()
+
+    @classmethod
+    def sync_ticket_timers(cls, ticket:Ticket, reset:bool=True)->int:
+        """
+        删除其他状态的定时器, 按当前状态的定时流转写入到期时间
+        reset: 进入状态时为True, 当前状态的原定时器一并删除后重新计时(离开后再回到该状态不沿用原到期时间)
+        为False时保留已有的定时器只补充缺少的, 用于回填
+        返回新写入的数量
+        """
+        queryset = TicketTimer.objects.filter(ticket=ticket)
+        if not reset:
+            queryset = queryset.exclude(state_id=ticket.state_id)
+        queryset.delete()
+        if ticket.is_deleted or ticket.act_state in [Ticket.TICKET_ACT_STATE_FINISH, Ticket.TICKET_ACT_STATE_CLOSED]:
+            return 0
+        transitions = [i for i in get_workflow_definition(ticket.workflow_id).get_state_transitions(ticket.state_id) if i.timer > 0]
+        if not transitions:
+            return 0
+        if not reset:
+            exists = set(TicketTimer.objects.filter(ticket=ticket).values_list('transition_id', flat=True))
+            transitions = [i for i in transitions if i.id not in exists]
+        now = timezone.now()
+        TicketTimer.objects.bulk_create([TicketTimer(ticket=ticket, state_id=ticket.state_id, transition=i,
+            due_at=now + timedelta(seconds=i.timer)) for i in transitions], ignore_conflicts=True)
+        return len(transitions)
+
+    @classmethod
+    def fire_ticket_timers(cls, batch:int=200, max_batches:int=10)->int:
+        """
+        执行到期的定时流转, 每批最多batch个, 单次最多max_batches批, 剩余的留给下次
+        工单正被其他事务锁定时跳过, 下次再执行; 执行失败的定时器延后TIMER_RETRY_DELAY重试
+        skip_locked需要postgresql或mysql8+, 不支持时退化为等待锁
+        返回执行成功的数量
+        """
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        fired = 0
+        for _ in range(max_batches):
+            with transaction.atomic():
+                timers = list(TicketTimer.objects.select_for_update(skip_locked=skip_locked)
+                    .filter(due_at__lte=timezone.now()).order_by('due_at')[:batch])
+                if not timers:
+                    break
+                for timer in timers:
+                    ticket = Ticket._base_manager.select_for_update(skip_locked=skip_locked).filter(id=timer.ticket_id).first()
+                    if ticket is None:
+                        continue
+                    transition = get_workflow_definition(ticket.workflow_id).transitions.get(timer.transition_id, None)
+                    if ticket.is_deleted or ticket.state_id != timer.state_id or transition is None \
+                        or ticket.act_state in [Ticket.TICKET_ACT_STATE_FINISH, Ticket.TICKET_ACT_STATE_CLOSED]:
+                        TicketTimer.objects.filter(id=timer.id).delete()
+                        continue
+                    try:
+                        # 先删除本定时器再流转, 流转回同一状态时由sync_ticket_timers重新计时
+                        with transaction.atomic():
+                            TicketTimer.objects.filter(id=timer.id).delete()
+                            cls.handle_ticket(ticket=ticket, transition=transition,
+                                new_ticket_data=dict(ticket.ticket_data), by_timer=True)
+                        fired += 1
+                    except Exception:
+                        logger.exception('工单{}定时流转{}执行失败'.format(ticket.id, transition.id))
+                        ticket.refresh_from_db()
+                        TicketTimer.objects.filter(id=timer.id).update(
+                            due_at=timezone.now() + timedelta(seconds=TIMER_RETRY_DELAY))
+                if len(timers) < batch:
+                    break
+        return fired
+
+    @classmethod
+    def enqueue_ticket_script(cls, ticket:Ticket, state:State)->TicketScriptTask:
+        """
+        写入脚本任务, 事务提交后投递到celery执行
+        幂等键为工单id:状态id:版本号, 同一次流转重复写入时返回已有任务
+        """
+        key = '{}:{}:{}'.format(ticket.id, state.id, ticket.version)
+        try:
+            with transaction.atomic():
+                task = TicketScriptTask.objects.create(key=key, ticket=ticket, state=state, script=state.participant)
+        except IntegrityError:
+            return TicketScriptTask.objects.get(key=key)
+        transaction.on_commit(lambda: dispatch_script_task(task.id))
+        return task
+
+    @classmethod
+    def run_ticket_script(cls, task_id:int):
+        """
+        执行脚本任务, 通过条件更新抢占任务, 同一任务只会被一个worker执行
+        脚本在保存点中执行, 失败时按间隔重试, 执行结果记录在工单script_run_last_result
+        返回任务状态, 未抢占到时返回None
+        """
+        now = timezone.now()
+        claimed = TicketScriptTask.objects.filter(id=task_id, status=TicketScriptTask.TASK_STATUS_PENDING,
+            next_run_at__lte=now).update(status=TicketScriptTask.TASK_STATUS_RUNNING, update_time=now)
+        if not claimed:
+            return None
+        task = TicketScriptTask.objects.get(id=task_id)
+        with transaction.atomic():
+            ticket = Ticket.objects.select_for_update().get(id=task.ticket_id)
+            if ticket.is_deleted or ticket.state_id != task.state_id:
+                task.status = TicketScriptTask.TASK_STATUS_SKIPPED
+            else:
+                try:
+                    with transaction.atomic():
+                        getattr(HandleScripts, task.script)(ticket)
+                    task.status = TicketScriptTask.TASK_STATUS_SUCCESS
+                    task.last_error = ''
+                    result = True
+                except Exception:
+                    logger.exception('工单{}脚本{}执行失败'.format(ticket.id, task.script))
+                    task.retries += 1
+                    task.last_error = traceback.format_exc()[-2000:]
+                    if task.retries > SCRIPT_TASK_MAX_RETRIES:
+                        task.status = TicketScriptTask.TASK_STATUS_FAILED
+                    else:
+                        delay = SCRIPT_TASK_RETRY_DELAY * 2 ** (task.retries - 1)
+                        task.status = TicketScriptTask.TASK_STATUS_PENDING
+                        task.next_run_at = now + timedelta(seconds=delay)
+                        transaction.on_commit(lambda: dispatch_script_task(task.id, countdown=delay))
+                    result = False
+                Ticket.objects.filter(id=ticket.id).update(script_run_last_result=result)
+            task.save(update_fields=['status', 'retries', 'next_run_at', 'last_error', 'update_time'])
+        return task.status
+
+    @classmethod
+    def requeue_ticket_scripts(cls, limit:int=500)->int:
+        """
+        补发到期未执行的脚本任务(提交后投递失败, 等待重试)
+        执行超时的任务可能仍在执行或已产生外部影响, 不再重复执行, 标记为失败
+        """
+        now = timezone.now()
+        expired = list(TicketScriptTask.objects.filter(status=TicketScriptTask.TASK_STATUS_RUNNING,
+            update_time__lt=now - timedelta(seconds=SCRIPT_TASK_TIMEOUT)).values_list('id', 'ticket_id'))
+        if expired:
+            TicketScriptTask.objects.filter(id__in=[i[0] for i in expired], status=TicketScriptTask.TASK_STATUS_RUNNING).update(
+                status=TicketScriptTask.TASK_STATUS_FAILED, last_error='执行超时', update_time=now)
+            Ticket.objects.filter(id__in={i[1] for i in expired}).update(script_run_last_result=False)
+        ids = list(TicketScriptTask.objects.filter(status=TicketScriptTask.TASK_STATUS_PENDING,
+            next_run_at__lte=now).order_by('next_run_at').values_list('id', flat=True)[:limit])
+        for i in ids:
+            dispatch_script_task(i)
+        return len(ids)
+
+    @classmethod
+    def handle_ticket_batch(cls, items:list, handler:User, all_or_none:bool=False)->list:
+        """
+        批量处理工单
+        items: [{'ticket': id, 'transition': id, 'ticket_data': {}, 'suggestion': '', 'version': 版本号(可选)}]
+        按id顺序锁定工单, 每项在独立的保存点中处理, 流转记录最后批量创建
+        all_or_none为True时任一项失败则全部回滚, 抛出ValidationError并列出各项的失败原因
+        返回与items顺序一致的处理结果, 非业务异常只记录日志, 不返回异常信息
+        """
+        ids = sorted({item['ticket'] for item in items})
+        results, flows, seen = [], [], set()
+        with transaction.atomic():
+            tickets = {i.id: i for i in Ticket.objects.select_for_update().filter(id__in=ids).order_by('id')}
+            for item in items:
+                ret = dict(ticket=item['ticket'], success=False, msg='')
+                results.append(ret)
+                ticket = tickets.get(item['ticket'], None)
+                try:
+                    if ticket is None:
+                        raise ParseError('工单不存在')
+                    if ticket.id in seen:
+                        raise ParseError('工单重复提交')
+                    seen.add(ticket.id)
+                    transition = get_workflow_definition(ticket.workflow_id).transitions.get(item['transition'], None)
+                    if transition is None or transition.source_state_id != ticket.state_id:
+                        raise ParseError('该操作不属于工单当前状态')
+                    item_flows = []
+                    with transaction.atomic():
+                        cls.lock_ticket(ticket, item.get('version', None))
+                        new_ticket_data = dict(ticket.ticket_data)
+                        new_ticket_data.update(item.get('ticket_data', None) or {})
+                        cls.handle_ticket(ticket=ticket, transition=transition, new_ticket_data=new_ticket_data,
+                            handler=handler, suggestion=item.get('suggestion', ''), flows=item_flows)
+                    flows.extend(item_flows)
+                    ret.update(success=True, state=ticket.state_id, act_state=ticket.act_state)
+                except Exception as e:
+                    if isinstance(e, APIException):
+                        ret['msg'] = str(e.detail)
+                    else:
+                        logger.exception('批量处理工单{}失败'.format(item['ticket']))
+                        ret['msg'] = '处理失败'
+                    # 保存点回滚后重新读取, 丢弃内存中的修改
+                    if ticket is not None:
+                        ticket.refresh_from_db()
+            if all_or_none and not all(i['success'] for i in results):
+                raise ValidationError({'items': ['工单{}: {}'.format(i['ticket'], i['msg']) for i in results if not i['success']]})
+            TicketFlow.objects.bulk_create(flows)
+        return results
@@ -0,0 +1,41 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from apps.system.models import Role, User
+from .definition import bump_workflow_version
+from .models import CustomField, State, Transition
+from .participants import bump_participant_version
+
+# 变更工作流的状态,流转或自定义字段时工作流定义缓存失效
+@receiver(post_save, sender=State)
+@receiver(post_delete, sender=State)
+@receiver(post_save, sender=Transition)
+@receiver(post_delete, sender=Transition)
+@receiver(post_save, sender=CustomField)
+@receiver(post_delete, sender=CustomField)
+def update_workflow_version(sender, instance, **kwargs):
+    workflow_id = instance.workflow_id
+    transaction.on_commit(lambda: bump_workflow_version(workflow_id))
+
+# 变更用户的部门或角色时处理人解析快照失效, 保存前读取原部门, 只修改资料、登录时间等其他字段时跳过
+@receiver(pre_save, sender=User)
+def check_participant_dept_user(sender, instance, update_fields=None, **kwargs):
+    instance._participant_dept_changed = False
+    if instance.pk is not None and (update_fields is None or 'dept' in update_fields):
+        old = User.objects.filter(pk=instance.pk).values_list('dept_id', flat=True)
+        instance._participant_dept_changed = bool(old) and old[0] != instance.dept_id
+
+@receiver(post_save, sender=User)
+def update_participant_version_user(sender, instance, created, **kwargs):
+    if created or getattr(instance, '_participant_dept_changed', False):
+        transaction.on_commit(bump_participant_version)
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Role)
+def update_participant_version_delete(sender, instance, **kwargs):
+    transaction.on_commit(bump_participant_version)
+
+@receiver(m2m_changed, sender=User.roles.through)
+def update_participant_version_roles(sender, action, **kwargs):
+    if action in ['post_remove', 'post_add', 'post_clear']:
+        transaction.on_commit(bump_participant_version)
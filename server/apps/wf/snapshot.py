@@ -0,0 +1,131 @@
+from django.db import models
+from django.utils import timezone
+from rest_framework.settings import api_settings
+from .definition import get_workflow_definition
+from .models import Ticket, TicketFlow
+
+FLOW_CHECKPOINT_INTERVAL = 10 # 每隔多少条流转记录写入一次全量快照
+DELTA_REMOVED_KEY = '_removed' # 增量中记录被移除的字段
+
+
+def _get_snapshot_fields(model):
+    """
+    按ModelSerializer(fields='__all__')的字段顺序生成(字段名, 属性名, 转换函数)
+    """
+    opts = model._meta
+    fields = [opts.pk] + [i for i in opts.fields if i.serialize and not i.remote_field] \
+        + [i for i in opts.fields if i.serialize and i.remote_field]
+    ret = []
+    for field in fields:
+        convert = None
+        if isinstance(field, models.DateTimeField):
+            convert = _datetime_to_str
+        elif isinstance(field, models.DateField):
+            convert = _date_to_str
+        ret.append((field.name, field.attname, convert))
+    return ret
+
+
+def _datetime_to_str(value):
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.strftime(api_settings.DATETIME_FORMAT)
+
+
+def _date_to_str(value):
+    return value.strftime(api_settings.DATE_FORMAT)
+
+
+TICKET_SNAPSHOT_FIELDS = _get_snapshot_fields(Ticket)
+
+
+def build_ticket_snapshot(ticket, definition=None):
+    """
+    工单所有字段的值,用于流转记录
+    与TicketSimpleSerializer输出一致(外键为id, 时间按DATETIME_FORMAT),并合并自定义字段的值
+    不经过序列化器,自定义字段取自工作流定义
+    """
+    ret = {}
+    for name, attname, convert in TICKET_SNAPSHOT_FIELDS:
+        value = getattr(ticket, attname)
+        ret[name] = convert(value) if convert is not None and value is not None else value
+    if definition is None:
+        definition = get_workflow_definition(ticket.workflow_id)
+    ticket_data = ticket.ticket_data
+    for key in definition.field_keys:
+        ret[key] = ticket_data.get(key, None)
+    return ret
+
+
+def diff_snapshot(old, new):
+    """
+    计算快照增量,只保留变化的字段
+    """
+    delta = {k: v for k, v in new.items() if k not in old or old[k] != v}
+    removed = [k for k in old if k not in new]
+    if removed:
+        delta[DELTA_REMOVED_KEY] = removed
+    return delta
+
+
+def apply_delta(snapshot, delta):
+    ret = dict(snapshot)
+    for k, v in delta.items():
+        if k != DELTA_REMOVED_KEY:
+            ret[k] = v
+    for k in delta.get(DELTA_REMOVED_KEY, []):
+        ret.pop(k, None)
+    return ret
+
+
+def get_flow_snapshot(ticket_id, flow_id=None):
+    """
+    还原工单某条流转记录(默认最近一条)时的快照
+    返回(快照, 距上一个全量快照的增量条数), 无记录时返回(None, None)
+    """
+    queryset = TicketFlow.objects.filter(ticket_id=ticket_id).exclude(
+        ticket_data_type=TicketFlow.TICKET_DATA_TYPE_NONE)
+    if flow_id is not None:
+        queryset = queryset.filter(id__lte=flow_id)
+    rows = list(queryset.order_by('-id').values_list('ticket_data_type', 'ticket_data')[:FLOW_CHECKPOINT_INTERVAL])
+    for index, (data_type, data) in enumerate(rows):
+        if data_type == TicketFlow.TICKET_DATA_TYPE_FULL:
+            for _, delta in reversed(rows[:index]):
+                data = apply_delta(data, delta)
+            return data, index
+    return None, None
+
+
+def make_flow_data(ticket, snapshot=None):
+    """
+    生成新流转记录的工单数据
+    返回(ticket_data, ticket_data_type), 无基准或增量条数达到间隔时写入全量快照
+    """
+    if snapshot is None:
+        snapshot = build_ticket_snapshot(ticket)
+    last, count = get_flow_snapshot(ticket.id)
+    if last is None or count + 1 >= FLOW_CHECKPOINT_INTERVAL:
+        return snapshot, TicketFlow.TICKET_DATA_TYPE_FULL
+    return diff_snapshot(last, snapshot), TicketFlow.TICKET_DATA_TYPE_DELTA
+
+
+def materialize_flows(flows):
+    """
+    批量还原增量流转记录的快照,一次查询
+    返回{flow_id: 快照}
+    """
+    wanted = {i.id: i.ticket_id for i in flows if i.ticket_data_type == TicketFlow.TICKET_DATA_TYPE_DELTA}
+    if not wanted:
+        return {}
+    rows = TicketFlow.objects.filter(ticket_id__in=set(wanted.values()), id__lte=max(wanted)).exclude(
+        ticket_data_type=TicketFlow.TICKET_DATA_TYPE_NONE).order_by('id').values_list(
+        'id', 'ticket_id', 'ticket_data_type', 'ticket_data')
+    current, ret = {}, {}
+    for pk, ticket_id, data_type, data in rows:
+        if data_type == TicketFlow.TICKET_DATA_TYPE_FULL:
+            current[ticket_id] = data
+        else:
+            current[ticket_id] = apply_delta(current.get(ticket_id, {}), data)
+        if pk in wanted:
+            ret[pk] = current[ticket_id]
+    return ret
@@ -0,0 +1,56 @@
+from __future__ import absolute_import, unicode_literals
+
+from celery import shared_task
+import logging
+
+from .todo import reconcile_todo_counts
+
+logger = logging.getLogger('log')
+
+
+@shared_task(name='wf_reconcile_todo_counts')
+def wf_reconcile_todo_counts():
+    """
+    定时任务: 待办计数器与数据库对账
+    """
+    fixed = reconcile_todo_counts()
+    if fixed:
+        logger.info('待办计数对账修正{}个用户'.format(fixed))
+    return fixed
+
+
+@shared_task(name='wf_run_ticket_script')
+def wf_run_ticket_script(task_id):
+    """
+    执行工单脚本任务
+    """
+    from .services import WfService
+    return WfService.run_ticket_script(task_id)
+
+
+@shared_task(name='wf_requeue_ticket_scripts')
+def wf_requeue_ticket_scripts():
+    """
+    定时任务: 补发未执行的工单脚本任务
+    """
+    from .services import WfService
+    return WfService.requeue_ticket_scripts()
+
+
+@shared_task(name='wf_fire_ticket_timers')
+def wf_fire_ticket_timers():
+    """
+    定时任务: 执行到期的工单定时流转
+    """
+    from .services import WfService
+    return WfService.fire_ticket_timers()
+
+
+def dispatch_script_task(task_id, countdown=None):
+    """
+    投递脚本任务, 失败时由定时任务补发
+    """
+    try:
+        wf_run_ticket_script.apply_async(args=(task_id,), countdown=countdown)
+    except Exception as e:
+        logger.warning('工单脚本任务{}投递失败: {}'.format(task_id, e))
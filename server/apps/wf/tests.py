@@ -1,3 +1,671 @@
-from django.test import TestCase
+import contextlib
+import datetime
+import io
+import threading
+from unittest import mock
+from unittest import skipUnless
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from apps.system.models import Organization, Permission, Role, User
+from apps.wf.models import CustomField, State, Ticket, TicketFlow, TicketInvolvement, TicketScriptTask, TicketSnCounter, TicketTimer, TicketParticipant, TicketVote, Transition, Workflow
+from apps.wf.expression import ConditionExpression, ExpressionError
+from apps.wf.tasks import wf_reconcile_todo_counts
+from apps.wf.todo import TODO_TOTAL_FIELD, TODO_VERSION_FIELD, TODO_WORKFLOW_FIELD, _todo_key, get_user_todo
+from apps.wf.services import SCRIPT_TASK_TIMEOUT, TIMER_RETRY_DELAY, TicketConflict, WfService
+from apps.wf.snapshot import FLOW_CHECKPOINT_INTERVAL, build_ticket_snapshot, get_flow_snapshot, materialize_flows
 
-# Create your tests here.
+try:
+    import fakeredis
+    import lupa  # noqa: F401 fakeredis执行lua脚本需要
+except ImportError:
+    fakeredis = None
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def create_multi_all_workflow(approver_count):
+    """
+    草稿 -> 会签(全部处理) -> 结束
+    """
+    # TestCase中事务不提交, 手动执行on_commit回调使工作流和处理人缓存失效
+    with TestCase.captureOnCommitCallbacks(execute=True):
+        org = Organization.objects.create(name='测试部门')
+        admin = User.objects.create(username='admin', name='管理员', dept=org, is_superuser=True)
+        role = Role.objects.create(name='审批', datas='全部')
+        role.perms.add(Permission.objects.create(name='工单', method='ticket_view'))
+        approvers = []
+        for i in range(approver_count):
+            user = User.objects.create(username='approver{}'.format(i), name='审批人{}'.format(i), dept=org)
+            user.roles.add(role)
+            approvers.append(user)
+        workflow = Workflow.objects.create(name='会签', sn_prefix='hq')
+        start = State.objects.create(workflow=workflow, name='草稿', type=State.STATE_TYPE_START, sort=1,
+            participant_type=State.PARTICIPANT_TYPE_VARIABLE, participant='create_by')
+        multi = State.objects.create(workflow=workflow, name='会签', sort=2, participant_type=State.PARTICIPANT_TYPE_MULTI,
+            participant=[i.id for i in approvers], distribute_type=State.STATE_DISTRIBUTE_TYPE_ALL)
+        end = State.objects.create(workflow=workflow, name='结束', type=State.STATE_TYPE_END, sort=3)
+        submit = Transition.objects.create(workflow=workflow, name='提交', source_state=start, destination_state=multi,
+            field_require_check=False)
+        agree = Transition.objects.create(workflow=workflow, name='同意', source_state=multi, destination_state=end,
+            field_require_check=False)
+    client = APIClient()
+    client.force_authenticate(admin)
+    data = client.post('/api/wf/ticket/', {'workflow': workflow.id, 'transition': submit.id, 'title': '会签', 'ticket_data': {}},
+        format='json').json()['data']
+    return Ticket.objects.get(id=data['id']), approvers, agree, end
+
+
+class ConditionExpressionTestCase(SimpleTestCase):
+
+    def evaluate(self, expression, **values):
+        return ConditionExpression(expression).evaluate(values)
+
+    def test_allowed(self):
+        self.assertTrue(self.evaluate('{days} > 3 and {days} <= 10', days=5))
+        self.assertTrue(self.evaluate("{type} in ['a', 'b']", type='a'))
+        self.assertTrue(self.evaluate('{items}[0] == 1 and {items}[1:] == [2]', items=[1, 2]))
+        self.assertTrue(self.evaluate("{name}.startswith('张')", name='张三'))
+        self.assertTrue(self.evaluate('{missing} is None'))
+        self.assertTrue(self.evaluate("time.strftime('%Y') >= '2020'"))
+
+    def test_legacy(self):
+        # 原eval支持的写法
+        self.assertTrue(self.evaluate('datetime.datetime.now().date() > datetime.date(2020,1,1)'))
+        self.assertTrue(self.evaluate("datetime.datetime.strptime({day}, '%Y-%m-%d') < datetime.datetime.now()", day='2020-01-01'))
+        self.assertTrue(self.evaluate('(datetime.datetime.now() - datetime.timedelta(days=1)).day >= 1'))
+        self.assertTrue(self.evaluate("{a} + {b} == 'xy'", a='x', b='y'))
+
+    def test_rejected(self):
+        for expression in [
+            "{a}.__class__",
+            "().__class__.__bases__[0].__subclasses__()",
+            "__import__('os').system('ls')",
+            "datetime.sys",
+            "time.sleep(1)",
+            "(lambda: 1)()",
+            "[i for i in {a}]",
+            "{i for i in {a}}",
+            "len({a})",
+            "'{0.__class__}'.format({a})",
+            "{a} ** 100",
+            "os",
+        ]:
+            with self.subTest(expression=expression):
+                with self.assertRaises(ExpressionError):
+                    ConditionExpression(expression)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TicketVersionTestCase(TestCase):
+
+    def test_stale_version_conflict(self):
+        ticket, approvers, agree, _ = create_multi_all_workflow(2)
+        client = APIClient()
+        client.force_authenticate(approvers[0])
+        res = client.post('/api/wf/ticket/{}/handle/'.format(ticket.id),
+            {'transition': agree.id, 'ticket_data': {}, 'version': ticket.version - 1}, format='json').json()
+        self.assertEqual(res['code'], 409)
+        res = client.post('/api/wf/ticket/{}/handle/'.format(ticket.id),
+            {'transition': agree.id, 'ticket_data': {}, 'version': ticket.version}, format='json').json()
+        self.assertEqual(res['code'], 200)
+        self.assertEqual(res['data']['version'], ticket.version)
+
+    def test_save_ticket_cas(self):
+        ticket, _, _, _ = create_multi_all_workflow(1)
+        stale = Ticket.objects.get(id=ticket.id)
+        WfService.save_ticket(ticket, ['participant'])
+        with self.assertRaises(TicketConflict):
+            WfService.save_ticket(stale, ['participant'])
+
+
+class TicketSnTestCase(TestCase):
+
+    def setUp(self):
+        self.workflow = Workflow.objects.create(name='流水号', sn_prefix='sn')
+        self.today = timezone.localdate()
+
+    def sn(self, date, value):
+        return 'sn_{}{:04d}'.format(date.strftime('%Y%m%d'), value)
+
+    def test_daily_counter(self):
+        self.assertEqual(WfService.get_ticket_sn(self.workflow), self.sn(self.today, 1))
+        self.assertEqual(WfService.get_ticket_sn(self.workflow), self.sn(self.today, 2))
+        self.assertEqual(WfService.reserve_ticket_sn(self.workflow, 3), [self.sn(self.today, i) for i in (3, 4, 5)])
+        other = Workflow.objects.create(name='其他', sn_prefix='sn')
+        self.assertEqual(WfService.get_ticket_sn(other), self.sn(self.today, 1))
+        self.assertEqual(TicketSnCounter.objects.get(workflow=self.workflow, date=self.today).next_value, 6)
+
+    def test_day_rollover(self):
+        WfService.reserve_ticket_sn(self.workflow, 2)
+        tomorrow = self.today + datetime.timedelta(days=1)
+        with mock.patch('django.utils.timezone.localdate', return_value=tomorrow):
+            self.assertEqual(WfService.get_ticket_sn(self.workflow), self.sn(tomorrow, 1))
+        self.assertEqual(WfService.get_ticket_sn(self.workflow), self.sn(self.today, 3))
+        self.assertEqual(TicketSnCounter.objects.filter(workflow=self.workflow).count(), 2)
+
+    def test_seed_from_existing_tickets(self):
+        # 计数器上线前当天已生成的流水号
+        state = State.objects.create(workflow=self.workflow, name='开始', type=State.STATE_TYPE_START)
+        for i in range(2):
+            Ticket.objects.create(workflow=self.workflow, state=state, title='t', sn=self.sn(self.today, i + 1))
+        self.assertEqual(WfService.get_ticket_sn(self.workflow), self.sn(self.today, 3))
+
+    def test_create_conflict(self):
+        # 读取计数器后另一个请求抢先建了当天的行, 本次插入冲突后改为锁定已有行
+        select_for_update = TicketSnCounter.objects.select_for_update
+        calls = []
+
+        def concurrent_create(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                TicketSnCounter.objects.create(workflow=self.workflow, date=self.today, next_value=7)
+                return TicketSnCounter.objects.none()
+            return select_for_update(*args, **kwargs)
+        with mock.patch.object(TicketSnCounter.objects, 'select_for_update', side_effect=concurrent_create):
+            self.assertEqual(WfService.get_ticket_sn(self.workflow), self.sn(self.today, 7))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(TicketSnCounter.objects.get(workflow=self.workflow, date=self.today).next_value, 8)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TicketScriptTaskTestCase(TestCase):
+
+    def test_enqueue_idempotent(self):
+        ticket, _, _, _ = create_multi_all_workflow(1)
+        state = ticket.state
+        first = WfService.enqueue_ticket_script(ticket, state)
+        self.assertEqual(first.key, '{}:{}:{}'.format(ticket.id, state.id, ticket.version))
+        self.assertEqual(WfService.enqueue_ticket_script(ticket, state).id, first.id)
+        WfService.save_ticket(ticket, ['participant'])
+        self.assertNotEqual(WfService.enqueue_ticket_script(ticket, state).id, first.id)
+
+    def test_expired_running_not_rerun(self):
+        ticket, _, _, _ = create_multi_all_workflow(1)
+        task = WfService.enqueue_ticket_script(ticket, ticket.state)
+        expired = timezone.now() - datetime.timedelta(seconds=SCRIPT_TASK_TIMEOUT + 1)
+        TicketScriptTask.objects.filter(id=task.id).update(status=TicketScriptTask.TASK_STATUS_RUNNING, update_time=expired)
+        with mock.patch('apps.wf.services.dispatch_script_task') as dispatch:
+            self.assertEqual(WfService.requeue_ticket_scripts(), 0)
+        dispatch.assert_not_called()
+        task.refresh_from_db()
+        self.assertEqual(task.status, TicketScriptTask.TASK_STATUS_FAILED)
+        self.assertIsNone(WfService.run_ticket_script(task.id))
+        self.assertFalse(Ticket.objects.get(id=ticket.id).script_run_last_result)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TicketTimerTestCase(TestCase):
+    """
+    草稿 -> 等待(定时流转回自身) -> 结束
+    """
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            admin = User.objects.create(username='admin', name='管理员', is_superuser=True)
+            workflow = Workflow.objects.create(name='定时', sn_prefix='ds')
+            start = State.objects.create(workflow=workflow, name='草稿', type=State.STATE_TYPE_START, sort=1,
+                participant_type=State.PARTICIPANT_TYPE_VARIABLE, participant='create_by')
+            self.wait = State.objects.create(workflow=workflow, name='等待', sort=2,
+                participant_type=State.PARTICIPANT_TYPE_VARIABLE, participant='create_by')
+            State.objects.create(workflow=workflow, name='结束', type=State.STATE_TYPE_END, sort=3)
+            submit = Transition.objects.create(workflow=workflow, name='提交', source_state=start, destination_state=self.wait,
+                field_require_check=False)
+            self.loop = Transition.objects.create(workflow=workflow, name='提醒', source_state=self.wait,
+                destination_state=self.wait, field_require_check=False, timer=60)
+        client = APIClient()
+        client.force_authenticate(admin)
+        data = client.post('/api/wf/ticket/', {'workflow': workflow.id, 'transition': submit.id, 'title': '定时', 'ticket_data': {}},
+            format='json').json()['data']
+        self.ticket = Ticket.objects.get(id=data['id'])
+
+    def expire(self):
+        TicketTimer.objects.filter(ticket=self.ticket).update(due_at=timezone.now() - datetime.timedelta(seconds=1))
+
+    def test_loop_back(self):
+        for i in range(2):
+            self.expire()
+            self.assertEqual(WfService.fire_ticket_timers(), 1)
+            timer = TicketTimer.objects.get(ticket=self.ticket)
+            self.assertEqual((timer.state_id, timer.transition_id), (self.wait.id, self.loop.id))
+            self.assertGreater(timer.due_at, timezone.now())
+        self.assertEqual(TicketFlow.objects.filter(ticket=self.ticket, transition=self.loop, participant_str='定时器').count(), 2)
+
+    def test_failure_rescheduled(self):
+        self.expire()
+        with mock.patch.object(WfService, 'handle_ticket', side_effect=Exception('配置错误')):
+            self.assertEqual(WfService.fire_ticket_timers(), 0)
+        timer = TicketTimer.objects.get(ticket=self.ticket)
+        self.assertGreater(timer.due_at, timezone.now() + datetime.timedelta(seconds=TIMER_RETRY_DELAY - 10))
+        self.assertEqual(WfService.fire_ticket_timers(), 0)
+
+    def test_stale_timer_removed(self):
+        self.expire()
+        Ticket.objects.filter(id=self.ticket.id).update(is_deleted=True)
+        self.assertEqual(WfService.fire_ticket_timers(), 0)
+        self.assertFalse(TicketTimer.objects.filter(ticket=self.ticket).exists())
+
+
+    def test_reenter_resets(self):
+        """
+        离开后再回到定时状态时重新计时
+        """
+        timer = TicketTimer.objects.get(ticket=self.ticket)
+        TicketTimer.objects.filter(id=timer.id).update(due_at=timezone.now() + datetime.timedelta(seconds=5))
+        WfService.handle_ticket(self.ticket, self.loop, dict(self.ticket.ticket_data))
+        timer = TicketTimer.objects.get(ticket=self.ticket)
+        self.assertGreater(timer.due_at, timezone.now() + datetime.timedelta(seconds=30))
+
+    def test_backfill(self):
+        TicketTimer.objects.all().delete()
+        out = io.StringIO()
+        call_command('sync_ticket_timers', stdout=out)
+        timer = TicketTimer.objects.get(ticket=self.ticket)
+        self.assertEqual((timer.state_id, timer.transition_id), (self.wait.id, self.loop.id))
+        due_at = timer.due_at
+        call_command('sync_ticket_timers', stdout=out)
+        self.assertEqual(TicketTimer.objects.get(ticket=self.ticket).due_at, due_at)
+        Ticket.objects.filter(id=self.ticket.id).update(act_state=Ticket.TICKET_ACT_STATE_FINISH)
+        TicketTimer.objects.all().delete()
+        call_command('sync_ticket_timers', stdout=out)
+        self.assertFalse(TicketTimer.objects.exists())
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TicketFlowSnapshotTestCase(TestCase):
+    """
+    增量流转记录跨全量快照还原后与当时的完整快照一致
+    """
+
+    def test_replay_delta_chain(self):
+        ticket, _, _, _ = create_multi_all_workflow(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            CustomField.objects.create(workflow=ticket.workflow, field_type='string', field_key='amount', field_name='金额')
+        expected = {}
+        for i in range(FLOW_CHECKPOINT_INTERVAL * 2 + 3):
+            ticket.title = '标题{}'.format(i % 3)
+            ticket.ticket_data = {'amount': i} if i % 4 else {}
+            WfService.save_ticket(ticket, ['title', 'ticket_data'])
+            flow = WfService.create_ticket_flow(ticket, state=ticket.state, participant_type=State.PARTICIPANT_TYPE_PERSONAL)
+            expected[flow.id] = build_ticket_snapshot(ticket)
+            self.assertIn('amount', expected[flow.id])
+        flows = list(TicketFlow.objects.filter(id__in=expected).order_by('id'))
+        types = [i.ticket_data_type for i in flows]
+        self.assertIn(TicketFlow.TICKET_DATA_TYPE_DELTA, types)
+        self.assertGreaterEqual(types.count(TicketFlow.TICKET_DATA_TYPE_FULL), 2)
+        materialized = materialize_flows(flows)
+        for flow in flows:
+            self.assertEqual(get_flow_snapshot(ticket.id, flow.id)[0], expected[flow.id])
+            self.assertEqual(WfService.get_ticket_flow_data(flow), expected[flow.id])
+            if flow.ticket_data_type == TicketFlow.TICKET_DATA_TYPE_DELTA:
+                self.assertEqual(materialized[flow.id], expected[flow.id])
+            else:
+                self.assertEqual(flow.ticket_data, expected[flow.id])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TicketVoteTestCase(TestCase):
+
+    def handle(self, user, ticket, transition):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post('/api/wf/ticket/{}/handle/'.format(ticket.id),
+            {'transition': transition.id, 'ticket_data': {}}, format='json').json()
+
+    def test_vote_without_ticket_write(self):
+        ticket, approvers, agree, end = create_multi_all_workflow(3)
+        version = ticket.version
+        self.assertEqual(self.handle(approvers[0], ticket, agree)['code'], 200)
+        self.assertEqual(self.handle(approvers[0], ticket, agree)['code'], 403)
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.version, version)
+        self.assertEqual(TicketVote.objects.filter(ticket=ticket).count(), 1)
+        self.assertEqual(set(TicketParticipant.objects.filter(ticket=ticket).values_list('user_id', flat=True)),
+            {approvers[1].id, approvers[2].id})
+        for user in approvers[1:]:
+            self.assertEqual(self.handle(user, ticket, agree)['code'], 200)
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.state_id, end.id)
+        self.assertEqual(ticket.version, version + 1)
+        self.assertFalse(TicketVote.objects.filter(ticket=ticket).exists())
+        self.assertEqual(TicketFlow.objects.filter(ticket=ticket, transition=agree).count(), 3)
+
+    def test_stale_voters(self):
+        """
+        处理人基于同一份旧数据先后处理: 未修改表单的直接投票, 修改表单的按版本号保存, 基于旧版本时冲突
+        投票的流转记录为全量快照或不带工单数据, 不依赖上一条记录
+        """
+        ticket, approvers, agree, end = create_multi_all_workflow(3)
+        with self.captureOnCommitCallbacks(execute=True):
+            for key in ('x', 'y'):
+                CustomField.objects.create(workflow=ticket.workflow, field_type='string', field_key=key, field_name=key)
+            state = State.objects.get(id=ticket.state_id)
+            state.state_fields = {'x': State.STATE_FIELD_OPTIONAL, 'y': State.STATE_FIELD_OPTIONAL}
+            state.save()
+        Ticket.objects.filter(id=ticket.id).update(ticket_data={'x': '0', 'y': '0'})
+        stale = [Ticket.objects.get(id=ticket.id) for _ in approvers]
+
+        def handle(user, instance, data):
+            new_ticket_data = dict(instance.ticket_data)
+            new_ticket_data.update(data)
+            WfService.handle_ticket(instance, agree, new_ticket_data, handler=user)
+
+        handle(approvers[0], stale[0], {'x': 'a'})
+        with self.assertRaises(TicketConflict), transaction.atomic():
+            handle(approvers[1], stale[1], {'y': 'b'})
+        handle(approvers[1], Ticket.objects.get(id=ticket.id), {'y': 'b'})
+        handle(approvers[2], stale[2], {})
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.state_id, end.id)
+        self.assertEqual(ticket.ticket_data, {'x': 'a', 'y': 'b'})
+        flows = list(TicketFlow.objects.filter(ticket=ticket, transition=agree).order_by('id'))
+        self.assertEqual([i.ticket_data_type for i in flows], [TicketFlow.TICKET_DATA_TYPE_FULL,
+            TicketFlow.TICKET_DATA_TYPE_FULL, TicketFlow.TICKET_DATA_TYPE_NONE])
+        self.assertEqual([(i.ticket_data['x'], i.ticket_data['y']) for i in flows[:2]], [('a', '0'), ('a', 'b')])
+
+    def test_vote_without_lock(self):
+        """
+        投票写入后才锁定工单判断是否完成, 已有不一致的处理动作时不再锁定
+        """
+        ticket, approvers, agree, end = create_multi_all_workflow(3)
+        refuse = Transition.objects.create(workflow=ticket.workflow, name='拒绝', source_state=agree.source_state,
+            destination_state=agree.source_state)
+        lock_ticket = WfService.lock_ticket
+
+        def lock(instance, version=None):
+            self.assertEqual(TicketVote.objects.filter(ticket=ticket).count(), 1)
+            return lock_ticket(instance, version)
+
+        with mock.patch.object(WfService, 'lock_ticket', side_effect=lock) as mocked:
+            WfService.handle_ticket(Ticket.objects.get(id=ticket.id), refuse, {}, handler=approvers[0])
+            WfService.handle_ticket(Ticket.objects.get(id=ticket.id), agree, {}, handler=approvers[1])
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(TicketVote.objects.filter(ticket=ticket).count(), 2)
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.state_id, agree.source_state_id)
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ParticipantVersionTestCase(TestCase):
+    """
+    只有新增用户、修改部门或角色时处理人快照失效
+    """
+
+    def assert_bumped(self, func, bumped=True):
+        with mock.patch('apps.wf.signals.bump_participant_version') as bump, \
+                self.captureOnCommitCallbacks(execute=True):
+            func()
+        self.assertEqual(bump.called, bumped)
+
+    def test_user_changes(self):
+        dept = Organization.objects.create(name='部门', type='部门')
+        other = Organization.objects.create(name='其他部门', type='部门')
+        role = Role.objects.create(name='审批人')
+        user = User.objects.create(username='user', dept=dept)
+        self.assert_bumped(lambda: User.objects.create(username='new', dept=dept))
+        user.name = '张三'
+        self.assert_bumped(user.save, False)
+        self.assert_bumped(lambda: user.save(update_fields=['last_login']), False)
+        user.dept = other
+        self.assert_bumped(user.save)
+        self.assert_bumped(lambda: user.save(update_fields=['dept']), False)
+        stale = User.objects.get(id=user.id)
+        stale.dept = dept
+        self.assert_bumped(lambda: stale.save(update_fields=['dept']))
+        self.assert_bumped(lambda: user.roles.add(role))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TodoAggTestCase(TestCase):
+    """
+    待办计数接口: since/If-None-Match与version一致时返回304, 待办变化后返回新version
+    """
+
+    def test_since(self):
+        ticket, approvers, agree, end = create_multi_all_workflow(2)
+        client = APIClient()
+        client.force_authenticate(approvers[0])
+        res = client.get('/api/wf/ticket/duty_agg/').json()['data']
+        self.assertEqual(res['total_count'], 1)
+        self.assertEqual(res['details'], [{'workflow': ticket.workflow_id, 'workflow__name': '会签', 'count': 1}])
+        version = res['version']
+        self.assertEqual(client.get('/api/wf/ticket/duty_agg/', {'since': version}).status_code, 304)
+        self.assertEqual(client.get('/api/wf/ticket/duty_agg/', HTTP_IF_NONE_MATCH='"{}"'.format(version)).status_code, 304)
+        WfService.handle_ticket(ticket, agree, {}, handler=approvers[0])
+        res = client.get('/api/wf/ticket/duty_agg/', {'since': version}).json()['data']
+        self.assertEqual(res['total_count'], 0)
+        self.assertNotEqual(res['version'], version)
+
+
+@skipUnless(fakeredis, '需要fakeredis[lua]')
+@override_settings(CACHES=LOCMEM_CACHES)
+class TodoCounterTestCase(TestCase):
+    """
+    redis待办计数器: 从数据库初始化, 事务提交后增量更新, 定时对账修正
+    """
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.redis.flushall()
+        patcher = mock.patch('apps.wf.todo.get_redis_client', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ticket, self.approvers, self.agree, self.end = create_multi_all_workflow(2)
+
+    def get_hash(self, user):
+        return {k.decode(): int(v) for k, v in self.redis.hgetall(_todo_key(user.id)).items()}
+
+    def test_counter(self):
+        workflow_id = self.ticket.workflow_id
+        field = TODO_WORKFLOW_FIELD.format(workflow_id)
+        for user in self.approvers:
+            self.assertEqual(get_user_todo(user.id)[0], {workflow_id: 1})
+        version = self.get_hash(self.approvers[0])[TODO_VERSION_FIELD]
+        with self.captureOnCommitCallbacks() as callbacks:
+            WfService.handle_ticket(self.ticket, self.agree, {}, handler=self.approvers[0])
+        # 事务提交前不更新计数
+        self.assertEqual(self.get_hash(self.approvers[0])[field], 1)
+        for callback in callbacks:
+            callback()
+        data = self.get_hash(self.approvers[0])
+        self.assertNotIn(field, data)
+        self.assertEqual(data.get(TODO_TOTAL_FIELD, 0), 0)
+        self.assertGreater(data[TODO_VERSION_FIELD], version)
+        self.assertEqual(get_user_todo(self.approvers[0].id)[0], {})
+        self.assertEqual(get_user_todo(self.approvers[1].id)[0], {workflow_id: 1})
+
+    def test_missing_counter_not_created(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            WfService.handle_ticket(self.ticket, self.agree, {}, handler=self.approvers[0])
+        self.assertFalse(self.redis.exists(_todo_key(self.approvers[0].id)))
+        self.assertEqual(get_user_todo(self.approvers[1].id)[0], {self.ticket.workflow_id: 1})
+
+    def test_reconcile(self):
+        workflow_id = self.ticket.workflow_id
+        for user in self.approvers:
+            get_user_todo(user.id)
+        self.redis.hset(_todo_key(self.approvers[0].id), mapping={TODO_TOTAL_FIELD: 5, TODO_WORKFLOW_FIELD.format(workflow_id): 5})
+        self.assertEqual(wf_reconcile_todo_counts(), 1)
+        self.assertEqual(get_user_todo(self.approvers[0].id)[0], {workflow_id: 1})
+        self.assertEqual(self.get_hash(self.approvers[0])[TODO_TOTAL_FIELD], 1)
+        self.assertEqual(wf_reconcile_todo_counts(), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TicketBatchTestCase(TestCase):
+
+    def handle_batch(self, user, items, all_or_none=False):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post('/api/wf/ticket/handle_batch/', {'items': items, 'all_or_none': all_or_none}, format='json').json()
+
+    def test_item_errors(self):
+        ticket, approvers, agree, end = create_multi_all_workflow(1)
+        items = [{'ticket': ticket.id, 'transition': agree.id, 'version': ticket.version - 1}]
+        res = self.handle_batch(approvers[0], items)
+        self.assertEqual(res['code'], 200)
+        self.assertFalse(res['data'][0]['success'])
+        with mock.patch.object(WfService, 'get_next_state_by_transition_and_ticket_info', side_effect=Exception('工作流状态配置错误')):
+            res = self.handle_batch(approvers[0], [dict(items[0], version=ticket.version)])
+        self.assertEqual(res['code'], 200)
+        # 非业务异常不返回异常信息
+        self.assertEqual(res['data'][0], dict(ticket=ticket.id, success=False, msg='处理失败'))
+        with mock.patch.object(WfService, 'get_next_state_by_transition_and_ticket_info', side_effect=Exception('工作流状态配置错误')):
+            res = self.handle_batch(approvers[0], [dict(items[0], version=ticket.version)], all_or_none=True)
+        self.assertEqual(res['code'], 400)
+        self.assertEqual(res['data'], {'items': ['工单{}: 处理失败'.format(ticket.id)]})
+        res = self.handle_batch(approvers[0], [dict(items[0], version=ticket.version), {'ticket': 0, 'transition': agree.id},
+            dict(items[0], version=ticket.version)], all_or_none=True)
+        self.assertEqual(res['code'], 400)
+        self.assertEqual(res['data'], {'items': ['工单0: 工单不存在', '工单{}: 工单重复提交'.format(ticket.id)]})
+        ticket.refresh_from_db()
+        self.assertNotEqual(ticket.state_id, end.id)
+        res = self.handle_batch(approvers[0], [dict(items[0], version=ticket.version)])
+        self.assertTrue(res['data'][0]['success'])
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.state_id, end.id)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CursorPaginationTestCase(TestCase):
+
+    def setUp(self):
+        ticket, self.approvers, _, _ = create_multi_all_workflow(1)
+        self.admin = ticket.create_by
+        now = timezone.now()
+        # 每3个工单的创建时间相同, 验证同一时间的数据不跳过不重复
+        for i in range(24):
+            ticket.pk = ticket.id = None
+            ticket.sn = 'cursor{}'.format(i)
+            ticket.create_time = now - datetime.timedelta(seconds=i // 3)
+            ticket.save()
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def fetch_all(self, url):
+        ids, pages = [], []
+        while url:
+            data = self.client.get(url).json()['data']
+            pages.append(len(data['results']))
+            ids += [i['id'] for i in data['results']]
+            self.assertIsNone(data['previous'])
+            url = data['next']
+        return ids, pages
+
+    def test_pages(self):
+        expected = list(Ticket.objects.order_by('-create_time', '-id').values_list('id', flat=True))
+        ids, pages = self.fetch_all('/api/wf/ticket/?category=all&cursor=&page_size=7')
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, [7, 7, 7, 4])
+        ids, pages = self.fetch_all('/api/wf/ticket/?category=all&cursor=&page_size=5')
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, [5] * 5)
+
+    def test_count(self):
+        data = self.client.get('/api/wf/ticket/?category=all&cursor=').json()['data']
+        self.assertIsNone(data['count'])
+        for count in ('approx', 'exact'):
+            data = self.client.get('/api/wf/ticket/?category=all&cursor=&count={}'.format(count)).json()['data']
+            self.assertEqual(data['count'], Ticket.objects.count())
+        data = self.client.get('/api/wf/ticketflow/?cursor=&count=approx').json()['data']
+        self.assertEqual(data['count'], TicketFlow.objects.count())
+
+    def test_invalid_cursor(self):
+        for cursor in ('abc', 'WzFd', 'WyJ4IiwgMV0='):
+            self.assertEqual(self.client.get('/api/wf/ticket/?category=all&cursor={}'.format(cursor)).json()['code'], 400)
+
+    def test_worked_by_last_touched(self):
+        user = self.approvers[0]
+        now = timezone.now()
+        tickets = list(Ticket.objects.order_by('id'))
+        TicketInvolvement.objects.filter(user=user).delete()
+        TicketInvolvement.objects.bulk_create([TicketInvolvement(user=user, ticket=t, role=TicketInvolvement.ROLE_HANDLED,
+            last_touched=now - datetime.timedelta(seconds=i % 4)) for i, t in enumerate(tickets)])
+        self.client.force_authenticate(user)
+        expected = list(TicketInvolvement.objects.filter(user=user, role=TicketInvolvement.ROLE_HANDLED)
+            .order_by('-last_touched', '-ticket_id').values_list('ticket_id', flat=True))
+        ids, _ = self.fetch_all('/api/wf/ticket/?category=worked&cursor=&page_size=6')
+        self.assertEqual(ids, expected)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@skipUnless(connection.features.has_select_for_update, '数据库不支持行锁')
+class TicketConcurrencyTestCase(TransactionTestCase):
+    """
+    多个处理人并发处理同一会签工单, 每人的处理结果都不能丢失
+    """
+    approver_count = 8
+
+    def handle(self, user, ticket, transition, results, barrier):
+        client = APIClient()
+        client.force_authenticate(user)
+        try:
+            barrier.wait()
+            for _ in range(5):
+                res = client.post('/api/wf/ticket/{}/handle/'.format(ticket.id),
+                    {'transition': transition.id, 'ticket_data': {}}, format='json').json()
+                if res['code'] != 409: # 冲突可重试
+                    break
+            results.append(res['code'])
+        finally:
+            connections.close_all()
+
+    def test_parallel_handle(self):
+        ticket, approvers, agree, end = create_multi_all_workflow(self.approver_count)
+        version = ticket.version
+        results = []
+        barrier = threading.Barrier(len(approvers))
+        threads = [threading.Thread(target=self.handle, args=(i, ticket, agree, results, barrier)) for i in approvers]
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+        self.assertEqual(results, [200] * len(approvers))
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.state_id, end.id)
+        self.assertEqual(ticket.act_state, Ticket.TICKET_ACT_STATE_FINISH)
+        self.assertEqual(ticket.multi_all_person, {})
+        self.assertEqual(TicketFlow.objects.filter(ticket=ticket, transition=agree).count(), len(approvers))
+        self.assertEqual(ticket.version, version + 1)
+        self.assertFalse(TicketVote.objects.filter(ticket=ticket).exists())
+
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TicketCasConcurrencyTestCase(TransactionTestCase):
+    """
+    多个线程基于同一版本并发保存同一工单, 按版本号比较后更新: 只有一个成功, 其他返回409
+    不依赖行锁, 在所有数据库上运行
+    """
+    thread_count = 8
+
+    def save(self, ticket_id, participant, results, barrier, write_lock):
+        try:
+            ticket = Ticket.objects.get(id=ticket_id)
+            barrier.wait() # 所有线程读到同一版本后再保存
+            ticket.participant = participant
+            try:
+                with write_lock:
+                    WfService.save_ticket(ticket, ['participant'])
+                results.append(200)
+            except TicketConflict as e:
+                results.append(e.status_code)
+        finally:
+            connections.close_all()
+
+    def test_parallel_save(self):
+        ticket, approvers, agree, end = create_multi_all_workflow(1)
+        version = ticket.version
+        results = []
+        barrier = threading.Barrier(self.thread_count)
+        # sqlite测试库为共享缓存的内存库, 并发写入直接报表锁定而不等待, 用线程锁代替数据库的写锁排队
+        write_lock = threading.Lock() if connection.vendor == 'sqlite' else contextlib.nullcontext()
+        threads = [threading.Thread(target=self.save, args=(ticket.id, i, results, barrier, write_lock))
+            for i in range(self.thread_count)]
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+        self.assertEqual(sorted(results), [200] + [409] * (self.thread_count - 1))
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.version, version + 1)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import time
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from utils.cache import get_redis_client
+from .models import Ticket, TicketParticipant, Workflow
+
+logger = logging.getLogger('log')
+
+TODO_KEY = 'wf__todo__{}' # redis hash: total, version, wf:<workflow_id>
+TODO_TIMEOUT = 60*60*24*7
+TODO_TOTAL_FIELD = 'total'
+TODO_VERSION_FIELD = 'version'
+TODO_WORKFLOW_FIELD = 'wf:{}'
+
+# 计数器存在时才增量更新,不存在的在下次读取时从数据库初始化
+TODO_INCR_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    local value = redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+    if value <= 0 then
+        redis.call('hdel', KEYS[1], ARGV[i])
+    end
+end
+redis.call('hset', KEYS[1], 'version', ARGV[1])
+return 1
+"""
+
+
+def _todo_key(user_id):
+    return cache.make_key(TODO_KEY.format(user_id))
+
+
+def count_user_todo(user_id):
+    """
+    从数据库统计用户待办数量{workflow_id: count}
+    """
+    queryset = TicketParticipant.objects.filter(user_id=user_id, ticket__is_deleted=False)\
+        .exclude(ticket__act_state__in=[Ticket.TICKET_ACT_STATE_FINISH, Ticket.TICKET_ACT_STATE_CLOSED])
+    return dict(queryset.values_list('ticket__workflow').annotate(count=Count('id')))
+
+
+def _to_hash(counts, version):
+    data = {TODO_WORKFLOW_FIELD.format(k): v for k, v in counts.items() if v > 0}
+    data[TODO_TOTAL_FIELD] = sum(counts.values())
+    data[TODO_VERSION_FIELD] = version
+    return data
+
+
+def _from_hash(data):
+    data = {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in data.items()}
+    counts = {int(k[3:]): v for k, v in data.items() if k.startswith('wf:') and v > 0}
+    return counts, data.get(TODO_VERSION_FIELD, 0)
+
+
+def get_user_todo(user_id):
+    """
+    获取用户待办计数, 返回({workflow_id: count}, version)
+    优先读redis计数器, 不存在时从数据库统计并写入; 非redis缓存时直接统计, 版本号取内容摘要
+    """
+    client = get_redis_client()
+    if client is None:
+        counts = count_user_todo(user_id)
+        digest = hashlib.md5(json.dumps(sorted(counts.items())).encode()).hexdigest()
+        return counts, int(digest[:15], 16)
+    key = _todo_key(user_id)
+    data = client.hgetall(key)
+    if data:
+        return _from_hash(data)
+    counts = count_user_todo(user_id)
+    version = time.time_ns()
+    pipe = client.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping=_to_hash(counts, version))
+    pipe.expire(key, TODO_TIMEOUT)
+    pipe.execute()
+    return counts, version
+
+
+def _apply_todo_changes(changes):
+    client = get_redis_client()
+    if client is None:
+        return
+    version = time.time_ns()
+    try:
+        for user_id, deltas in changes.items():
+            args = [version]
+            for workflow_id, delta in deltas.items():
+                if delta:
+                    args += [TODO_WORKFLOW_FIELD.format(workflow_id), delta]
+            total = sum(deltas.values())
+            if total:
+                args += [TODO_TOTAL_FIELD, total]
+            if len(args) > 1:
+                client.eval(TODO_INCR_SCRIPT, 1, _todo_key(user_id), *args)
+    except Exception as e:
+        # 计数器更新失败不影响业务, 由定时对账修正
+        logger.warning('待办计数更新失败: {}'.format(e))
+
+
+def update_todo_counts(changes):
+    """
+    事务提交后增量更新待办计数
+    changes: {user_id: {workflow_id: delta}}
+    """
+    changes = {k: v for k, v in changes.items() if any(v.values())}
+    if changes:
+        transaction.on_commit(lambda: _apply_todo_changes(changes))
+
+
+def get_todo_changes(workflow_id, added=(), removed=()):
+    changes = {}
+    for user_id in added:
+        changes.setdefault(user_id, {})[workflow_id] = 1
+    for user_id in removed:
+        changes.setdefault(user_id, {})[workflow_id] = -1
+    return changes
+
+
+def reconcile_todo_counts():
+    """
+    对账: 以数据库为准重写所有已存在的计数器, 返回修正的用户数
+    """
+    client = get_redis_client()
+    if client is None:
+        return 0
+    fixed = 0
+    prefix = _todo_key('')
+    for key in client.scan_iter(match=prefix + '*', count=500):
+        key = key.decode() if isinstance(key, bytes) else key
+        user_id = key[len(prefix):]
+        if not user_id.isdigit():
+            continue
+        data = client.hgetall(key)
+        if not data:
+            continue
+        counts, _ = _from_hash(data)
+        actual = count_user_todo(int(user_id))
+        if counts != actual:
+            pipe = client.pipeline()
+            pipe.delete(key)
+            pipe.hset(key, mapping=_to_hash(actual, time.time_ns()))
+            pipe.expire(key, TODO_TIMEOUT)
+            pipe.execute()
+            fixed += 1
+    return fixed
+
+
+def get_todo_details(counts):
+    """
+    待办按工作流的明细, 与原duty_agg的返回结构一致
+    """
+    if not counts:
+        return []
+    names = dict(Workflow._base_manager.filter(id__in=counts).values_list('id', 'name'))
+    return [{'workflow': k, 'workflow__name': names.get(k, ''), 'count': v} for k, v in counts.items()]
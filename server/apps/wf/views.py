@@ -4,22 +4,23 @@ from django.db.models import query
 from rest_framework.utils import serializer_helpers
 from rest_framework.views import APIView
 from apps.system.models import User
+from apps.system.permission import filter_permitted
 from apps.wf.filters import TicketFilterSet
 from django.core.exceptions import AppRegistryNotReady
 from rest_framework.response import Response
 from rest_framework import serializers
 from rest_framework.mixins import CreateModelMixin, DestroyModelMixin, ListModelMixin, RetrieveModelMixin, UpdateModelMixin
-from apps.wf.serializers import CustomFieldCreateUpdateSerializer, CustomFieldSerializer, StateSerializer, TicketAddNodeEndSerializer, TicketAddNodeSerializer, TicketCloseSerializer, TicketCreateSerializer, TicketDestorySerializer, TicketFlowSerializer, TicketFlowSimpleSerializer, TicketHandleSerializer, TicketRetreatSerializer, TicketSerializer, TransitionSerializer, WorkflowSerializer, TicketListSerializer, TicketDetailSerializer
+from apps.wf.serializers import CustomFieldCreateUpdateSerializer, CustomFieldSerializer, StateSerializer, TicketAddNodeEndSerializer, TicketAddNodeSerializer, TicketCloseSerializer, TicketCreateSerializer, TicketDestorySerializer, TicketFlowSerializer, TicketFlowSimpleSerializer, TicketHandleBatchSerializer, TicketHandleSerializer, TicketRetreatSerializer, TicketSerializer, TransitionSerializer, WorkflowSerializer, TicketListSerializer, TicketDetailSerializer
 from django.shortcuts import get_object_or_404, render
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 from rest_framework.decorators import action, api_view
-from apps.wf.models import CustomField, Ticket, Workflow, State, Transition, TicketFlow
+from apps.wf.models import CustomField, Ticket, Workflow, State, Transition, TicketFlow, TicketParticipant
 from apps.system.mixins import CreateUpdateCustomMixin, CreateUpdateModelAMixin, OptimizationMixin
-from apps.wf.services import WfService
+from apps.wf.services import TicketConflict, WfService
 from rest_framework.exceptions import APIException, PermissionDenied
 from rest_framework import status
-from django.db.models import Count
 from .scripts import GetParticipants, HandleScripts
+from .todo import get_todo_details, get_user_todo, update_todo_counts
 
 
 # Create your views here.
@@ -64,7 +65,7 @@ class WorkflowViewSet(CreateUpdateModelAMixin, ModelViewSet):
         工作流下的自定义字段
         """
         wf = self.get_object()
-        serializer = self.serializer_class(instance=CustomField.objects.filter(workflow=wf, is_deleted=False).order_by('sort'), many=True)
+        serializer = self.serializer_class(instance=WfService.get_workflow_custom_fields(wf), many=True)
         return Response(serializer.data)
     
     @action(methods=['get'], detail=True, perms_map={'get':'workflow_init'})
@@ -121,11 +122,19 @@ class CustomFieldViewSet(CreateModelMixin, UpdateModelMixin, RetrieveModelMixin,
 
 class TicketViewSet(OptimizationMixin, CreateUpdateCustomMixin, CreateModelMixin, ListModelMixin, RetrieveModelMixin, GenericViewSet):
     perms_map = {'get':'*', 'post':'ticket_create'}
+    obj_perm_check = False # 工单的查看和处理由处理人控制, 不走数据权限
     queryset = Ticket.objects.all()
     serializer_class = TicketSerializer
     search_fields = ['title']
     filterset_class = TicketFilterSet
     ordering = ['-create_time']
+    cursor_ordering = ('-create_time', '-id')
+
+    def get_cursor_ordering(self):
+        # 处理过的/抄送我的按参与记录的最近流转时间翻页, 走参与记录(user, role, -last_touched)索引
+        if self.request.query_params.get('category', None) in ('worked', 'cc'):
+            return ('-involvement_touched', '-id')
+        return self.cursor_ordering
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -192,14 +201,19 @@ class TicketViewSet(OptimizationMixin, CreateUpdateCustomMixin, CreateModelMixin
     @action(methods=['get'], detail=False, perms_map={'get':'*'})
     def duty_agg(self, request, pk=None):
         """
-        工单待办聚合
+        工单待办聚合, 读取待办计数器
+        参数since为上次返回的version, 未变化时返回304
         """
+        counts, version = get_user_todo(request.user.id)
+        headers = {'ETag': '"{}"'.format(version)}
+        since = request.query_params.get('since', None) or request.META.get('HTTP_IF_NONE_MATCH', '').strip('W/"')
+        if since == str(version):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
         ret = {}
-        queryset = Ticket.objects.filter(participant__contains=request.user.id, is_deleted=False)\
-            .exclude(act_state__in=[Ticket.TICKET_ACT_STATE_FINISH, Ticket.TICKET_ACT_STATE_CLOSED])
-        ret['total_count'] = queryset.count()
-        ret['details'] = list(queryset.values('workflow', 'workflow__name').annotate(count = Count('workflow')))
-        return Response(ret)
+        ret['total_count'] = sum(counts.values())
+        ret['details'] = get_todo_details(counts)
+        ret['version'] = str(version)
+        return Response(ret, headers=headers)
 
     @action(methods=['post'], detail=True, perms_map={'post':'*'})
     @transaction.atomic
@@ -211,14 +225,33 @@ class TicketViewSet(OptimizationMixin, CreateUpdateCustomMixin, CreateModelMixin
         serializer = TicketHandleSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         vdata = serializer.validated_data
-        new_ticket_data = ticket.ticket_data
+        if ticket.multi_all_person:
+            # 会签中各处理人只写入自己的投票记录, 不锁定工单, 不校验他人投票引起的版本变化
+            if vdata.get('version', None) not in (None, ticket.version):
+                raise TicketConflict()
+        else:
+            # 锁定工单, 同时处理同一工单的请求依次执行; 传入version时校验是否基于最新数据
+            WfService.lock_ticket(ticket, vdata.get('version', None))
+        new_ticket_data = dict(ticket.ticket_data)
         new_ticket_data.update(**vdata['ticket_data'])
 
         ticket = WfService.handle_ticket(ticket=ticket, transition=vdata['transition'], 
-        new_ticket_data=new_ticket_data, handler=request.user, suggestion=vdata['suggestion'])
+        new_ticket_data=new_ticket_data, handler=request.user, suggestion=vdata.get('suggestion', ''))
         return Response(TicketSerializer(instance=ticket).data)
         
 
+    @action(methods=['post'], detail=False, perms_map={'post':'*'}, serializer_class=TicketHandleBatchSerializer)
+    def handle_batch(self, request, pk=None):
+        """
+        批量处理工单, 返回每个工单的处理结果
+        all_or_none为true时任一工单处理失败则全部回滚
+        """
+        serializer = TicketHandleBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        vdata = serializer.validated_data
+        results = WfService.handle_ticket_batch(vdata['items'], handler=request.user, all_or_none=vdata['all_or_none'])
+        return Response(results)
+
     @action(methods=['get'], detail=True, perms_map={'get':'*'})
     def flowsteps(self, request, pk=None):
         """
@@ -231,11 +264,11 @@ class TicketViewSet(OptimizationMixin, CreateUpdateCustomMixin, CreateModelMixin
     @action(methods=['get'], detail=True, perms_map={'get':'*'})
     def flowlogs(self, request, pk=None):
         """
-        工单流转记录
+        工单流转记录, 参数delta=true时工单数据返回增量
         """
         ticket = self.get_object()
-        flowlogs = TicketFlow.objects.filter(ticket=ticket).order_by('-create_time')
-        serializer = TicketFlowSerializer(instance=flowlogs, many=True)
+        flowlogs = TicketFlow.objects.filter(ticket=ticket).select_related('participant', 'state').order_by('-create_time')
+        serializer = TicketFlowSerializer(instance=flowlogs, many=True, context={'request': request})
         return Response(serializer.data)
     
     @action(methods=['get'], detail=True, perms_map={'get':'*'})
@@ -248,19 +281,22 @@ class TicketViewSet(OptimizationMixin, CreateUpdateCustomMixin, CreateModelMixin
         return Response(TransitionSerializer(instance=transitions, many=True).data)
 
     @action(methods=['post'], detail=True, perms_map={'post':'*'})
+    @transaction.atomic
     def accpet(self, request, pk=None):
         """
         接单,当工单当前处理人实际为多个人时(角色、部门、多人都有可能， 注意角色和部门有可能实际只有一人)
         """
         ticket = self.get_object()
+        WfService.lock_ticket(ticket)
         result = WfService.ticket_handle_permission_check(ticket, request.user)
         if result.get('need_accept', False):
             ticket.participant_type = State.PARTICIPANT_TYPE_PERSONAL
             ticket.participant = request.user.id
-            ticket.save()
+            WfService.save_ticket(ticket, ['participant_type', 'participant'])
+            WfService.sync_ticket_participants(ticket)
             # 接单日志
             # 更新工单流转记录
-            TicketFlow.objects.create(ticket=ticket, state=ticket.state, ticket_data=WfService.get_ticket_all_field_value(ticket),
+            WfService.create_ticket_flow(ticket, state=ticket.state,
                         suggestion='', participant_type=State.PARTICIPANT_TYPE_PERSONAL, intervene_type=Transition.TRANSITION_ATTRIBUTE_TYPE_ACCEPT,
                         participant=request.user, transition=None)
             return Response()
@@ -268,83 +304,99 @@ class TicketViewSet(OptimizationMixin, CreateUpdateCustomMixin, CreateModelMixin
             raise APIException('无需接单')
     
     @action(methods=['post'], detail=True, perms_map={'post':'*'})
+    @transaction.atomic
     def retreat(self, request, pk=None):
         """
         撤回工单，允许创建人在指定状态撤回工单至初始状态，状态设置中开启允许撤回
         """
         ticket = self.get_object()
+        WfService.lock_ticket(ticket)
         if ticket.create_by != request.user:
             raise APIException('非创建人不可撤回')
-        if not ticket.state.enable_retreat:
+        if not WfService.get_ticket_state(ticket).enable_retreat:
             raise APIException('该状态不可撤回')
         start_state = WfService.get_workflow_start_state(ticket.workflow)
         ticket.state = start_state
         ticket.participant_type = State.PARTICIPANT_TYPE_PERSONAL
         ticket.participant = request.user.id
         ticket.act_state = Ticket.TICKET_ACT_STATE_RETREAT
-        ticket.save()
+        ticket.multi_all_person = {}
+        WfService.save_ticket(ticket, ['state', 'participant_type', 'participant', 'multi_all_person', 'act_state'])
+        WfService.clear_ticket_votes(ticket)
+        WfService.sync_ticket_participants(ticket)
+        WfService.sync_ticket_timers(ticket)
         # 更新流转记录
         suggestion = request.data.get('suggestion', '') # 撤回原因
-        TicketFlow.objects.create(ticket=ticket, state=ticket.state, ticket_data=WfService.get_ticket_all_field_value(ticket),
+        WfService.create_ticket_flow(ticket, state=ticket.state,
                         suggestion=suggestion, participant_type=State.PARTICIPANT_TYPE_PERSONAL, intervene_type=Transition.TRANSITION_INTERVENE_TYPE_RETREAT,
                         participant=request.user, transition=None)
         return Response()
     
     @action(methods=['post'], detail=True, perms_map={'post':'*'}, serializer_class=TicketAddNodeSerializer)
+    @transaction.atomic
     def add_node(self, request, pk=None):
         """
         加签
         """
         ticket = self.get_object()
+        WfService.lock_ticket(ticket)
         data = request.data
         add_user = User.objects.get(pk=data['toadd_user'])
         ticket.participant_type = State.PARTICIPANT_TYPE_PERSONAL
         ticket.participant = add_user.id
         ticket.in_add_node = True
         ticket.add_node_man = request.user
-        ticket.save()
+        WfService.save_ticket(ticket, ['participant_type', 'participant', 'in_add_node', 'add_node_man'])
+        WfService.sync_ticket_participants(ticket)
         # 更新流转记录
         suggestion = request.data.get('suggestion', '') # 加签说明
-        TicketFlow.objects.create(ticket=ticket, state=ticket.state, ticket_data=WfService.get_ticket_all_field_value(ticket),
+        WfService.create_ticket_flow(ticket, state=ticket.state,
                         suggestion=suggestion, participant_type=State.PARTICIPANT_TYPE_PERSONAL, intervene_type=Transition.TRANSITION_INTERVENE_TYPE_ADD_NODE,
                         participant=request.user, transition=None)
         return Response()
 
     @action(methods=['post'], detail=True, perms_map={'post':'*'}, serializer_class=TicketAddNodeEndSerializer)
+    @transaction.atomic
     def add_node_end(self, request, pk=None):
         """
         加签完成
         """
         ticket = self.get_object()
+        WfService.lock_ticket(ticket)
         ticket.participant_type = State.PARTICIPANT_TYPE_PERSONAL
         ticket.in_add_node = False
         ticket.participant = ticket.add_node_man.id
         ticket.add_node_man = None
-        ticket.save()
+        WfService.save_ticket(ticket, ['participant_type', 'in_add_node', 'participant', 'add_node_man'])
+        WfService.sync_ticket_participants(ticket)
         # 更新流转记录
         suggestion = request.data.get('suggestion', '') # 加签意见
-        TicketFlow.objects.create(ticket=ticket, state=ticket.state, ticket_data=WfService.get_ticket_all_field_value(ticket),
+        WfService.create_ticket_flow(ticket, state=ticket.state,
                         suggestion=suggestion, participant_type=State.PARTICIPANT_TYPE_PERSONAL, intervene_type=Transition.TRANSITION_INTERVENE_TYPE_ADD_NODE_END,
                         participant=request.user, transition=None)
         return Response()
     
 
     @action(methods=['post'], detail=True, perms_map={'post':'*'}, serializer_class=TicketCloseSerializer)
+    @transaction.atomic
     def close(self, request, pk=None):
         """
         关闭工单(创建人在初始状态)
         """
         ticket = self.get_object()
-        if ticket.state.type == State.STATE_TYPE_START and ticket.create_by==request.user:
+        WfService.lock_ticket(ticket)
+        if WfService.get_ticket_state(ticket).type == State.STATE_TYPE_START and ticket.create_by_id==request.user.id:
             end_state = WfService.get_workflow_end_state(ticket.workflow)
             ticket.state = end_state
             ticket.participant_type = 0
             ticket.participant = 0
             ticket.act_state = Ticket.TICKET_ACT_STATE_CLOSED
-            ticket.save()
+            WfService.save_ticket(ticket, ['state', 'participant_type', 'participant', 'act_state'])
+            WfService.sync_ticket_participants(ticket)
+            WfService.sync_ticket_timers(ticket)
             # 更新流转记录
             suggestion = request.data.get('suggestion', '') # 关闭原因
-            TicketFlow.objects.create(ticket=ticket, state=ticket.state, ticket_data=WfService.get_ticket_all_field_value(ticket),
+            WfService.create_ticket_flow(ticket, state=ticket.state,
                             suggestion=suggestion, participant_type=State.PARTICIPANT_TYPE_PERSONAL, intervene_type=Transition.TRANSITION_INTERVENE_TYPE_CLOSE,
                             participant=request.user, transition=None)
             return Response()
@@ -352,11 +404,23 @@ class TicketViewSet(OptimizationMixin, CreateUpdateCustomMixin, CreateModelMixin
             return Response('工单不可关闭', status=status.HTTP_400_BAD_REQUEST)
 
     @action(methods=['post'], detail=False, perms_map={'post':'ticket_deletes'}, serializer_class=TicketDestorySerializer)
+    @transaction.atomic
     def destory(self, request, pk=None):
         """
         批量物理删除
         """
-        Ticket.objects.filter(id__in=request.data.get('ids', [])).delete(soft=False)
+        tickets = list(Ticket.objects.filter(id__in=request.data.get('ids', []))
+            .only('id', 'belong_dept', 'create_by', 'update_by'))
+        permitted = filter_permitted(request.user, tickets)
+        if len(permitted) != len(tickets):
+            raise PermissionDenied('无权删除部分工单')
+        ids = [i.id for i in permitted]
+        changes = {}
+        for workflow_id, user_id in TicketParticipant.objects.filter(ticket_id__in=ids).values_list('ticket__workflow', 'user'):
+            changes.setdefault(user_id, {})
+            changes[user_id][workflow_id] = changes[user_id].get(workflow_id, 0) - 1
+        update_todo_counts(changes)
+        Ticket.objects.filter(id__in=ids).delete(soft=False)
         return Response()
 
 
@@ -370,4 +434,5 @@ class TicketFlowViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
     serializer_class = TicketFlowSerializer
     search_fields = ['suggestion']
     filterset_fields = ['ticket']
-    ordering = ['-create_time']
\ No newline at end of file
+    ordering = ['-create_time']
+    cursor_ordering = ('-create_time', '-id')
\ No newline at end of file
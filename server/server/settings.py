@@ -199,6 +199,11 @@ CACHES = {
         "LOCATION": "redis://127.0.0.1:6379/1",
     }
 }
+# 进程内缓存配置,用于鉴权等热点数据,各worker通过redis发布订阅失效
+LOCAL_CACHE = {
+    'MAXSIZE': 4096,  # 最多缓存条数
+    'TIMEOUT': 60,  # 超时时间(秒),兜底漏掉的失效消息
+}
 
 # celery配置,celery正常运行必须安装redis
 CELERY_BROKER_URL = "redis://localhost:6379/0"   # 任务存储
@@ -217,6 +222,27 @@ CELERY_BEAT_SCHEDULE = {
             'expires': 3600  # 任务过期时间（秒）
         }
     },
+    'wf-requeue-ticket-scripts': {
+        'task': 'wf_requeue_ticket_scripts',
+        'schedule': crontab(minute='*'),  # 每分钟补发未执行的工单脚本任务
+        'options': {
+            'expires': 60
+        }
+    },
+    'wf-fire-ticket-timers': {
+        'task': 'wf_fire_ticket_timers',
+        'schedule': 30.0,  # 每30秒执行到期的工单定时流转
+        'options': {
+            'expires': 30
+        }
+    },
+    'wf-reconcile-todo-counts': {
+        'task': 'wf_reconcile_todo_counts',
+        'schedule': crontab(minute='*/10'),  # 每10分钟对账待办计数
+        'options': {
+            'expires': 600
+        }
+    },
 }
 
 # swagger配置
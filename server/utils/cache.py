@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('log')
+
+INVALIDATE_CHANNEL = 'local_cache__invalidate'
+
+
+class LocalCache(object):
+    """
+    进程内LRU/TTL缓存,放在redis前面缓存鉴权等热点数据
+    各worker之间通过redis发布订阅失效消息保持一致,超时时间兜底
+    """
+
+    def __init__(self, maxsize=4096, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, None)
+            if item is None:
+                return default
+            value, expire = item
+            if expire < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expire = time.monotonic() + (timeout or self.timeout)
+        with self._lock:
+            self._data[key] = (value, expire)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self, prefix=None):
+        """
+        清除全部或指定前缀的缓存
+        """
+        with self._lock:
+            if prefix is None:
+                self._data.clear()
+            else:
+                for key in [k for k in self._data if k.startswith(prefix)]:
+                    del self._data[key]
+
+
+_local_conf = getattr(settings, 'LOCAL_CACHE', {})
+local_cache = LocalCache(maxsize=_local_conf.get('MAXSIZE', 4096),
+                         timeout=_local_conf.get('TIMEOUT', 60))
+
+
+def get_redis_client():
+    """
+    获取默认缓存使用的redis连接,非redis缓存时返回None
+    """
+    backend = getattr(cache, '_cache', None)
+    if backend is None or not hasattr(backend, 'get_client'):
+        return None
+    return backend.get_client(write=True)
+
+
+def _apply_invalidation(message):
+    if message.get('prefix', None) is not None:
+        local_cache.clear(prefix=message['prefix'])
+    if message.get('keys', None):
+        local_cache.delete_many(message['keys'])
+
+
+class InvalidationListener(threading.Thread):
+    """
+    订阅失效消息的后台线程,每个进程一个
+    断线期间可能漏掉消息,重连后清空本地缓存
+    """
+    daemon = True
+
+    def __init__(self, client):
+        super().__init__(name='local-cache-invalidation')
+        self.client = client
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATE_CHANNEL)
+                local_cache.clear()
+                for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        _apply_invalidation(json.loads(message['data']))
+            except Exception as e:
+                logger.warning('本地缓存失效订阅断开: {}'.format(e))
+                local_cache.clear()
+                time.sleep(5)
+
+
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def ensure_invalidation_listener():
+    """
+    按进程懒启动订阅线程(兼容gunicorn预加载后fork)
+    """
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        client = get_redis_client()
+        if client is not None:
+            InvalidationListener(client).start()
+
+
+def local_get(key, default=None):
+    ensure_invalidation_listener()
+    return local_cache.get(key, default)
+
+
+def local_set(key, value, timeout=None):
+    ensure_invalidation_listener()
+    local_cache.set(key, value, timeout)
+
+
+def invalidate_local(keys=None, prefix=None):
+    """
+    本进程立即失效并通知其他worker
+    keys: 需要清除的键列表
+    prefix: 需要清除的键前缀
+    """
+    message = {'keys': list(keys) if keys else [], 'prefix': prefix}
+    _apply_invalidation(message)
+    try:
+        client = get_redis_client()
+        if client is not None:
+            client.publish(INVALIDATE_CHANNEL, json.dumps(message))
+    except Exception as e:
+        logger.warning('本地缓存失效消息发布失败: {}'.format(e))
+
+
+def get_version(key):
+    """
+    获取缓存版本号,先查进程内缓存再查redis,不存在时初始化
+    """
+    version = local_get(key)
+    if version is None:
+        version = cache.get(key, None)
+        if version is None:
+            version = time.time_ns()
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+        local_set(key, version)
+    return version
+
+
+def bump_version(key, prefix=None):
+    """
+    更新缓存版本号并通知各worker失效
+    prefix: 同时需要清除的本地缓存键前缀
+    """
+    version = time.time_ns()
+    cache.set(key, version, None)
+    invalidate_local(keys=[key], prefix=prefix)
+    return version
@@ -1,6 +1,8 @@
-from django.db import models
+from django.db import connections, models
 import django.utils.timezone as timezone
+from django.db.models.lookups import IsNull
 from django.db.models.query import QuerySet
+from utils.queryset import TreeDepth, TreeJoin, get_root_ids, get_tree_ids, support_recursive_cte
 
 # 自定义软删除查询基类
 
@@ -49,6 +51,69 @@ class SoftDeletableManager(SoftDeletableManagerMixin, models.Manager):
     pass
 
 
+class TreeQuerySetMixin(object):
+    '''
+    树形数据表(包含parent字段)的查询
+    subtree_ids/ancestor_ids返回{id:相对深度}, 支持WITH RECURSIVE的数据库单次查询
+    roots可为实例,id或它们的列表
+    '''
+
+    def subtree_ids(self, roots, include_self=True):
+        return get_tree_ids(self.model, roots, include_self=include_self, using=self.db)
+
+    def ancestor_ids(self, roots, include_self=True):
+        return get_tree_ids(self.model, roots, include_self=include_self, ancestors=True, using=self.db)
+
+    def _tree(self, roots, include_self, ancestors, with_depth):
+        '''
+        支持WITH RECURSIVE时内连接递归查询, 单次查询返回数据及depth
+        否则先逐层查出id再过滤
+        '''
+        root_ids = get_root_ids(roots)
+        if not root_ids:
+            return self.none()
+        if not support_recursive_cte(connections[self.db]):
+            depths = get_tree_ids(self.model, root_ids, include_self=include_self,
+                                  ancestors=ancestors, using=self.db)
+            queryset = self.filter(pk__in=list(depths))
+            if with_depth and depths:
+                queryset = queryset.annotate(depth=models.Case(
+                    *[models.When(pk=k, then=models.Value(v)) for k, v in depths.items()],
+                    output_field=models.IntegerField()))
+            return queryset
+        queryset = self.all()
+        query = queryset.query
+        alias = query.join(TreeJoin(self.model, root_ids, query.get_initial_alias(),
+                                    include_self=include_self, ancestors=ancestors))
+        query.alias_map[alias] = query.alias_map[alias].demote()
+        depth = TreeDepth(alias)
+        # 与其他查询|合并时连接会改为外连接, 仍按depth非空过滤
+        queryset = queryset.filter(IsNull(depth, False))
+        if with_depth:
+            queryset = queryset.annotate(depth=depth)
+        return queryset
+
+    def descendants(self, roots, include_self=True, with_depth=False):
+        '''
+        所有下级,with_depth为True时标注相对深度depth
+        '''
+        return self._tree(roots, include_self, False, with_depth)
+
+    def ancestors(self, roots, include_self=True, with_depth=False):
+        '''
+        所有上级,with_depth为True时标注相对深度depth
+        '''
+        return self._tree(roots, include_self, True, with_depth)
+
+
+class TreeQuerySet(TreeQuerySetMixin, SoftDeletableQuerySet):
+    pass
+
+
+class TreeManager(SoftDeletableManagerMixin, models.Manager.from_queryset(TreeQuerySet)):
+    _queryset_class = TreeQuerySet
+
+
 class BaseModel(models.Model):
     """
     基本表
@@ -1,17 +1,138 @@
+import base64
+import json
+from django.db import connections
+from django.db.models import Q
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def estimate_count(queryset):
+    """
+    估算查询结果数量, postgresql取执行计划的估算行数, 其他数据库精确统计
+    """
+    if connections[queryset.db].vendor != 'postgresql':
+        return queryset.count()
+    plan = json.loads(queryset.order_by().values('pk').explain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
 
 class MyPagination(PageNumberPagination):
+    """
+    默认页码分页; 请求带cursor参数时(首页传空值)改用游标分页, 不统计总数也不使用offset
+    游标分页按视图的get_cursor_ordering()或cursor_ordering排序(默认创建时间、id倒序), 可使用annotate的字段
+    忽略ordering参数, 只能向后翻页
+    count=approx时返回估算总数, count=exact时返回精确总数
+    """
     page_size = 10
     page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    cursor_ordering = ('-create_time', '-id')
 
     def paginate_queryset(self, queryset, request, view=None):
         if request.query_params.get('pageoff', None) or request.query_params.get('page', None) == '0':
             if queryset.count() < 800:
                 return None
             raise ParseError('单次请求数据量大,请分页获取')
+        self.cursor_mode = self.cursor_query_param in request.query_params
+        if self.cursor_mode:
+            return self.paginate_queryset_by_cursor(queryset, request, view=view)
         return super().paginate_queryset(queryset, request, view=view)
 
+    def get_paginated_response(self, data):
+        if not getattr(self, 'cursor_mode', False):
+            return super().get_paginated_response(data)
+        return Response({
+            'count': self.count,
+            'next': self.get_next_link(),
+            'previous': None,
+            'results': data
+        })
+
+    def get_next_link(self):
+        if not getattr(self, 'cursor_mode', False):
+            return super().get_next_link()
+        if self.next_cursor is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def paginate_queryset_by_cursor(self, queryset, request, view=None):
+        self.request = request
+        if hasattr(view, 'get_cursor_ordering'):
+            ordering = tuple(view.get_cursor_ordering())
+        else:
+            ordering = tuple(getattr(view, 'cursor_ordering', self.cursor_ordering))
+        try:
+            fields, attnames = zip(*[self.get_ordering_field(queryset, i.lstrip('-')) for i in ordering])
+        except Exception:
+            raise ParseError('该列表不支持游标分页')
+        queryset = queryset.order_by(*ordering)
+        count = request.query_params.get('count', None)
+        if count == 'approx':
+            self.count = estimate_count(queryset)
+        elif count == 'exact':
+            self.count = queryset.count()
+        else:
+            self.count = None
+        cursor = request.query_params.get(self.cursor_query_param, None)
+        if cursor:
+            values = self.decode_cursor(cursor, fields)
+            queryset = self.filter_after(queryset, ordering, values)
+        page_size = self.get_page_size(request)
+        results = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            last = results[-1]
+            self.next_cursor = self.encode_cursor([getattr(last, i) for i in attnames])
+        return results
+
+    @staticmethod
+    def get_ordering_field(queryset, name):
+        """
+        排序字段及实例上的属性名, annotate的字段取其输出字段
+        """
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field, name
+        field = queryset.model._meta.get_field(name)
+        if not field.concrete or field.many_to_many or field.one_to_many:
+            raise ValueError(name)
+        return field, field.attname
+
+    @staticmethod
+    def filter_after(queryset, ordering, values):
+        """
+        排序在游标之后的数据: (a, b) < (va, vb) 展开为 a < va or (a = va and b < vb)
+        首字段另加范围条件, 便于按联合索引顺序扫描
+        """
+        q = Q()
+        for i, field in enumerate(ordering):
+            cond = Q(**{'{}__{}'.format(field.lstrip('-'), 'lt' if field.startswith('-') else 'gt'): values[i]})
+            for prev, value in zip(ordering[:i], values):
+                cond &= Q(**{prev.lstrip('-'): value})
+            q |= cond
+        first = ordering[0]
+        queryset = queryset.filter(**{'{}__{}'.format(first.lstrip('-'), 'lte' if first.startswith('-') else 'gte'): values[0]})
+        return queryset.filter(q)
+
+    @staticmethod
+    def encode_cursor(values):
+        # 时间保留微秒, 否则同一秒内的数据会被跳过或重复
+        values = [i.isoformat() if hasattr(i, 'isoformat') else i for i in values]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor, fields):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            if not isinstance(values, list) or len(values) != len(fields):
+                raise ValueError
+            return [field.to_python(value) for field, value in zip(fields, values)]
+        except Exception:
+            raise ParseError('无效的cursor')
+
 class PageOrNot:
     def paginate_queryset(self, queryset):
         if (self.paginator is None):
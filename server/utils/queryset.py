@@ -1,24 +1,186 @@
-from django.db import models
+from django.db import connections, models
+from django.db.models.sql.constants import INNER, LOUTER
 from django.apps import apps
 
+MAX_TREE_DEPTH = 100  # 递归层数上限,防止parent成环时死循环
 
-def get_child_queryset_u(checkQueryset, obj, hasParent=True):
+
+def get_root_ids(roots):
     '''
-    获取所有子集
-    查的范围checkQueryset
-    父obj
-    是否包含父默认True
+    统一转换为id列表
+    roots可为实例,id或它们的列表
+    '''
+    if roots is None:
+        return []
+    if isinstance(roots, (list, tuple, set, frozenset, models.QuerySet)):
+        return [getattr(i, 'pk', i) for i in roots if i is not None]
+    return [getattr(roots, 'pk', roots)]
+
+
+def support_recursive_cte(connection):
+    '''
+    数据库是否支持WITH RECURSIVE
+    '''
+    if connection.vendor in ('postgresql', 'sqlite'):
+        return True
+    if connection.vendor == 'mysql':
+        return connection.mysql_is_mariadb or connection.mysql_version >= (8,)
+    return False
+
+
+def _tree_cte_sql(model, connection, ancestors=False):
+    qn = connection.ops.quote_name
+    opts = model._meta
+    table, pk = qn(opts.db_table), qn(opts.pk.column)
+    parent = qn(opts.get_field('parent').column)
+    live = ''
+    if not ancestors and any(f.name == 'is_deleted' for f in opts.concrete_fields):
+        # 与原逐层查询一致,不经过已软删除的节点向下查找
+        live = ' AND t.{} = %s'.format(qn('is_deleted'))
+    join = 't.{} = tree.parent_id'.format(pk) if ancestors else 't.{} = tree.id'.format(parent)
+    return (
+        'WITH RECURSIVE tree(id, parent_id, depth) AS ('
+        'SELECT {pk}, {parent}, 0 FROM {table} WHERE {pk} IN ({{ids}}) '
+        'UNION ALL '
+        'SELECT t.{pk}, t.{parent}, tree.depth + 1 FROM {table} t JOIN tree ON {join} '
+        'WHERE tree.depth < %s{live}) '
+        'SELECT id, MIN(depth) AS depth FROM tree GROUP BY id'
+    ).format(pk=pk, parent=parent, table=table, join=join, live=live), bool(live)
+
+
+def _tree_ids_by_cte(model, root_ids, using, ancestors=False):
+    connection = connections[using]
+    sql, has_live = _tree_cte_sql(model, connection, ancestors)
+    sql = sql.format(ids=', '.join(['%s'] * len(root_ids)))
+    params = list(root_ids) + [MAX_TREE_DEPTH] + ([False] if has_live else [])
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return dict(cursor.fetchall())
+
+
+def _tree_ids_by_loop(model, root_ids, using, ancestors=False):
+    base = model._base_manager.using(using)
+    has_live = any(f.name == 'is_deleted' for f in model._meta.concrete_fields)
+    depths = {i: 0 for i in root_ids}
+    current, depth = list(root_ids), 0
+    while current and depth < MAX_TREE_DEPTH:
+        depth += 1
+        if ancestors:
+            next_ids = base.filter(pk__in=current, parent__isnull=False).values_list('parent_id', flat=True)
+        else:
+            queryset = base.filter(parent_id__in=current)
+            if has_live:
+                queryset = queryset.filter(is_deleted=False)
+            next_ids = queryset.values_list('pk', flat=True)
+        current = [i for i in set(next_ids) if i not in depths]
+        for i in current:
+            depths[i] = depth
+    return depths
+
+
+class TreeJoin(object):
+    '''
+    把WITH RECURSIVE查询作为派生表内连接到主表, 单次查询返回数据及相对深度(depth列)
+    与django的Join接口一致, 通过Query.join加入alias_map
     '''
-    cls = type(obj)
-    queryset = cls.objects.none()
-    fatherQueryset = cls.objects.filter(pk=obj.id)
-    if hasParent:
-        queryset = queryset | fatherQueryset
-    child_queryset = checkQueryset.filter(parent=obj)
-    while child_queryset:
-        queryset = queryset | child_queryset
-        child_queryset = checkQueryset.filter(parent__in=child_queryset)
-    return queryset
+    filtered_relation = None
+    # 与其他查询|合并时允许改为外连接, 由depth非空条件过滤
+    nullable = True
+
+    def __init__(self, model, root_ids, parent_alias, include_self=True, ancestors=False,
+                 table_alias=None, join_type=INNER):
+        self.model = model
+        self.root_ids = tuple(root_ids)
+        self.parent_alias = parent_alias
+        self.include_self = include_self
+        self.ancestors = ancestors
+        self.table_name = 'tree_{}'.format(model._meta.db_table)
+        self.table_alias = table_alias
+        self.join_type = join_type
+
+    def as_sql(self, compiler, connection):
+        sql, has_live = _tree_cte_sql(self.model, connection, self.ancestors)
+        sql = sql.format(ids=', '.join(['%s'] * len(self.root_ids)))
+        if not self.include_self:
+            sql += ' HAVING MIN(depth) > 0'
+        params = list(self.root_ids) + [MAX_TREE_DEPTH] + ([False] if has_live else [])
+        qn, alias = compiler.quote_name_unless_alias, compiler.quote_name_unless_alias(self.table_alias)
+        return '{} ({}) {} ON ({}.{} = {}.{})'.format(
+            self.join_type, sql, alias, qn(self.parent_alias), qn(self.model._meta.pk.column),
+            alias, connection.ops.quote_name('id')), params
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(
+            self.model, self.root_ids, change_map.get(self.parent_alias, self.parent_alias),
+            self.include_self, self.ancestors,
+            change_map.get(self.table_alias, self.table_alias), self.join_type)
+
+    @property
+    def identity(self):
+        return (self.__class__, self.model, self.root_ids, self.parent_alias,
+                self.include_self, self.ancestors)
+
+    def __eq__(self, other):
+        if not isinstance(other, TreeJoin):
+            return NotImplemented
+        return self.identity == other.identity
+
+    def __hash__(self):
+        return hash(self.identity)
+
+    def equals(self, other):
+        return self == other
+
+    def demote(self):
+        new = self.relabeled_clone({})
+        new.join_type = INNER
+        return new
+
+    def promote(self):
+        new = self.relabeled_clone({})
+        new.join_type = LOUTER
+        return new
+
+
+class TreeDepth(models.Expression):
+    '''
+    TreeJoin派生表的depth列, 随别名重命名
+    '''
+    output_field = models.IntegerField()
+
+    def __init__(self, alias):
+        super().__init__()
+        self.alias = alias
+
+    def as_sql(self, compiler, connection):
+        return '{}.{}'.format(compiler.quote_name_unless_alias(self.alias),
+                              connection.ops.quote_name('depth')), []
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(change_map.get(self.alias, self.alias))
+
+    def get_group_by_cols(self):
+        return [self]
+
+
+def get_tree_ids(model, roots, include_self=True, ancestors=False, using='default'):
+    '''
+    获取树形数据表(包含parent字段)的所有下级或上级id
+    支持WITH RECURSIVE的数据库单次查询,否则逐层查询
+    返回{id:相对深度}
+    '''
+    root_ids = get_root_ids(roots)
+    if not root_ids:
+        return {}
+    if support_recursive_cte(connections[using]):
+        depths = _tree_ids_by_cte(model, root_ids, using, ancestors)
+    else:
+        depths = _tree_ids_by_loop(model, root_ids, using, ancestors)
+    if not include_self:
+        for i in root_ids:
+            if depths.get(i, None) == 0:
+                del depths[i]
+    return depths
 
 
 def get_child_queryset(name, pk, hasParent=True):
@@ -30,16 +192,8 @@ def get_child_queryset(name, pk, hasParent=True):
     '''
     app, model = name.split('.')
     cls = apps.get_model(app, model)
-    queryset = cls.objects.none()
-    fatherQueryset = cls.objects.filter(pk=pk)
-    if fatherQueryset.exists():
-        if hasParent:
-            queryset = queryset | fatherQueryset
-        child_queryset = cls.objects.filter(parent=fatherQueryset.first())
-        while child_queryset:
-            queryset = queryset | child_queryset
-            child_queryset = cls.objects.filter(parent__in=child_queryset)
-    return queryset
+    return cls.objects.descendants(pk, include_self=hasParent)
+
 
 def get_child_queryset2(obj, hasParent=True):
     '''
@@ -48,23 +202,13 @@ def get_child_queryset2(obj, hasParent=True):
     数据表需包含parent字段
     是否包含父默认True
     '''
-    cls = type(obj)
-    queryset = cls.objects.none()
-    fatherQueryset = cls.objects.filter(pk=obj.id)
-    if hasParent:
-        queryset = queryset | fatherQueryset
-    child_queryset = cls.objects.filter(parent=obj)
-    while child_queryset:
-        queryset = queryset | child_queryset
-        child_queryset = cls.objects.filter(parent__in=child_queryset)
-    return queryset
+    return type(obj).objects.descendants(obj, include_self=hasParent)
+
 
 def get_parent_queryset(obj, hasSelf=True):
-    cls = type(obj)
-    ids = []
-    if hasSelf:
-        ids.append(obj.id)
-    while obj.parent:
-        obj = obj.parent
-        ids.append(obj.id)
-    return cls.objects.filter(id__in=ids)
\ No newline at end of file
+    '''
+    获取所有上级
+    obj实例
+    是否包含自身默认True
+    '''
+    return type(obj).objects.ancestors(obj, include_self=hasSelf)
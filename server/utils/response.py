@@ -47,6 +47,8 @@ class FitJSONRenderer(JSONRenderer):
         """
         response_body = BaseResponse()
         response = renderer_context.get("response")
+        if response.status_code == status.HTTP_304_NOT_MODIFIED:  # 未修改不返回内容
+            return b''
         response_body.code = response.status_code
         if response_body.code >= 400:  # 响应异常
             response_body.data = data  # data里是详细异常信息